@@ -0,0 +1,121 @@
+import sys
+import time
+import numpy as np
+
+from LightCurves import LoadEvent, SamplingModes
+from CubeBuilder import CalculateCube, CalculateCubeExact, CalculateCubeSampling, GridStepOf, SampleStride, SampleSeed
+
+#Convergence of a cube with the number of samples per object: the cube of one band pair
+#built with each sampling mode of CubeBuilder.CalculateCubeSampling, and with the SharedGrid
+#kernel (CubeBuilder.CalculateCube), for several PointsPerDay, compared bin by bin with
+#a reference cube: the exact one of CubeBuilder.CalculateCubeExact, or one of
+#RefPointsPerDay stratified samples with Reference = 'stratified'. The probabilities compared are
+#the counts of each time pair normalised to one. For each mode the cheapest PointsPerDay
+#whose bins are within Tolerance of the reference (for 90% of them) is reported.
+#Usage: python Benchmark_Convergence.py <Event>_LC|<Event>_Interp.pkl [BandPair]
+
+#########################################################
+#Parameter setting
+
+BandPair = 'gr'
+ObjectNo = 1000         #the first objects of the event are used
+TimePairNo = 16         #time pairs drawn from the grid of the Dask script
+
+PointsPerDays = [0.1, 0.3, 1, 3, 10]
+Reference = 'Exact'
+RefPointsPerDay = 100
+
+MinProb = 1e-3          #bins compared: those with a probability of at least MinProb in the reference
+Tolerance = 0.1         #relative error accepted for 90% of the bins compared
+
+Seed = 2021
+
+dT1s = np.arange(-480, 481, 15)
+dT2s = np.hstack(( np.arange(-1920, -1439, 30), np.arange(-480, 481, 30), np.arange(1440, 1921, 30) ))
+
+BinMag = np.arange(-5.05, 6.01, 0.1)
+BinColor = np.arange(-9.25, 9.8, 0.5)
+
+#########################################################
+#Functions
+
+def BuildCube(Store, BandPair, TimePairs, Objects, PointsPerDay, Mode):
+
+    if Mode == 'Exact':
+        return CalculateCubeExact(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay)[1]
+
+    if Mode == 'SharedGrid':
+        return CalculateCube(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                             GridStep=GridStepOf(TimePairs), Seed=SampleSeed(Seed, 'Benchmark', BandPair))[1]
+
+    Keys = [ SampleSeed(Seed, 'Benchmark', BandPair, int(dT1), int(dT2)).generate_state(1, np.uint64)[0] for dT1, dT2 in TimePairs ]
+
+    return CalculateCubeSampling(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay, Keys, Mode=Mode)[1]
+
+#Counts of every time pair normalised to probabilities.
+def Probabilities(HashTable):
+
+    Totals = HashTable.sum(axis=(1, 2), keepdims=True, dtype=np.float64)
+    return np.divide(HashTable, Totals, out=np.zeros(HashTable.shape), where=Totals > 0)
+
+#Median and 90th percentile of the relative errors of the bins of the reference with a
+#probability of at least MinProb, and the mean total variation distance of the time pairs.
+def Errors(Prob, RefProb):
+
+    Mask = RefProb >= MinProb
+    Relative = np.abs(Prob[Mask] - RefProb[Mask]) / RefProb[Mask]
+    Distance = 0.5 * np.abs(Prob - RefProb).sum(axis=(1, 2)).mean()
+
+    return np.median(Relative), np.percentile(Relative, 90), Distance
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python Benchmark_Convergence.py <Event>_LC|<Event>_Interp.pkl [BandPair]')
+
+    if len(sys.argv) > 2:
+        BandPair = sys.argv[2]
+
+    Store = LoadEvent(sys.argv[1])
+    Objects = np.arange(min(ObjectNo, Store.ObjectNo))
+
+    TimePairs = np.array([ [ii, jj] for ii in dT1s for jj in dT2s if abs(ii) <= abs(ii-jj) ])
+    TimePairs = TimePairs[ np.sort(np.random.default_rng(Seed).choice(len(TimePairs), TimePairNo, replace=False)) ]
+
+    start = time.time()
+    RefProb = Probabilities(BuildCube(Store, BandPair, TimePairs, Objects, RefPointsPerDay, Reference))
+    print('Reference: {}, {} objects, {} time pairs, {:.1f} s, {} bins compared.'.format(
+          Reference if Reference == 'Exact' else '{} points per day'.format(RefPointsPerDay),
+          len(Objects), len(TimePairs), time.time()-start, int((RefProb >= MinProb).sum())))
+
+    print('{:<12}{:>14}{:>10}{:>14}{:>14}{:>10}'.format('Mode', 'PointsPerDay', 'Time (s)', 'Median error', '90% error', 'TV'))
+
+    Cheapest = {}
+
+    for Mode in SamplingModes + ['SharedGrid']:
+        for PointsPerDay in PointsPerDays:
+
+            #The shared grid only samples whole numbers of its steps, see CubeBuilder.SampleStride.
+            if Mode == 'SharedGrid':
+                try:
+                    SampleStride(GridStepOf(TimePairs), PointsPerDay)
+                except ValueError:
+                    print('{:<12}{:>14}{:>10}'.format(Mode, PointsPerDay, 'not on the grid'))
+                    continue
+
+            start = time.time()
+            Prob = Probabilities(BuildCube(Store, BandPair, TimePairs, Objects, PointsPerDay, Mode))
+            Spent = time.time() - start
+
+            Median, P90, Distance = Errors(Prob, RefProb)
+            print('{:<12}{:>14}{:>10.2f}{:>14.4f}{:>14.4f}{:>10.4f}'.format(Mode, PointsPerDay, Spent, Median, P90, Distance))
+
+            if P90 <= Tolerance and Mode not in Cheapest:
+                Cheapest[Mode] = PointsPerDay
+
+    for Mode in SamplingModes + ['SharedGrid']:
+        if Mode in Cheapest:
+            print('{:<12} PointsPerDay = {} is within {:.0%} for 90% of the bins.'.format(Mode, Cheapest[Mode], Tolerance))
+        else:
+            print('{:<12} no PointsPerDay tried is within {:.0%} for 90% of the bins.'.format(Mode, Tolerance))
@@ -0,0 +1,130 @@
+import os
+import sys
+import time
+import tempfile
+import numpy as np
+
+from CubeBuilder import SparseCube, WriteCube, LoadCube
+from CubeQuery import ProbabilityCube
+
+#Size and lookup latency of a cube stored dense and sparse (CubeBuilder.SparseCube).
+#Usage: python Benchmark_SparseCube.py [ProbCube_<time>__<Event>.cube|.pkl]
+#Without a cube a synthetic one is used: a Gaussian blob of counts per
+#[BinMag, BinColor] slice, empty elsewhere, on the grids of the Dask script.
+
+#########################################################
+#Parameter setting
+
+BandPairNo = 4          #band pairs of the synthetic cube
+QueryNo = 10000         #single queries timed
+BatchNo = 1000000       #alerts of the batch query
+
+Bands = ['u', 'g', 'r', 'i', 'z', 'Y']
+
+dT1s = np.arange(-480, 481, 15)
+dT2s = np.hstack(( np.arange(-1920, -1439, 30), np.arange(-480, 481, 30), np.arange(1440, 1921, 30) ))
+
+BinMag = np.arange(-5.05, 6.01, 0.1)
+BinColor = np.arange(-9.25, 9.8, 0.5)
+
+#########################################################
+#Functions
+
+def SyntheticCube(BandPairNo=BandPairNo, Seed=0):
+
+    rng = np.random.default_rng(Seed)
+
+    BandPairs = [B1+B2 for B1 in Bands for B2 in Bands if B1!=B2 and B1+B2!='uY' and B1+B2!='Yu'][:BandPairNo]
+    TimePairs = [ [ii, jj] for ii in dT1s for jj in dT2s if abs(ii) <= abs(ii-jj) ]
+
+    MagCenters = (BinMag[1:] + BinMag[:-1]) / 2
+    ColorCenters = (BinColor[1:] + BinColor[:-1]) / 2
+
+    HashTable = np.zeros([len(BandPairs), len(TimePairs), len(MagCenters), len(ColorCenters)], dtype=np.uint32)
+
+    for kk in range(len(BandPairs)):
+
+        Shape = [len(TimePairs), 1, 1]
+        Mag0, MagWidth = rng.normal(0, 0.2, Shape), rng.uniform(0.1, 0.5, Shape)
+        Color0, ColorWidth = rng.normal(0, 1, Shape), rng.uniform(0.5, 2, Shape)
+
+        Blob = np.exp( -0.5*((MagCenters[:, None] - Mag0) / MagWidth)**2 - 0.5*((ColorCenters[None, :] - Color0) / ColorWidth)**2 )
+        HashTable[kk] = np.floor(1e5 * Blob)
+
+    InfoDict = {'EventName': 'Synthetic', 'ObjectNo': 10000, 'PointsPerDay': 1,
+                'BandPairs': [BandPair.lower() for BandPair in BandPairs], 'dT1s': dT1s, 'dT2s': dT2s,
+                'BinMag': BinMag, 'BinColor': BinColor, 'TimePairs': np.array(TimePairs)}
+
+    return InfoDict, HashTable
+
+def Alerts(InfoDict, No, Seed=1):
+
+    rng = np.random.default_rng(Seed)
+
+    Pairs = np.array(InfoDict['BandPairs'])[ rng.integers(len(InfoDict['BandPairs']), size=No) ]
+    dT1 = rng.uniform(-480, 480, No)
+    dT2 = rng.uniform(-1920, 1920, No)
+    dMag = rng.normal(0, 0.5, No)
+    Color = rng.normal(0, 2, No)
+
+    return Pairs, dT1, dT2, dMag, Color
+
+def Benchmark(InfoDict, HashTable):
+
+    Folder = tempfile.mkdtemp()
+    Results = {}
+
+    Alert = Alerts(InfoDict, BatchNo)
+    Single = [ (Alert[0][ii][0], Alert[0][ii][1], Alert[1][ii], Alert[2][ii]) for ii in range(QueryNo) ]
+
+    for Layout in ['dense', 'sparse']:
+
+        FilePath = os.path.join(Folder, Layout + '.cube')
+        WriteCube(FilePath, InfoDict, SparseCube.FromDense(HashTable) if Layout == 'sparse' else HashTable)
+
+        Cube = ProbabilityCube(LoadCube(FilePath)[1], InfoDict)
+
+        #Whole [BinMag, BinColor] slices, as plotted in the notebooks.
+        start = time.perf_counter()
+        for Band1, Band2, dT1, dT2 in Single:
+            try:
+                Cube.Query(Band1, Band2, dT1, dT2)
+            except ValueError:
+                pass
+        SliceTime = (time.perf_counter() - start) / QueryNo
+
+        start = time.perf_counter()
+        Values = Cube.QueryBatch(*Alert)
+        BatchTime = time.perf_counter() - start
+
+        Results[Layout] = {'File (MB)': os.path.getsize(FilePath) / 1024**2,
+                           'Slice query (us)': SliceTime * 1e6,
+                           'Batch (M alerts/s)': BatchNo / BatchTime / 1e6,
+                           'Checksum': int(Values.sum())}
+
+        os.remove(FilePath)
+
+    os.rmdir(Folder)
+
+    return Results
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        InfoDict, HashTable = LoadCube(sys.argv[1], mmap_mode=None)
+        if isinstance(HashTable, SparseCube):
+            HashTable = HashTable.ToDense()
+    else:
+        InfoDict, HashTable = SyntheticCube()
+
+    print('Cube {}, {:.2%} of the bins non-zero.'.format(HashTable.shape, np.count_nonzero(HashTable) / HashTable.size))
+
+    Results = Benchmark(InfoDict, HashTable)
+
+    print('{:<22}{:>12}{:>12}'.format('', 'dense', 'sparse'))
+    for Key in ['File (MB)', 'Slice query (us)', 'Batch (M alerts/s)']:
+        print('{:<22}{:>12.3f}{:>12.3f}'.format(Key, Results['dense'][Key], Results['sparse'][Key]))
+
+    if Results['dense']['Checksum'] != Results['sparse']['Checksum']:
+        print('The dense and sparse batch queries differ!')
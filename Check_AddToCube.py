@@ -0,0 +1,105 @@
+import os
+import sys
+import shutil
+import tempfile
+import numpy as np
+
+from CubeBuilder import SaveCube, LoadCube, ReadManifest, AddToCube, BuildInfo, ObjectChunks
+
+#Check of the incremental builds (CubeBuilder.AddToCube, the Incremental option of
+#ProbabilityCube_forDask_Final.py) on small cubes written in a temporary folder: new objects
+#must be added into a cube with a manifest, while a cube without one (built before manifests,
+#converted from a .pkl, ...), a cube of another build and objects already counted must be
+#refused, the cube being left unchanged.
+#Usage: python Check_AddToCube.py
+
+#########################################################
+#Parameter setting
+
+EventName = 'EV'
+BandPairs = ['gr', 'ri']
+Seed = 2021
+
+dT1s = np.array([0, 30])
+dT2s = np.array([60, 120])
+
+BinMag = np.arange(-1, 1.01, 0.5)
+BinColor = np.arange(-1, 1.01, 1)
+
+CubeObjects = np.arange(0, 100, 2)      #objects counted in the cube
+NewObjects = np.arange(100, 200, 2)     #objects added into it
+
+TimePairs = np.array([ [ii, jj] for ii in dT1s for jj in dT2s ])
+Shape = [ len(BandPairs), len(TimePairs), len(BinMag)-1, len(BinColor)-1 ]
+
+#########################################################
+#Functions
+
+#Counts and infos (as returned by the kernels) of the objects Objects.
+def Counts(Objects):
+
+    HashTable = np.full(Shape, len(Objects), dtype=np.uint32)
+    Infos = [ [len(Objects), BandPair, 0, -0.5, 0.5, -0.5, 0.5, 0] for BandPair in BandPairs ]
+
+    return HashTable, Infos
+
+def Build(PointsPerDay=1):
+    return BuildInfo(BandPairs, dT1s, dT2s, TimePairs, BinMag, BinColor, PointsPerDay, 'SharedGrid')
+
+#A cube of CubeObjects in Folder, with or without their manifest.
+def WriteCube(Folder, Manifest):
+
+    os.makedirs(Folder)
+    HashTable, Infos = Counts(CubeObjects)
+
+    return SaveCube(HashTable, Infos, EventName, BandPairs, dT1s, dT2s, TimePairs, BinMag, BinColor, 1, Folder,
+                    Manifest=ObjectChunks(EventName, CubeObjects, 10, Seed) if Manifest else None, Kernel='SharedGrid')
+
+#Add Objects into the cube FilePath, None if that is accepted, the error otherwise, and
+#whether a refused cube was left unchanged.
+def TryAdd(FilePath, Objects, Build):
+
+    Before = LoadCube(FilePath, mmap_mode=None), ReadManifest(FilePath)
+    HashTable, Infos = Counts(Objects)
+
+    try:
+        AddToCube(FilePath, HashTable, Infos, ObjectChunks(EventName, Objects, 10, Seed), Build)
+        return None, True
+    except ValueError as Error:
+        After = LoadCube(FilePath, mmap_mode=None), ReadManifest(FilePath)
+        return Error, ( np.array_equal(Before[0][1], After[0][1]) and Before[0][0]['ObjectNo'] == After[0][0]['ObjectNo']
+                        and Before[1] == After[1] )
+
+
+if __name__ == '__main__':
+
+    Folder = tempfile.mkdtemp()
+    Failed = False
+
+    try:
+        Cases = [ ('new objects', True, NewObjects, Build(), True),
+                  ('cube without a manifest', False, NewObjects, Build(), False),
+                  ('objects already counted', True, CubeObjects[-5:], Build(), False),
+                  ('another PointsPerDay', True, NewObjects, Build(PointsPerDay=3), False) ]
+
+        for kk, (Name, Manifest, Objects, CaseBuild, Accept) in enumerate(Cases):
+
+            FilePath = WriteCube(os.path.join(Folder, str(kk)), Manifest)
+            Error, Unchanged = TryAdd(FilePath, Objects, CaseBuild)
+
+            if Accept:
+                InfoDict, HashTable = LoadCube(FilePath, mmap_mode=None)
+                Ok = ( Error is None and InfoDict['ObjectNo'] == len(CubeObjects)+len(Objects)
+                       and np.all(HashTable == len(CubeObjects)+len(Objects))
+                       and sorted( Object for Chunk in ReadManifest(FilePath) for Object in range(*Chunk['Objects']) )
+                           == sorted(np.concatenate((CubeObjects, Objects)).tolist()) )
+            else:
+                Ok = Error is not None and Unchanged
+
+            Failed |= not Ok
+            print('{:<28}{:<10}{}'.format(Name+':', 'ok' if Ok else 'FAILED', Error if Error is not None else 'added'))
+
+    finally:
+        shutil.rmtree(Folder, ignore_errors=True)
+
+    sys.exit('AddToCube check failed.' if Failed else None)
@@ -0,0 +1,149 @@
+import sys
+import time
+import numpy as np
+
+from LightCurves import LoadEvent
+from CubeBuilder import CalculateCube, CalculateCubeAllPairs, GridStepOf, SampleSeed
+
+#Consistency check of the shared-grid kernels (CubeBuilder.CalculateCube and
+#CalculateCubeAllPairs): for each PointsPerDay the cubes of the given objects must be the
+#same, bin by bin, with and without the bright-part trimming of the grids (Bright=False
+#builds the full grids), whatever ObjectChunk the objects are split by, and when they are
+#built as the tasks of ProbabilityCube_Local.py and ProbabilityCube_forDask_Final.py, on
+#blocks of objects (LightCurveStore.Select with their ObjectIDs) and of time pairs, and
+#summed. PointsPerDay above 1 matters: there the margins of the grids are several samples wide.
+#Both kernels must also refuse a PointsPerDay whose samples are not whole grid steps apart
+#(OffGridStep, OffGridPointsPerDay) instead of sampling another density.
+#Usage: python Check_CubeBuilders.py <Event>_LC|<Event>_Interp.pkl
+
+#########################################################
+#Parameter setting
+
+BandPairs = ['ug', 'gr', 'ri', 'iz', 'zi', 'Yz']
+ObjectNo = 500          #the first objects of the event are used
+TimePairStep = 37       #every TimePairStep-th time pair of the grid of the Dask script
+
+PointsPerDays = [1, 3, 12]     #whole numbers of grid steps apart, see CubeBuilder.SampleStride
+ObjectChunks = [256, 1]
+
+TaskObjects = 7         #objects per task
+TaskTimePairs = 5       #time pairs per task
+
+OffGridStep = 120       #1440/(120*5) = 2.4 grid steps per sample
+OffGridPointsPerDay = 5
+
+Seed = 2021
+
+dT1s = np.arange(-480, 481, 15)
+dT2s = np.hstack(( np.arange(-1920, -1439, 30), np.arange(-480, 481, 30), np.arange(1440, 1921, 30) ))
+
+BinMag = np.arange(-5.05, 6.01, 0.1)
+BinColor = np.arange(-9.25, 9.8, 0.5)
+
+#########################################################
+#Functions
+
+#The cubes of every band pair, by CalculateCube, and by CalculateCubeAllPairs under 'All'.
+def BuildCubes(Store, TimePairs, Objects, PointsPerDay, ObjectChunk, Bright):
+
+    GridStep = GridStepOf(TimePairs)
+    Cubes = {}
+
+    for BandPair in BandPairs:
+        Cubes[BandPair] = CalculateCube(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                                        GridStep=GridStep, ObjectChunk=ObjectChunk,
+                                        Seed=SampleSeed(Seed, 'Check', BandPair), Bright=Bright)[1]
+
+    Cubes['All'] = CalculateCubeAllPairs(Store, BandPairs, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                                         GridStep=GridStep, ObjectChunk=ObjectChunk,
+                                         Seed=SampleSeed(Seed, 'Check', 'All'), Bright=Bright)[1]
+    return Cubes
+
+#The same cubes summed over tasks of TaskObjects objects and TaskTimePairs time pairs.
+def BuildTasks(Store, TimePairs, Objects, PointsPerDay):
+
+    GridStep = GridStepOf(TimePairs)
+    Cubes = {}
+
+    for Lo in range(0, len(Objects), TaskObjects):
+
+        Objs = Objects[Lo:Lo+TaskObjects]
+        Part = Store.Select(Objs)
+
+        for TLo in range(0, len(TimePairs), TaskTimePairs):
+
+            Block = slice(TLo, TLo+TaskTimePairs)
+
+            for BandPair in BandPairs:
+                Cubes.setdefault(BandPair, np.zeros([len(TimePairs), len(BinMag)-1, len(BinColor)-1], dtype=np.uint32))
+                Cubes[BandPair][Block] += CalculateCube(Part, BandPair, TimePairs[Block], BinMag, BinColor, np.arange(len(Objs)),
+                                                        PointsPerDay, GridStep=GridStep, ObjectIDs=Objs,
+                                                        Seed=SampleSeed(Seed, 'Check', BandPair))[1]
+
+            Cubes.setdefault('All', np.zeros([len(BandPairs), len(TimePairs), len(BinMag)-1, len(BinColor)-1], dtype=np.uint32))
+            Cubes['All'][:, Block] += CalculateCubeAllPairs(Part, BandPairs, TimePairs[Block], BinMag, BinColor, np.arange(len(Objs)),
+                                                            PointsPerDay, GridStep=GridStep, ObjectIDs=Objs,
+                                                            Seed=SampleSeed(Seed, 'Check', 'All'))[1]
+    return Cubes
+
+#Names of the kernels that accept a PointsPerDay off the grid.
+def OffGridAccepted(Store, TimePairs, Objects):
+
+    Accepted = []
+
+    for Name, Kernel, Bands in [('CalculateCube', CalculateCube, BandPairs[0]), ('CalculateCubeAllPairs', CalculateCubeAllPairs, BandPairs)]:
+        try:
+            Kernel(Store, Bands, TimePairs, BinMag, BinColor, Objects, OffGridPointsPerDay, GridStep=OffGridStep)
+            Accepted.append(Name)
+        except ValueError:
+            pass
+
+    return Accepted
+
+#Names of the cubes of Cubes that differ from those of RefCubes.
+def Differences(Cubes, RefCubes):
+    return [ Name for Name in RefCubes if not np.array_equal(Cubes[Name], RefCubes[Name]) ]
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 2:
+        sys.exit('Usage: python Check_CubeBuilders.py <Event>_LC|<Event>_Interp.pkl')
+
+    Store = LoadEvent(sys.argv[1])
+    Objects = np.arange(min(ObjectNo, Store.ObjectNo))
+
+    TimePairs = np.array([ [ii, jj] for ii in dT1s for jj in dT2s if abs(ii) <= abs(ii-jj) ])[::TimePairStep]
+
+    Accepted = OffGridAccepted(Store, TimePairs[np.all(TimePairs % OffGridStep == 0, axis=1)], Objects)
+    Failed = len(Accepted) > 0
+
+    print('PointsPerDay = {} on a grid of {} min: {}'.format(OffGridPointsPerDay, OffGridStep,
+          'accepted by '+', '.join(Accepted) if Accepted else 'refused'))
+
+    for PointsPerDay in PointsPerDays:
+
+        start = time.time()
+        RefCubes = BuildCubes(Store, TimePairs, Objects, PointsPerDay, ObjectChunks[0], Bright=False)
+
+        for ObjectChunk in ObjectChunks:
+            for Bright in [True, False]:
+
+                if (ObjectChunk, Bright) == (ObjectChunks[0], False):
+                    continue
+
+                Differ = Differences(BuildCubes(Store, TimePairs, Objects, PointsPerDay, ObjectChunk, Bright), RefCubes)
+                Failed |= len(Differ) > 0
+
+                print('PointsPerDay = {:<6}ObjectChunk = {:<6}Bright = {:<7}{}'.format(
+                      PointsPerDay, ObjectChunk, str(Bright), 'differ: '+', '.join(Differ) if Differ else 'same'))
+
+        Differ = Differences(BuildTasks(Store, TimePairs, Objects, PointsPerDay), RefCubes)
+        Failed |= len(Differ) > 0
+
+        print('PointsPerDay = {:<6}{:<33}{}'.format(PointsPerDay, 'tasks of {} objects, {} time pairs'.format(TaskObjects, TaskTimePairs),
+                                                   'differ: '+', '.join(Differ) if Differ else 'same'))
+
+        print('{} s spent.'.format(int(time.time()-start)))
+
+    sys.exit('Cubes differ.' if Failed else None)
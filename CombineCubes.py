@@ -0,0 +1,223 @@
+import os
+import sys
+import time
+import pickle
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+
+from CubeBuilder import LoadCube, ReadCubeHeader, CreateCube, UpdateCubeInfo, CubeFilePath, CubeName, AddCounts, CountedTwice, BuildKeys
+
+#Merge the partial cubes of each event (ProbCube_<time>__<Event>.pkl/.cube, built on
+#different objects) into one cube per event, as the loop of CombineCubes.ipynb did.
+#The partial cubes are checked to share their axes and dtype and not to count the same
+#objects twice, summed band pair by band pair into a memory-mapped .cube, and the events
+#are merged in parallel. A partial cube without a manifest (a .pkl, a cube converted from
+#one) cannot be checked, so it is only merged with others with AllowNoManifest
+#(--allow-no-manifest), and the merged cube then has no manifest either.
+#Usage: python CombineCubes.py SourceFolder TargetFolder [WorkerNo] [--allow-no-manifest]
+
+#########################################################
+#Parameter setting
+
+#The InfoDict entries which must be the same in every partial cube of an event.
+AxisKeys = BuildKeys
+
+#Merge partial cubes without a manifest with the others, trusting that they hold other objects.
+AllowNoManifest = False
+
+#########################################################
+#Functions
+
+#{EventName: [FilePath, ...]} of the cube files in Folder, matched on the exact event name.
+def GroupFiles(Folder):
+
+    Groups = {}
+
+    for FileName in sorted(os.listdir(Folder)):
+
+        Match = CubeName.match(FileName)
+        if Match:
+            Groups.setdefault(Match.group('EventName'), []).append(os.path.join(Folder, FileName))
+
+    return Groups
+
+#InfoDict, shape, dtype and manifest of a cube file without reading the cube, the manifest
+#being None if the file has none.
+def ReadInfo(FilePath):
+
+    if FilePath.endswith('.pkl'):
+
+        with open(FilePath, 'rb') as f:
+            InfoDict = pickle.load(f)
+
+        Shape = [ len(InfoDict['BandPairs']), len(InfoDict['TimePairs']),
+                  len(InfoDict['BinMag'])-1, len(InfoDict['BinColor'])-1 ]
+
+        return InfoDict, Shape, None, None
+
+    Header = ReadCubeHeader(FilePath)
+    InfoDict = Header['InfoDict']
+    for Key in Header['Arrays']:
+        InfoDict[Key] = np.array(InfoDict[Key])
+
+    return InfoDict, Header['shape'], np.dtype(Header['dtype']), Header.get('Manifest') or None
+
+#Check that the partial cubes share their axes and dtype (that of a .pkl is only known once
+#loaded, see MergeEvent), and that the objects of their manifests do not overlap. Partial
+#cubes without a manifest are refused, unless AllowNoManifest, when there are several.
+def CheckAxes(Infos, FilePaths, AllowNoManifest=AllowNoManifest):
+
+    Unchecked = [ FilePath for Info, FilePath in zip(Infos, FilePaths) if Info[3] is None ]
+
+    if Unchecked and len(FilePaths) > 1:
+        if not AllowNoManifest:
+            raise ValueError('No manifest in {}, so the objects counted there cannot be checked against those of '
+                             'the other cubes; set AllowNoManifest (--allow-no-manifest) to merge them anyway.'.format(', '.join(Unchecked)))
+        print('Warning: no manifest in {}, the objects counted there are not checked against those of the other cubes.'.format(', '.join(Unchecked)))
+
+    InfoDict0, Shape0, dtype0 = Infos[0][:3]
+    Manifest = list(Infos[0][3] or [])
+
+    for (InfoDict, Shape, dtype, Chunks), FilePath in zip(Infos[1:], FilePaths[1:]):
+
+        if list(Shape) != list(Shape0):
+            raise ValueError('{} has shape {}, {} has {}.'.format(FilePath, Shape, FilePaths[0], Shape0))
+
+        if dtype0 is None:
+            dtype0 = dtype
+        elif dtype is not None and dtype != dtype0:
+            raise ValueError('{} holds {}, the other cubes {}.'.format(FilePath, dtype, dtype0))
+
+        Chunks = Chunks or []
+        Twice = CountedTwice(Manifest, Chunks)
+        if Twice:
+            raise ValueError('Objects {} of {} in {} are also counted in another cube.'.format(Twice[0]['Objects'], Twice[0]['Event'], FilePath))
+        Manifest.extend(Chunks)
+
+        for Key in AxisKeys:
+            if (Key in InfoDict) != (Key in InfoDict0) or ( Key in InfoDict and not
+                    np.array_equal(np.asarray(InfoDict[Key]), np.asarray(InfoDict0[Key])) ):
+                raise ValueError('{} of {} differs from that of {}.'.format(Key, FilePath, FilePaths[0]))
+
+#InfoDict of the merged cube: ObjectNo, outliers and overflows are summed, the ranges widened.
+def MergeInfo(Infos):
+
+    InfoDict = dict(Infos[0][0])
+    Others = [Info[0] for Info in Infos[1:]]
+
+    InfoDict['ObjectNo'] = sum( Info['ObjectNo'] for Info in [InfoDict]+Others )
+
+    for Key in ['dMagRange', 'ColorRange']:
+        if Key in InfoDict:
+            InfoDict[Key] = [ min( Info[Key][0] for Info in [InfoDict]+Others ),
+                              max( Info[Key][1] for Info in [InfoDict]+Others ) ]
+
+    if 'StartObjNo' in InfoDict:
+        InfoDict['StartObjNo'] = min( Info.get('StartObjNo', InfoDict['StartObjNo']) for Info in Others+[InfoDict] )
+
+    Outliers = sum( Info.get('Outliers', 0) for Info in [InfoDict]+Others )
+    if Outliers > 0:
+        InfoDict['Outliers'] = Outliers
+
+    InfoDict.pop('OutliersRatio', None)
+
+    Overflow = sum( Info.get('Overflow', 0) for Info in [InfoDict]+Others )
+    if Overflow > 0:
+        InfoDict['Overflow'] = Overflow
+
+    return InfoDict
+
+#Sum the partial cubes of one event into TargetFolder/ProbCube_<time>__<Event>.cube.
+#Only one band pair slice (and one whole .pkl cube, pickles not being mappable) is in
+#memory at a time. Sums beyond the range of the integer dtype are clipped to its maximum
+#and counted in InfoDict['Overflow'] with the overflows of the partial cubes, see
+#CubeBuilder.AddCounts. The manifests of the partial cubes are joined, the merged cube has
+#none if one of them has none.
+def MergeEvent(EventName, FilePaths, TargetFolder, AllowNoManifest=AllowNoManifest):
+
+    start = time.time()
+
+    Infos = [ ReadInfo(FilePath) for FilePath in FilePaths ]
+    CheckAxes(Infos, FilePaths, AllowNoManifest)
+
+    InfoDict = MergeInfo(Infos)
+    Shape = Infos[0][1]
+    dtype = next( (Info[2] for Info in Infos if Info[2] is not None), np.dtype(np.uint32) )
+    Manifest = None
+    if all( Info[3] is not None for Info in Infos ):
+        Manifest = [ Chunk for Info in Infos for Chunk in Info[3] ]
+
+    FilePath = CubeFilePath(TargetFolder, EventName)
+    TmpPath = FilePath + '.part'
+
+    Provenance = {'Created': time.strftime('%Y-%m-%d %H:%M:%S'), 'Program': os.path.basename(__file__),
+                  'MergedFrom': [os.path.basename(Path) for Path in FilePaths]}
+    Cube = CreateCube(TmpPath, InfoDict, Shape, dtype, Provenance, Manifest=Manifest)
+
+    OverflowNo = 0
+
+    for PartPath in FilePaths:
+
+        _, HashTable = LoadCube(PartPath)
+        if list(HashTable.shape) != list(Shape):
+            raise ValueError('The cube in {} has shape {}, not {}.'.format(PartPath, HashTable.shape, Shape))
+        if np.issubdtype(HashTable.dtype, np.integer) != np.issubdtype(dtype, np.integer):
+            raise ValueError('The cube in {} holds {}, the other cubes {}.'.format(PartPath, HashTable.dtype, dtype))
+
+        OverflowNo += AddCounts(Cube, HashTable)
+        del HashTable
+
+    Max = max( Cube[kk].max() for kk in range(Shape[0]) )
+    Cube.flush()
+    del Cube
+
+    if 'Outliers' in InfoDict and Max > 0:
+        InfoDict['OutliersRatio'] = InfoDict['Outliers'] / Max
+    if OverflowNo > 0:
+        InfoDict['Overflow'] = InfoDict.get('Overflow', 0) + OverflowNo
+
+    UpdateCubeInfo(TmpPath, InfoDict)
+    os.rename(TmpPath, FilePath)
+
+    return FilePath, len(FilePaths), InfoDict.get('Overflow', 0), time.time()-start
+
+def CombineCubes(SourceFolder, TargetFolder, WorkerNo=None, AllowNoManifest=AllowNoManifest):
+
+    Groups = GroupFiles(SourceFolder)
+
+    if WorkerNo is None:
+        WorkerNo = min(len(Groups), len(os.sched_getaffinity(0))) or 1
+
+    os.makedirs(TargetFolder, exist_ok=True)
+
+    with ProcessPoolExecutor(max_workers=WorkerNo) as Pool:
+
+        Futures = { Pool.submit(MergeEvent, EventName, FilePaths, TargetFolder, AllowNoManifest): EventName
+                    for EventName, FilePaths in Groups.items() }
+
+        for Future in as_completed(Futures):
+
+            FilePath, PartNo, OverflowNo, Spent = Future.result()
+            print('{:<25}{:>3} cubes -> {}\t time spent: {:6.3f} s'.format(Futures[Future]+':', PartNo, os.path.basename(FilePath), Spent))
+
+            if OverflowNo > 0:
+                print('Data overflow in {} bins of {}, please check!'.format(OverflowNo, Futures[Future]))
+
+
+if __name__ == '__main__':
+
+    Args = [ Arg for Arg in sys.argv[1:] if Arg != '--allow-no-manifest' ]
+    AllowNoManifest = len(Args) < len(sys.argv) - 1
+
+    if len(Args) < 2:
+        sys.exit('Usage: python CombineCubes.py SourceFolder TargetFolder [WorkerNo] [--allow-no-manifest]')
+
+    WorkerNo = int(Args[2]) if len(Args) > 2 else None
+
+    print('###############\nStart!\n###############')
+    time1 = time.time()
+
+    CombineCubes(Args[0], Args[1], WorkerNo, AllowNoManifest)
+
+    print( '{} min spent.'.format( (time.time() - time1)/60 ))
+    print('###############\nFinish!\n###############')
@@ -0,0 +1,1502 @@
+"""
+Kernels filling the [TimePair, BinMag, BinColor] HashTable of one band pair.
+
+They return the same ([ObjectNo, BandPair, outliersNo, dMagMin, dMagMax,
+ColorMin, ColorMax], HashTable) as CalculateMap in
+ProbabilityCube_forDask_Final.py, so SaveCube works with either.
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import zlib
+import pickle
+import shutil
+import numpy as np
+
+from LightCurves import Thrs, StreamTimePair, SamplingModes, BelowThr
+
+#Numba is optional: without it CalculateCubeSampling runs on NumPy.
+try:
+    import numba
+except ImportError:
+    numba = None
+
+
+#Bin index of every value as np.histogram2d counts it, the last edge being
+#included in the last bin. Values out of the bins (or NaN) get -1.
+#For uniform edges the index is computed arithmetically and then corrected by
+#one bin where rounding put a value on the wrong side of an edge.
+def BinIndex(Values, Edges, Uniform=False):
+
+    BinNo = len(Edges) - 1
+
+    if Uniform:
+        with np.errstate(invalid='ignore'):
+            Ind = np.floor((Values - Edges[0]) * (BinNo / (Edges[-1] - Edges[0])))
+        Ind = np.clip(np.nan_to_num(Ind), 0, BinNo - 1).astype(np.int64)
+        Ind -= Values < Edges[Ind]
+        Ind += (Values >= Edges[np.minimum(Ind + 1, BinNo)]) & (Ind < BinNo - 1)
+    else:
+        Ind = np.searchsorted(Edges, Values, side='right') - 1
+        Ind[Values == Edges[-1]] = BinNo - 1
+
+    Ind[~((Values >= Edges[0]) & (Values <= Edges[-1]))] = -1
+
+    return Ind
+
+
+#In-place accumulator of a [TimePair, BinMag, BinColor] HashTable.
+#
+#The BinMag and BinColor grids of the cube are np.arange grids, so the bins
+#are found arithmetically instead of by np.histogram2d, and the counts are
+#added into the preallocated integer HashTable with np.bincount on flat
+#indices. Samples out of the bins are counted in outliersNo, and the ranges
+#of dMag and Color are kept as running scalars.
+class CubeAccumulator:
+
+    def __init__(self, BinMag, BinColor, TimePairNo, dtype=np.uint32, HashTable=None):
+
+        self.BinMag = np.asarray(BinMag)
+        self.BinColor = np.asarray(BinColor)
+
+        self.MagNo = len(BinMag) - 1
+        self.ColorNo = len(BinColor) - 1
+
+        self.UniformMag = IsUniform(self.BinMag)
+        self.UniformColor = IsUniform(self.BinColor)
+
+        if HashTable is None:
+            HashTable = np.zeros([TimePairNo, self.MagNo, self.ColorNo], dtype=dtype)
+        self.HashTable = HashTable
+        self._Flat = HashTable.reshape(-1)
+
+        self.outliersNo = 0
+        self.dMagMin, self.dMagMax = np.inf, -np.inf
+        self.ColorMin, self.ColorMax = np.inf, -np.inf
+
+    #Widen the running ranges of dMag and Color.
+    def Extend(self, dMag, Color):
+
+        if len(dMag) == 0:
+            return
+
+        self.dMagMin = min(self.dMagMin, np.nanmin(dMag))
+        self.dMagMax = max(self.dMagMax, np.nanmax(dMag))
+        self.ColorMin = min(self.ColorMin, np.nanmin(Color))
+        self.ColorMax = max(self.ColorMax, np.nanmax(Color))
+
+    def MagIndex(self, dMag):
+        return BinIndex(dMag, self.BinMag, self.UniformMag)
+
+    def ColorIndex(self, Color):
+        return BinIndex(Color, self.BinColor, self.UniformColor)
+
+    #Keep the ranges and the outliers of the valid samples of a time pair and
+    #return the flat HashTable indices of those in the bins.
+    def FlatIndex(self, TimePairInd, dMag, Color, IndMag=None, IndColor=None, Mask=None):
+
+        if Mask is not None:
+            dMag, Color = dMag[Mask], Color[Mask]
+            if IndMag is not None:
+                IndMag, IndColor = IndMag[Mask], IndColor[Mask]
+
+        if len(dMag) == 0:
+            return np.zeros(0, dtype=np.int64)
+
+        self.Extend(dMag, Color)
+
+        if IndMag is None:
+            IndMag = self.MagIndex(dMag)
+            IndColor = self.ColorIndex(Color)
+
+        InBins = (IndMag >= 0) & (IndColor >= 0)
+        self.outliersNo += len(dMag) - int(InBins.sum())
+
+        return (TimePairInd*self.MagNo + IndMag[InBins])*self.ColorNo + IndColor[InBins]
+
+    #Count flat indices (with Weights, one per index, if given) into the HashTable in
+    #place, touching only their range.
+    def AddFlat(self, FlatInd, Weights=None):
+
+        if len(FlatInd) == 0:
+            return
+
+        Lo = FlatInd.min()
+        Counts = np.bincount(FlatInd - Lo, weights=Weights)
+        self._Flat[Lo:Lo+len(Counts)] += Counts.astype(self._Flat.dtype)
+
+    def Add(self, TimePairInd, dMag, Color):
+        self.AddFlat(self.FlatIndex(TimePairInd, dMag, Color))
+
+    #Add Weights at the bins of the points (dMag, Color) of a time pair, which are neither
+    #bin edges nor range extremes (see CalculateCubeExact): the weight out of the bins is
+    #added to outliersNo, and the ranges have to be kept with Extend.
+    def AddWeights(self, TimePairInd, dMag, Color, Weights):
+
+        IndMag = self.MagIndex(dMag)
+        IndColor = self.ColorIndex(Color)
+
+        InBins = (IndMag >= 0) & (IndColor >= 0)
+        self.outliersNo += Weights[~InBins].sum()
+
+        self.AddFlat((TimePairInd*self.MagNo + IndMag[InBins])*self.ColorNo + IndColor[InBins], Weights[InBins])
+
+    def Info(self):
+        return [self.outliersNo, self.dMagMin, self.dMagMax, self.ColorMin, self.ColorMax]
+
+
+def IsUniform(Edges):
+    Widths = np.diff(Edges)
+    return len(Widths) > 0 and np.allclose(Widths, Widths[0], rtol=1e-6, atol=0)
+
+
+#Step of the shared time grid in minutes: the largest step every dT is a multiple of.
+def GridStepOf(TimePairs):
+
+    dTs = np.asarray(TimePairs).ravel()
+    if not np.all(dTs == np.round(dTs)):
+        raise ValueError('The shared grid needs dT1 and dT2 in whole minutes.')
+
+    GridStep = np.gcd.reduce(np.abs(dTs).astype(np.int64))
+    return int(GridStep) if GridStep > 0 else 1440
+
+#Grid points per sample of the shared grid, m with m*GridStep = 1/PointsPerDay days. The
+#samples are whole grid points, so any other PointsPerDay would silently be another density.
+def SampleStride(GridStep, PointsPerDay):
+
+    Ratio = 1440 / (GridStep*PointsPerDay)
+    m = int(round(Ratio))
+
+    if m < 1 or not np.isclose(Ratio, m, rtol=1e-9, atol=0):
+        raise ValueError('PointsPerDay = {} is not reachable on a grid of {} min: 1440/(GridStep*PointsPerDay) = {:g} '
+                         'is not a whole number.'.format(PointsPerDay, GridStep, Ratio))
+    return m
+
+
+#Time grids of step GridStep (minutes) over [Start, End] of the objects of a chunk, with
+#Margin points on each side and the phase Phases (in steps) of every object, laid out one
+#after another as m-point groups: the index in the chunk of the object of every point and
+#the times. With First and Last (the bright range of the objects, see
+#LightCurveStore.BrightRange) the grids only cover [First, Last], skipping whole groups
+#of m points, so the points kept are at the same times as on the full grids. The Margin
+#points before the first point kept are then still points of the object, not those of the
+#previous one, as the shifted views of CalculateCube read them.
+def _ObjectGrids(Start, End, Phases, m, GridStep, Margin, First=None, Last=None):
+
+    Skip = np.zeros(len(Start), dtype=np.int64)
+    if First is not None:
+        Skip = (np.floor(np.maximum((First - Start)*1440/GridStep - Phases, 0) / m) * m).astype(np.int64)
+        End = np.minimum(End, Last)
+
+    Lengths = (np.maximum(np.ceil(((End - Start)*1440/GridStep - Phases - Skip + 1) / m), 1).astype(np.int64) * m + 2*Margin)
+
+    SegStart = np.zeros(len(Start)+1, dtype=np.int64)
+    np.cumsum(Lengths, out=SegStart[1:])
+
+    Owner = np.repeat(np.arange(len(Start)), Lengths)
+    Steps = np.arange(SegStart[-1]) - SegStart[Owner] - Margin + Skip[Owner] + Phases[Owner]
+
+    return Owner, Start[Owner] + Steps*GridStep/1440
+
+#Band evaluated on the grid, padded with Margin NaN on each side, the points out of the
+#range of the band or not brighter than Thr being NaN.
+def _BandGrid(Store, Band, ObjInd, Times, Thr, Margin):
+
+    Grid = np.full(len(Times) + 2*Margin, np.nan)
+    Grid[Margin:-Margin] = Store.Interpolate(Band, ObjInd, Times)
+    Grid[Grid >= Thr] = np.nan
+
+    return Grid
+
+
+#Cube of one band pair from a single pass over a shared time grid.
+#
+#Each object gets a grid of step GridStep (minutes) over its Band1 range, with
+#margins wide enough for the largest shift and a random phase. Band1 and Band2
+#are evaluated once on the grid, every m-th grid point being a sample
+#(m*GridStep = 1/PointsPerDay days, see SampleStride). A time pair is then just a pair of shifts
+#(dT1/GridStep, dT2/GridStep) of strided views of the grid, and dMag depends
+#only on dT2 and Color only on dT1, so their bins are computed once per dT.
+#Out-of-range points are NaN and fail the Thrs mask like faint ones. Objects with no
+#overlap of the bright parts of the bands (see LightCurveStore.BrightRange) for any of
+#the time pairs are dropped before the grid is built, and the grid of an object only
+#covers the bright part of Band1, which leaves the cube unchanged; Bright=False skips
+#both and builds the full grids.
+#The random phases are drawn from np.random.default_rng(Seed) for all the objects of
+#the event at once, ObjectIDs (Objects by default) being the indices of Objects in the
+#event, so the phase of an object, and the cube, do not depend on how the objects and
+#the time pairs are split into tasks (see SampleSeed).
+def CalculateCube(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                  Thrs=Thrs, GridStep=None, ObjectChunk=256, TimePairChunk=64, Seed=None, ObjectIDs=None, Bright=True):
+
+    Band1 = BandPair[0]
+    Band2 = BandPair[1]
+
+    TimePairs = np.asarray(TimePairs)
+    Objects = np.asarray(Objects)
+
+    if GridStep is None:
+        GridStep = GridStepOf(TimePairs)
+
+    m = SampleStride(GridStep, PointsPerDay)
+
+    Shifts1 = (TimePairs[:, 0] // GridStep).astype(np.int64)
+    Shifts2 = (TimePairs[:, 1] // GridStep).astype(np.int64)
+
+    #Margin around each object, a multiple of m so samples stay aligned.
+    Margin = int(np.ceil(np.abs(TimePairs).max() / GridStep / m)) * m
+
+    Cube = CubeAccumulator(BinMag, BinColor, len(TimePairs))
+
+    ObjectIDs = Objects if ObjectIDs is None else np.asarray(ObjectIDs)
+    AllPhases = np.random.default_rng(Seed).random(ObjectIDs.max(initial=-1)+1) * m
+
+    Valid = Store.OverlapMask(Band1, Band2, TimePairs, Objects, Thrs=Thrs if Bright else None)
+    Index = np.flatnonzero(Valid)
+
+    #Without Bright the grids are not trimmed: max(First - Start, 0) is 0, End is min(End, inf).
+    if Bright:
+        BrightStart, BrightEnd = Store.BrightRange(Band1, Thrs[Band1])
+    else:
+        BrightStart, BrightEnd = np.full(Store.ObjectNo, -np.inf), np.full(Store.ObjectNo, np.inf)
+
+    for ChunkIndex in np.array_split(Index, max(1, int(np.ceil(len(Index) / ObjectChunk)))):
+
+        Chunk = Objects[ChunkIndex]
+
+        if len(Chunk) == 0:
+            continue
+
+        Owner, Times = _ObjectGrids(Store.Start[Band1][Chunk], Store.End[Band1][Chunk],
+                                    AllPhases[ObjectIDs[ChunkIndex]], m, GridStep, Margin,
+                                    BrightStart[Chunk], BrightEnd[Chunk])
+
+        #Evaluate each band once, padded so every shifted view stays in bounds.
+        Grid1 = _BandGrid(Store, Band1, Chunk[Owner], Times, Thrs[Band1], Margin)
+        Grid2 = _BandGrid(Store, Band2, Chunk[Owner], Times, Thrs[Band2], Margin)
+
+        SampleNo = len(Times) // m
+
+        def View(Grid, Shift):
+            return Grid[Margin+Shift : Margin+Shift+SampleNo*m : m]
+
+        Mag1 = View(Grid1, 0)
+
+        #Bins of dMag for every dT2 and of Color for every dT1.
+        MagInd = {}
+        for Shift2 in np.unique(Shifts2):
+            dMag = (Mag1 - View(Grid1, Shift2)) * np.sign(Shift2)
+            MagInd[Shift2] = (Cube.MagIndex(dMag), dMag, ~np.isnan(dMag))
+
+        ColorInd = {}
+        for Shift1 in np.unique(Shifts1):
+            Color = Mag1 - View(Grid2, Shift1)
+            ColorInd[Shift1] = (Cube.ColorIndex(Color), Color, ~np.isnan(Color))
+
+        #Accumulate blocks of time pairs with one bincount on flat indices.
+        for Block in range(0, len(TimePairs), TimePairChunk):
+
+            FlatInds = []
+
+            for kk in range(Block, min(Block+TimePairChunk, len(TimePairs))):
+
+                IndMag, dMag, Valid2 = MagInd[Shifts2[kk]]
+                IndColor, Color, Valid1 = ColorInd[Shifts1[kk]]
+
+                FlatInds.append(Cube.FlatIndex(kk, dMag, Color, IndMag, IndColor, Mask=Valid1 & Valid2))
+
+            Cube.AddFlat(np.concatenate(FlatInds))
+
+    return [len(Objects), BandPair] + Cube.Info(), Cube.HashTable
+
+
+#Cube of all the band pairs BandPairs at once, [BandPair, TimePair, BinMag, BinColor],
+#from the shared time grid of CalculateCube.
+#
+#The grid of each object spans the union of the ranges of its bands, trimmed to the bright
+#parts of the Band1s as in CalculateCube, so every band is interpolated once per object
+#chunk and reused by all the band pairs it is in, and the bins of dMag are computed once
+#per band and dT2. The samples of a band pair are the
+#grid points in the range of its Band1, so the cube of each band pair is a cube of
+#CalculateCube, with the phase shared by all band pairs instead of one per band pair:
+#the phases are drawn from np.random.default_rng(Seed), Seed being SampleSeed(Seed,
+#EventName, 'All'). Bright as for CalculateCube. Returns the list of the infos of the band pairs and the cube.
+def CalculateCubeAllPairs(Store, BandPairs, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                          Thrs=Thrs, GridStep=None, ObjectChunk=256, TimePairChunk=64, Seed=None, ObjectIDs=None, Bright=True):
+
+    TimePairs = np.asarray(TimePairs)
+    Objects = np.asarray(Objects)
+
+    if GridStep is None:
+        GridStep = GridStepOf(TimePairs)
+
+    m = SampleStride(GridStep, PointsPerDay)
+
+    Shifts1 = (TimePairs[:, 0] // GridStep).astype(np.int64)
+    Shifts2 = (TimePairs[:, 1] // GridStep).astype(np.int64)
+
+    Margin = int(np.ceil(np.abs(TimePairs).max() / GridStep / m)) * m
+
+    Bands = sorted(set(''.join(BandPairs)), key=''.join(BandPairs).index)
+
+    HashTable = np.zeros([len(BandPairs), len(TimePairs), len(BinMag)-1, len(BinColor)-1], dtype=np.uint32)
+    Cubes = [ CubeAccumulator(BinMag, BinColor, len(TimePairs), HashTable=HashTable[kk]) for kk in range(len(BandPairs)) ]
+
+    ObjectIDs = Objects if ObjectIDs is None else np.asarray(ObjectIDs)
+    AllPhases = np.random.default_rng(Seed).random(ObjectIDs.max(initial=-1)+1) * m
+
+    Valid = np.zeros(len(Objects), dtype=bool)
+    for BandPair in BandPairs:
+        Valid |= Store.OverlapMask(BandPair[0], BandPair[1], TimePairs, Objects, Thrs=Thrs if Bright else None)
+    Index = np.flatnonzero(Valid)
+
+    Band1s = set(BandPair[0] for BandPair in BandPairs)
+
+    if Bright:
+        BrightStart = np.min([ Store.BrightRange(Band, Thrs[Band])[0] for Band in Band1s ], axis=0)
+        BrightEnd = np.max([ Store.BrightRange(Band, Thrs[Band])[1] for Band in Band1s ], axis=0)
+    else:
+        BrightStart, BrightEnd = np.full(Store.ObjectNo, -np.inf), np.full(Store.ObjectNo, np.inf)
+
+    for ChunkIndex in np.array_split(Index, max(1, int(np.ceil(len(Index) / ObjectChunk)))):
+
+        Chunk = Objects[ChunkIndex]
+
+        if len(Chunk) == 0:
+            continue
+
+        #Union of the ranges of the valid bands of every object.
+        Start = np.min([ np.where(Store.Valid[Band][Chunk], Store.Start[Band][Chunk], np.inf) for Band in Bands ], axis=0)
+        End = np.max([ np.where(Store.Valid[Band][Chunk], Store.End[Band][Chunk], -np.inf) for Band in Bands ], axis=0)
+
+        Owner, Times = _ObjectGrids(Start, End, AllPhases[ObjectIDs[ChunkIndex]], m, GridStep, Margin,
+                                    BrightStart[Chunk], BrightEnd[Chunk])
+
+        Grids = { Band: _BandGrid(Store, Band, Chunk[Owner], Times, Thrs[Band], Margin) for Band in Bands }
+
+        SampleNo = len(Times) // m
+
+        def View(Grid, Shift):
+            return Grid[Margin+Shift : Margin+Shift+SampleNo*m : m]
+
+        Mag1s = { Band: View(Grids[Band], 0) for Band in Bands }
+
+        #Bins of dMag for every Band1 and dT2.
+        MagInd = {}
+        for Band in Band1s:
+            for Shift2 in np.unique(Shifts2):
+                dMag = (Mag1s[Band] - View(Grids[Band], Shift2)) * np.sign(Shift2)
+                MagInd[Band, Shift2] = (Cubes[0].MagIndex(dMag), dMag, ~np.isnan(dMag))
+
+        for BandPair, Cube in zip(BandPairs, Cubes):
+
+            Band1 = BandPair[0]
+            Band2 = BandPair[1]
+
+            ColorInd = {}
+            for Shift1 in np.unique(Shifts1):
+                Color = Mag1s[Band1] - View(Grids[Band2], Shift1)
+                ColorInd[Shift1] = (Cube.ColorIndex(Color), Color, ~np.isnan(Color))
+
+            for Block in range(0, len(TimePairs), TimePairChunk):
+
+                FlatInds = []
+
+                for kk in range(Block, min(Block+TimePairChunk, len(TimePairs))):
+
+                    IndMag, dMag, Valid2 = MagInd[Band1, Shifts2[kk]]
+                    IndColor, Color, Valid1 = ColorInd[Shifts1[kk]]
+
+                    FlatInds.append(Cube.FlatIndex(kk, dMag, Color, IndMag, IndColor, Mask=Valid1 & Valid2))
+
+                Cube.AddFlat(np.concatenate(FlatInds))
+
+    return [ [len(Objects), BandPair] + Cube.Info() for BandPair, Cube in zip(BandPairs, Cubes) ], HashTable
+
+
+#Knots of Band for the objects Chunk, laid out one object after another, and the index
+#in Chunk of the object of each knot.
+def _ChunkKnots(Store, Band, Chunk):
+
+    Offsets = Store.Offsets[Band]
+    Lengths = Offsets[Chunk+1] - Offsets[Chunk]
+
+    Owner = np.repeat(np.arange(len(Chunk)), Lengths)
+    Ind = np.repeat(Offsets[Chunk] - (np.cumsum(Lengths) - Lengths), Lengths) + np.arange(Lengths.sum())
+
+    return np.asarray(Store.MJD[Band][Ind], dtype=np.float64), Owner
+
+#The pieces, and the fractions u in (U0, U1) on them, where a value going linearly from
+#V0 at U0 to V1 at U1 crosses one of Edges.
+def _EdgeCrossings(V0, V1, U0, U1, Edges):
+
+    Lo = np.searchsorted(Edges, np.minimum(V0, V1), side='right')
+    Hi = np.searchsorted(Edges, np.maximum(V0, V1), side='left')
+    Nos = np.maximum(Hi - Lo, 0)
+
+    Piece = np.repeat(np.arange(len(V0)), Nos)
+    EdgeInd = np.arange(Nos.sum()) - np.repeat(np.cumsum(Nos) - Nos, Nos) + Lo[Piece]
+
+    u = U0[Piece] + (Edges[EdgeInd] - V0[Piece]) / (V1[Piece] - V0[Piece]) * (U1[Piece] - U0[Piece])
+
+    return Piece, u
+
+
+#Cube of one band pair from the exact time-weighted distribution of (dMag, Color), no
+#samples drawn.
+#
+#The light curves are linear between their knots, so for a time pair the window of
+#Overlap, narrowed to the bright parts of the bands (see LightCurveStore.BrightRange),
+#is cut at the knots of Mag1(t), Mag2(t+dT1) and Mag12(t+dT2) into pieces on
+#which dMag and Color are linear in t. On each piece the part below the Thrs of the
+#three magnitudes is an interval, and the segment it traces in the (dMag, Color) plane
+#is cut at the edges of BinMag and BinColor, every part adding its duration to its bin.
+#The weights are in samples (days*PointsPerDay), the counts the sampling kernels give
+#on average, so the cube has a float dtype and is comparable to theirs once normalised.
+#The cost grows with the number of knots and bin crossings, not with PointsPerDay.
+def CalculateCubeExact(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay,
+                       Thrs=Thrs, ObjectChunk=256, dtype=np.float64):
+
+    Band1 = BandPair[0]
+    Band2 = BandPair[1]
+
+    TimePairs = np.asarray(TimePairs)
+    Objects = np.asarray(Objects)
+
+    BinMag = np.asarray(BinMag, dtype=np.float64)
+    BinColor = np.asarray(BinColor, dtype=np.float64)
+
+    Cube = CubeAccumulator(BinMag, BinColor, len(TimePairs), dtype=dtype)
+
+    Valid = Store.OverlapMask(Band1, Band2, TimePairs, Objects, Thrs=Thrs)
+    Index = np.flatnonzero(Valid)
+
+    for ChunkIndex in np.array_split(Index, max(1, int(np.ceil(len(Index) / ObjectChunk)))):
+
+        Chunk = Objects[ChunkIndex]
+
+        if len(Chunk) == 0:
+            continue
+
+        Knots1, Owner1 = _ChunkKnots(Store, Band1, Chunk)
+        Knots2, Owner2 = _ChunkKnots(Store, Band2, Chunk)
+
+        for kk, (dT1, dT2) in enumerate(TimePairs):
+
+            Start, End = Store.Overlap(Band1, Band2, dT1, dT2, Chunk, Thrs=Thrs)
+
+            #Breakpoints of the three shifted curves in the window of each object, sorted.
+            Times = np.concatenate([Knots1, Knots2 - dT1/1440, Knots1 - dT2/1440, Start, End])
+            Owner = np.concatenate([Owner1, Owner2, Owner1, np.arange(len(Chunk)), np.arange(len(Chunk))])
+
+            Inside = (Times >= Start[Owner]) & (Times <= End[Owner]) & (End > Start)[Owner]
+            Times, Owner = Times[Inside], Owner[Inside]
+
+            Order = np.lexsort((Times, Owner))
+            Times, Owner = Times[Order], Owner[Order]
+
+            #Magnitudes at the breakpoints, the shifted times clipped to the ranges of the
+            #bands against rounding at the ends of the window.
+            ObjInd = Chunk[Owner]
+
+            def Evaluate(Band, XX):
+                return Store.Interpolate(Band, ObjInd, np.clip(XX, Store.Start[Band][ObjInd], Store.End[Band][ObjInd]))
+
+            Mag1 = Evaluate(Band1, Times)
+            Mag2 = Evaluate(Band2, Times + dT1/1440)
+            Mag12 = Evaluate(Band1, Times + dT2/1440)
+
+            dMag = (Mag1 - Mag12) * np.sign(dT2)
+            Color = Mag1 - Mag2
+
+            Piece = np.flatnonzero( (Owner[1:] == Owner[:-1]) & (Times[1:] > Times[:-1]) )
+            A, B = Piece, Piece + 1
+
+            #Part of each piece where all three magnitudes are below their thresholds.
+            Lo1, Hi1 = BelowThr(Mag1[A], Mag1[B], Thrs[Band1])
+            Lo2, Hi2 = BelowThr(Mag2[A], Mag2[B], Thrs[Band2])
+            Lo12, Hi12 = BelowThr(Mag12[A], Mag12[B], Thrs[Band1])
+
+            U0 = np.maximum(np.maximum(Lo1, Lo2), Lo12)
+            U1 = np.minimum(np.minimum(Hi1, Hi2), Hi12)
+
+            Bright = U1 > U0
+            if not Bright.any():
+                continue
+
+            A, B, U0, U1 = A[Bright], B[Bright], U0[Bright], U1[Bright]
+
+            dMagSlope = dMag[B] - dMag[A]
+            ColorSlope = Color[B] - Color[A]
+            Duration = Times[B] - Times[A]
+
+            dMag0, dMag1 = dMag[A] + dMagSlope*U0, dMag[A] + dMagSlope*U1
+            Color0, Color1 = Color[A] + ColorSlope*U0, Color[A] + ColorSlope*U1
+
+            Cube.Extend(np.concatenate([dMag0, dMag1]), np.concatenate([Color0, Color1]))
+
+            #Cut the pieces at the bin edges, each part lying in one bin.
+            PieceMag, uMag = _EdgeCrossings(dMag0, dMag1, U0, U1, BinMag)
+            PieceColor, uColor = _EdgeCrossings(Color0, Color1, U0, U1, BinColor)
+
+            Parts = np.concatenate([np.arange(len(A)), np.arange(len(A)), PieceMag, PieceColor])
+            u = np.concatenate([U0, U1, uMag, uColor])
+
+            Order = np.lexsort((u, Parts))
+            Parts, u = Parts[Order], u[Order]
+
+            Same = np.flatnonzero( (Parts[1:] == Parts[:-1]) & (u[1:] > u[:-1]) )
+            Parts = Parts[Same]
+            Middle = (u[Same] + u[Same+1]) / 2
+
+            Cube.AddWeights(kk, dMag[A][Parts] + dMagSlope[Parts]*Middle, Color[A][Parts] + ColorSlope[Parts]*Middle,
+                            (u[Same+1] - u[Same]) * Duration[Parts] * PointsPerDay)
+
+    return [len(Objects), BandPair] + Cube.Info(), Cube.HashTable
+
+
+#Compiled version of the sampling kernel, one fused loop per time pair doing what
+#StreamTimePair, Store.Interpolate, BinIndex and CubeAccumulator do, operation for
+#operation, so the counts are identical. Only the counter-based samples (a Key per time
+#pair, see LightCurves.CounterUniform) can be reproduced this way.
+if numba is not None:
+
+    @numba.njit(cache=True)
+    def _MixJit(z):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    @numba.njit(cache=True)
+    def _UniformJit(Key, ObjectID, SampleInd):
+        Golden = np.uint64(0x9E3779B97F4A7C15)
+        z = _MixJit(ObjectID * Golden + Key)
+        z = _MixJit(z + (np.uint64(SampleInd) + np.uint64(1)) * Golden)
+        return (z >> np.uint64(11)) * (1.0 / 2**53)
+
+    @numba.njit(cache=True)
+    def _InterpolateJit(Keys, Offsets, MJD, Mag, Start, End, Valid, Span, Obj, XX):
+
+        if not (Valid[Obj] and XX >= Start[Obj] and XX <= End[Obj]):
+            return np.nan
+
+        Lo = Offsets[Obj]
+        Hi = Offsets[Obj+1]
+        Query = Obj*Span + (XX - Start[Obj])
+
+        #Left-side search of the knots of the object, as LightCurveStore.Interpolate.
+        while Lo < Hi:
+            Mid = (Lo + Hi) // 2
+            if Keys[Mid] < Query:
+                Lo = Mid + 1
+            else:
+                Hi = Mid
+
+        Ind = min(max(Lo, Offsets[Obj]+1), max(Offsets[Obj+1]-1, Offsets[Obj]+1))
+
+        XLo = MJD[Ind-1]
+        YLo = Mag[Ind-1]
+        Slope = (Mag[Ind] - YLo) / (MJD[Ind] - XLo)
+
+        return Slope*(XX - XLo) + YLo
+
+    @numba.njit(cache=True)
+    def _BinIndexJit(Value, Edges, Uniform):
+
+        BinNo = len(Edges) - 1
+
+        if not (Value >= Edges[0] and Value <= Edges[BinNo]):
+            return -1
+
+        if Uniform:
+            Ind = int(min(max(np.floor((Value - Edges[0]) * (BinNo / (Edges[BinNo] - Edges[0]))), 0), BinNo - 1))
+            if Value < Edges[Ind]:
+                Ind -= 1
+            if Value >= Edges[min(Ind + 1, BinNo)] and Ind < BinNo - 1:
+                Ind += 1
+            return Ind
+
+        if Value == Edges[BinNo]:
+            return BinNo - 1
+        return np.searchsorted(Edges, Value, side='right') - 1
+
+    #HashTable[kk] and Infos[kk] (outliers, dMagMin, dMagMax, ColorMin, ColorMax) are
+    #private to the time pair kk, so the time pairs run in parallel without locks.
+    @numba.njit(parallel=True, cache=True)
+    def _SamplingJit(dT1s, dT2s, Keys, Objects, ObjectIDs, PointsPerDay, Mode, Thr1, Thr2,
+                     Keys1, Offsets1, MJD1, Mag1, Start1, End1, Valid1,
+                     Keys2, Offsets2, MJD2, Mag2, Start2, End2, Valid2, Span1, Span2,
+                     BrightStart1, BrightEnd1, BrightStart2, BrightEnd2,
+                     BinMag, UniformMag, BinColor, UniformColor, HashTable, Infos):
+
+        for kk in numba.prange(len(dT1s)):
+
+            Shift1 = dT1s[kk]/1440
+            Shift2 = dT2s[kk]/1440
+            Sign = np.sign(dT2s[kk])
+
+            for jj in range(len(Objects)):
+
+                Obj = Objects[jj]
+                if not (Valid1[Obj] and Valid2[Obj]):
+                    continue
+
+                WindowStart1 = max(Start1[Obj], BrightStart1[Obj])
+                WindowEnd1 = min(End1[Obj], BrightEnd1[Obj])
+                WindowStart2 = max(Start2[Obj], BrightStart2[Obj])
+                WindowEnd2 = min(End2[Obj], BrightEnd2[Obj])
+
+                Start = max(max(WindowStart1, WindowStart2 - Shift1), WindowStart1 - Shift2)
+                End = min(min(WindowEnd1, WindowEnd1 - Shift2), WindowEnd2 - Shift1)
+
+                TimeRange = End - Start
+                if not TimeRange > 0:
+                    continue
+
+                SampleNo = np.int64(PointsPerDay*TimeRange)
+
+                for SampleInd in range(SampleNo):
+
+                    if Mode == 2:
+                        Uniform = 0.5
+                    else:
+                        Uniform = _UniformJit(Keys[kk], ObjectIDs[jj], SampleInd)
+                    if Mode != 0:
+                        Uniform = (SampleInd + Uniform) / SampleNo
+
+                    XX = Uniform*TimeRange + Start
+
+                    M1 = _InterpolateJit(Keys1, Offsets1, MJD1, Mag1, Start1, End1, Valid1, Span1, Obj, XX)
+                    M2 = _InterpolateJit(Keys2, Offsets2, MJD2, Mag2, Start2, End2, Valid2, Span2, Obj, XX + Shift1)
+                    M12 = _InterpolateJit(Keys1, Offsets1, MJD1, Mag1, Start1, End1, Valid1, Span1, Obj, XX + Shift2)
+
+                    if not (M1 < Thr1 and M2 < Thr2 and M12 < Thr1):
+                        continue
+
+                    dMag = (M1 - M12) * Sign
+                    Color = M1 - M2
+
+                    Infos[kk, 1] = min(Infos[kk, 1], dMag)
+                    Infos[kk, 2] = max(Infos[kk, 2], dMag)
+                    Infos[kk, 3] = min(Infos[kk, 3], Color)
+                    Infos[kk, 4] = max(Infos[kk, 4], Color)
+
+                    IndMag = _BinIndexJit(dMag, BinMag, UniformMag)
+                    IndColor = _BinIndexJit(Color, BinColor, UniformColor)
+
+                    if IndMag >= 0 and IndColor >= 0:
+                        HashTable[kk, IndMag, IndColor] += 1
+                    else:
+                        Infos[kk, 0] += 1
+
+
+#Cube of one band pair from independent samples of every time pair, drawn by
+#LightCurves.StreamTimePair in Mode with the counter-based generator under Keys (one
+#uint64 per time pair, see SampleSeed), ObjectIDs (Objects by default) being the indices
+#of the objects in the event, and Bright as for StreamTimePair. Backend 'numba' runs the
+#compiled loop over the objects and samples of each time pair, the time pairs in parallel
+#threads, 'numpy' the vectorized StreamTimePair; both give the same cube. None takes
+#'numba' if installed.
+def CalculateCubeSampling(Store, BandPair, TimePairs, BinMag, BinColor, Objects, PointsPerDay, Keys,
+                          Thrs=Thrs, ObjectIDs=None, Mode='random', Backend=None, Bright=True):
+
+    Band1 = BandPair[0]
+    Band2 = BandPair[1]
+
+    TimePairs = np.asarray(TimePairs)
+    Objects = np.asarray(Objects)
+    ObjectIDs = Objects if ObjectIDs is None else np.asarray(ObjectIDs)
+
+    if Mode not in SamplingModes:
+        raise ValueError('Unknown sampling mode {}, use one of {}.'.format(Mode, SamplingModes))
+
+    if Backend is None:
+        Backend = 'numpy' if numba is None else 'numba'
+
+    Cube = CubeAccumulator(BinMag, BinColor, len(TimePairs))
+
+    if Backend == 'numpy':
+
+        for kk, (dT1, dT2) in enumerate(TimePairs):
+            for dMag, Color in StreamTimePair(Store, Band1, Band2, dT1, dT2, Objects, PointsPerDay, Thrs=Thrs,
+                                              Key=Keys[kk], ObjectIDs=ObjectIDs, Mode=Mode, Bright=Bright):
+                Cube.Add(kk, dMag, Color)
+
+        return [len(Objects), BandPair] + Cube.Info(), Cube.HashTable
+
+    if Backend != 'numba' or numba is None:
+        raise ValueError('Backend {} is not available.'.format(Backend))
+
+    Infos = np.zeros([len(TimePairs), 5])
+    Infos[:, 1::2] = np.inf
+    Infos[:, 2::2] = -np.inf
+
+    Bands = [ (Store.Keys(Band), np.asarray(Store.Offsets[Band]), np.asarray(Store.MJD[Band]), np.asarray(Store.Mag[Band]),
+               Store.Start[Band], Store.End[Band], np.asarray(Store.Valid[Band])) for Band in [Band1, Band2] ]
+
+    #Without Bright the windows are not narrowed: max(Start, -inf) is Start.
+    if Bright:
+        BrightRanges = [ *Store.BrightRange(Band1, Thrs[Band1]), *Store.BrightRange(Band2, Thrs[Band2]) ]
+    else:
+        BrightRanges = [ np.full(Store.ObjectNo, -np.inf), np.full(Store.ObjectNo, np.inf) ] * 2
+
+    _SamplingJit(TimePairs[:, 0].astype(np.float64), TimePairs[:, 1].astype(np.float64),
+                 np.asarray(Keys, dtype=np.uint64), Objects.astype(np.int64), ObjectIDs.astype(np.uint64),
+                 float(PointsPerDay), SamplingModes.index(Mode), float(Thrs[Band1]), float(Thrs[Band2]),
+                 *Bands[0], *Bands[1], float(Store.Span), float(Store.Span), *BrightRanges,
+                 Cube.BinMag.astype(np.float64), Cube.UniformMag, Cube.BinColor.astype(np.float64), Cube.UniformColor,
+                 Cube.HashTable, Infos)
+
+    Cube.outliersNo = int(Infos[:, 0].sum())
+    Cube.dMagMin, Cube.dMagMax = Infos[:, 1].min(initial=np.inf), Infos[:, 2].max(initial=-np.inf)
+    Cube.ColorMin, Cube.ColorMax = Infos[:, 3].min(initial=np.inf), Infos[:, 4].max(initial=-np.inf)
+
+    return [len(Objects), BandPair] + Cube.Info(), Cube.HashTable
+
+
+#The InfoDict entries of the parameters of a build: counts are only added to a cube (see
+#AddToCube) or merged with it (CombineCubes.py) if these are the same.
+BuildKeys = ['BandPairs', 'dT1s', 'dT2s', 'TimePairs', 'BinMag', 'BinColor', 'PointsPerDay', 'Kernel', 'SamplingMode']
+
+#Those entries for a build, as SaveCube writes them. Kernel is left out if None, and
+#SamplingMode unless Kernel is 'Sampling'.
+def BuildInfo(BandPairs, dT1s, dT2s, TimePairs, BinMag, BinColor, PointsPerDay, Kernel=None, SamplingMode=None):
+
+    Build = {'PointsPerDay': PointsPerDay, 'BandPairs': [ii.lower() for ii in BandPairs], 'dT1s': dT1s, 'dT2s': dT2s,
+             'BinMag': BinMag, 'BinColor': BinColor, 'TimePairs': np.array(TimePairs)}
+
+    if Kernel is not None:
+        Build['Kernel'] = Kernel
+    if Kernel == 'Sampling' and SamplingMode is not None:
+        Build['SamplingMode'] = SamplingMode
+
+    return Build
+
+#Raise ValueError unless the cube file FilePath was built with the parameters Build (see BuildInfo).
+def CheckBuild(FilePath, Build):
+
+    InfoDict = ReadCubeHeader(FilePath)['InfoDict']
+
+    for Key in BuildKeys:
+        if (Key in InfoDict) != (Key in Build) or ( Key in Build and not
+                np.array_equal(np.asarray(InfoDict[Key]), np.asarray(Build[Key])) ):
+            raise ValueError('The {} of {} differ from those of this build, its counts cannot be added.'.format(Key, FilePath))
+
+#Build the InfoDict of an event from the infos returned by the kernels of its
+#band pairs and save it with the cube as ProbCube_<time>__<Event>.cube (see WriteCube),
+#or as the old two-pickle ProbCube_<time>__<Event>.pkl with Format='pkl'.
+#Sparse=True stores only the non-zero bins of the .cube, see SparseCube.
+#Manifest lists the chunks of objects counted in the cube, see ObjectChunks.
+def SaveCube(HashTableTotal, Infos, EventName, BandPairs, dT1s, dT2s, TimePairs, 
+             BinMag, BinColor, PointsPerDay, TargetFolder, Format='cube', Sparse=False, Manifest=None,
+             Kernel=None, SamplingMode=None):
+    
+    outliersNo = 0
+    dMagMin = []
+    dMagMax = []
+    ColorMin = []
+    ColorMax = []
+    
+    OverflowNo = 0
+
+    for info in Infos:
+        
+        outliersNo += info[2]
+        dMagMin.append(info[3])
+        dMagMax.append(info[4])
+        ColorMin.append(info[5])
+        ColorMax.append(info[6])
+        OverflowNo += InfoOverflow(info)
+        
+    InfoDict = {}
+    InfoDict['EventName'] = EventName
+    InfoDict['ObjectNo'] = Infos[0][0]
+
+    InfoDict.update(BuildInfo(BandPairs, dT1s, dT2s, TimePairs, BinMag, BinColor, PointsPerDay, Kernel, SamplingMode))
+
+    InfoDict['dMagRange'] = [ min(dMagMin), max(dMagMax) ]
+    InfoDict['ColorRange'] = [ min(ColorMin), max(ColorMax) ]
+    
+    if outliersNo>0:
+        InfoDict['Outliers'] = outliersNo
+        InfoDict['OutliersRatio'] = outliersNo / HashTableTotal.max()        
+    
+    if OverflowNo>0:
+        InfoDict['Overflow'] = OverflowNo
+        
+    #Save results
+
+    FilePath = CubeFilePath(TargetFolder, EventName, '.' + Format)
+
+    if Format == 'pkl':
+        with open(FilePath, 'wb') as f:
+            pickle.dump(InfoDict, f)
+            pickle.dump(HashTableTotal, f ) 
+    else:
+        WriteCube(FilePath, InfoDict, SparseCube.FromDense(HashTableTotal) if Sparse else HashTableTotal,
+                  Manifest=Manifest)
+
+    return FilePath
+
+
+#ProbCube_<time>__<Event><Ext> in TargetFolder, numbered (1), (2)... if it exists.
+def CubeFilePath(TargetFolder, EventName, Ext='.cube'):
+
+    FileName = 'ProbCube_' + time.strftime('%m%d_%H%M') + '__' + EventName + Ext
+
+    FilePath = os.path.join(TargetFolder, FileName)
+    FilePath0 = FilePath
+
+    ii = 1
+    while os.path.exists(FilePath):
+        FilePath = FilePath0[:-len(Ext)] + '('+str(ii)+')' + Ext
+        ii += 1
+
+    return FilePath
+
+#ProbCube_<time>__<Event>(n).pkl/.cube, the event name being everything between the
+#first '__' and the (n) or the extension.
+CubeName = re.compile(r'^ProbCube_.*?__(?P<EventName>.+?)(\(\d+\))?\.(pkl|cube)$')
+
+#The newest .cube file of EventName in Folder, None if there is none.
+def FindCube(Folder, EventName):
+
+    FilePaths = [ os.path.join(Folder, FileName) for FileName in os.listdir(Folder)
+                  if FileName.endswith('.cube') and CubeName.match(FileName)
+                  and CubeName.match(FileName).group('EventName') == EventName ]
+
+    return max(FilePaths, key=os.path.getmtime) if FilePaths else None
+
+
+#Cube file: CubeMagic, the length of the header as uint64 (little endian), the header
+#as JSON, then the HashTable as a raw C-order array starting at an offset aligned to
+#PayloadAlign bytes, so it can be opened with np.memmap and read slice by slice.
+#The header holds the format Version, the dtype, shape and offset of the payload, the
+#InfoDict (axes, bins, ObjectNo, ...), the Provenance of the file and, if known, the
+#Manifest of the chunks of objects counted in it (see ObjectChunks).
+#Version 2 adds layout 'sparse': the payload is the sorted flat indices (index_dtype) of
+#the non-zero bins at offset, followed by their counts at count_offset, nnz of each.
+CubeMagic = b'PROBCUBE'
+CubeVersion = 2
+PayloadAlign = 4096
+
+def _JSONValue(Value):
+
+    if isinstance(Value, np.ndarray):
+        return Value.tolist()
+    if isinstance(Value, np.generic):
+        return Value.item()
+    if isinstance(Value, (list, tuple)):
+        return [_JSONValue(Item) for Item in Value]
+    if isinstance(Value, dict):
+        return { Key: _JSONValue(Item) for Key, Item in Value.items() }
+    return Value
+
+def _Aligned(Size):
+    return -(-Size // PayloadAlign) * PayloadAlign
+
+
+#HashTable kept as the sorted flat indices of its non-zero bins and their counts.
+#Most of the [BinMag, BinColor] bins of a cube are empty, so this is much smaller than
+#the dense array. Indexing with leading integers (Cube[BandPair, TimePair],
+#Cube[BandPair, TimePair, MagBin, ColorBin], ...) returns dense NumPy values as the dense
+#array would, Take looks up flat indices in bulk.
+class SparseCube:
+
+    def __init__(self, Indices, Counts, shape):
+
+        self.Indices = Indices
+        self.Counts = Counts
+        self.shape = tuple(int(ii) for ii in shape)
+        self.dtype = Counts.dtype
+        self.ndim = len(self.shape)
+        self.size = int(np.prod(self.shape))
+
+    @classmethod
+    def FromDense(cls, HashTable):
+
+        Flat = np.asarray(HashTable).reshape(-1)
+        Indices = np.flatnonzero(Flat)
+
+        #uint32 indices as long as the cube allows, they are most of the size.
+        IndexDtype = np.uint32 if Flat.size < 2**32 else np.int64
+
+        return cls(Indices.astype(IndexDtype), Flat[Indices], HashTable.shape)
+
+    @property
+    def nnz(self):
+        return len(self.Indices)
+
+    @property
+    def nbytes(self):
+        return self.Indices.nbytes + self.Counts.nbytes
+
+    def ToDense(self):
+
+        HashTable = np.zeros(self.shape, dtype=self.dtype)
+        HashTable.reshape(-1)[self.Indices] = self.Counts
+
+        return HashTable
+
+    #Values at the flat indices FlatInd (any shape), 0 for the empty bins.
+    def Take(self, FlatInd):
+
+        FlatInd = np.asarray(FlatInd)
+        if self.nnz == 0:
+            return np.zeros(FlatInd.shape, dtype=self.dtype)
+
+        #Searched in the dtype of Indices, which would be copied to a common dtype otherwise.
+        FlatInd = FlatInd.astype(self.Indices.dtype)
+        Pos = np.minimum(np.searchsorted(self.Indices, FlatInd), self.nnz-1)
+        Hit = self.Indices[Pos] == FlatInd
+
+        return np.where(Hit, self.Counts[Pos], 0).astype(self.dtype)
+
+    #Dense block of the bins [Lo, Hi) of the flattened cube.
+    def FlatRange(self, Lo, Hi):
+
+        Block = np.zeros(Hi-Lo, dtype=self.dtype)
+        a, b = np.searchsorted(self.Indices, np.array([Lo, Hi], dtype=self.Indices.dtype))
+        Block[self.Indices[a:b].astype(np.int64) - Lo] = self.Counts[a:b]
+
+        return Block
+
+    def __getitem__(self, Key):
+
+        if not isinstance(Key, tuple):
+            Key = (Key,)
+
+        #The leading integers select a contiguous block, the rest indexes the dense block.
+        Prefix = []
+        for Item in Key:
+            if not isinstance(Item, (int, np.integer)):
+                break
+            Prefix.append(int(Item) % self.shape[len(Prefix)])
+
+        Shape = self.shape[len(Prefix):]
+        Lo = int(np.ravel_multi_index(Prefix + [0]*len(Shape), self.shape)) if self.ndim else 0
+        Block = self.FlatRange(Lo, Lo + int(np.prod(Shape))).reshape(Shape)
+
+        return Block[Key[len(Prefix):]]
+
+    #Sum with another sparse or dense cube of the same shape, as a SparseCube. As in
+    #AddCounts, sums beyond the range of an integer dtype are clipped to its maximum, their
+    #number being the OverflowNo of the sum.
+    def __add__(self, Other):
+
+        if not isinstance(Other, SparseCube):
+            Other = SparseCube.FromDense(Other)
+        if Other.shape != self.shape:
+            raise ValueError('Cubes of shapes {} and {} cannot be added.'.format(self.shape, Other.shape))
+
+        dtype = np.result_type(self.dtype, Other.dtype)
+        Integer = np.issubdtype(dtype, np.integer)
+        SumType = np.uint64 if Integer else np.float64
+
+        Indices, Inverse = np.unique(np.concatenate((self.Indices, Other.Indices)).astype(np.int64), return_inverse=True)
+        Sum = np.zeros(len(Indices), dtype=SumType)
+        np.add.at(Sum, Inverse, np.concatenate((self.Counts, Other.Counts)).astype(SumType))
+
+        OverflowNo = 0
+        if Integer:
+            Over = Sum > np.iinfo(dtype).max
+            OverflowNo = int(Over.sum())
+            Sum[Over] = np.iinfo(dtype).max
+
+        Result = SparseCube(Indices.astype(self.Indices.dtype), Sum.astype(dtype), self.shape)
+        Result.OverflowNo = OverflowNo
+
+        return Result
+
+    __radd__ = __add__
+
+    #A dense array + SparseCube goes to __radd__, not to NumPy adding the cube to every bin.
+    __array_ufunc__ = None
+
+
+#Values of a dense or sparse HashTable at flat indices.
+def TakeFlat(HashTable, FlatInd):
+
+    if isinstance(HashTable, SparseCube):
+        return HashTable.Take(FlatInd)
+    return HashTable.reshape(-1)[FlatInd]
+
+
+def _Header(InfoDict, dtype, shape, Provenance, Layout='dense', Manifest=None):
+
+    if Provenance is None:
+        Provenance = {'Created': time.strftime('%Y-%m-%d %H:%M:%S'), 'Program': os.path.basename(sys.argv[0])}
+
+    Header = {'Version': 2 if Layout == 'sparse' else 1,
+              'layout': Layout,
+              'dtype': np.dtype(dtype).str,
+              'shape': [int(ii) for ii in shape],
+              'InfoDict': _JSONValue(InfoDict),
+              'Arrays': [Key for Key, Value in InfoDict.items() if isinstance(Value, np.ndarray)],
+              'Provenance': _JSONValue(Provenance)}
+
+    if Manifest is not None:
+        Header['Manifest'] = _JSONValue(Manifest)
+
+    return Header
+
+def _HeaderBytes(Header, Offset):
+
+    HeaderBytes = json.dumps(Header).encode()
+    return HeaderBytes + b' ' * (Offset - len(CubeMagic) - 8 - len(HeaderBytes))
+
+#HashTable can be a dense array or a SparseCube, which is written with layout 'sparse'.
+#HeaderSlack bytes are left free in the header for UpdateCubeInfo.
+def WriteCube(FilePath, InfoDict, HashTable, Provenance=None, HeaderSlack=40, Manifest=None):
+
+    Sparse = isinstance(HashTable, SparseCube)
+    if not Sparse:
+        HashTable = np.ascontiguousarray(HashTable)
+
+    Header = _Header(InfoDict, HashTable.dtype, HashTable.shape, Provenance, 'sparse' if Sparse else 'dense', Manifest)
+
+    #The offsets are part of the header, so they are computed with placeholders of the same width.
+    Header['offset'] = 0
+    if Sparse:
+        Header['nnz'] = HashTable.nnz
+        Header['index_dtype'] = np.dtype(HashTable.Indices.dtype).newbyteorder('<').str
+        Header['count_offset'] = 0
+
+    HeaderSize = len(json.dumps(Header).encode()) + HeaderSlack
+    Offset = _Aligned(len(CubeMagic) + 8 + HeaderSize)
+    Header['offset'] = Offset
+    if Sparse:
+        Header['count_offset'] = _Aligned(Offset + HashTable.Indices.nbytes)
+
+    HeaderBytes = _HeaderBytes(Header, Offset)
+
+    with open(FilePath, 'wb') as f:
+        f.write(CubeMagic)
+        f.write(np.uint64(len(HeaderBytes)).astype('<u8').tobytes())
+        f.write(HeaderBytes)
+        if Sparse:
+            np.asarray(HashTable.Indices, dtype=Header['index_dtype']).tofile(f)
+            f.write(b'\0' * (Header['count_offset'] - f.tell()))
+            np.asarray(HashTable.Counts).tofile(f)
+        else:
+            HashTable.tofile(f)
+
+#Dense cube file of zeros, returned as a writable memmap to be filled slice by slice.
+#The InfoDict can be completed afterwards with UpdateCubeInfo.
+def CreateCube(FilePath, InfoDict, shape, dtype=np.uint32, Provenance=None, HeaderSlack=4096, Manifest=None):
+
+    Header = _Header(InfoDict, dtype, shape, Provenance, Manifest=Manifest)
+    Header['offset'] = 0
+    Offset = _Aligned(len(CubeMagic) + 8 + len(json.dumps(Header).encode()) + HeaderSlack)
+    Header['offset'] = Offset
+
+    HeaderBytes = _HeaderBytes(Header, Offset)
+
+    with open(FilePath, 'wb') as f:
+        f.write(CubeMagic)
+        f.write(np.uint64(len(HeaderBytes)).astype('<u8').tobytes())
+        f.write(HeaderBytes)
+        f.truncate(Offset + int(np.prod(shape)) * np.dtype(dtype).itemsize)
+
+    return np.memmap(FilePath, dtype=Header['dtype'], mode='r+', offset=Offset, shape=tuple(Header['shape']))
+
+#Replace the InfoDict (and the Manifest if given) in the header of a cube file, in place.
+#A header grown beyond its space moves the payload to the next aligned offset, the file
+#being rewritten next to it and renamed over it.
+def UpdateCubeInfo(FilePath, InfoDict, Manifest=None):
+
+    Header = ReadCubeHeader(FilePath)
+    Header['InfoDict'] = _JSONValue(InfoDict)
+    Header['Arrays'] = [Key for Key, Value in InfoDict.items() if isinstance(Value, np.ndarray)]
+    if Manifest is not None:
+        Header['Manifest'] = _JSONValue(Manifest)
+
+    HeaderBytes = json.dumps(Header).encode()
+    Space = Header['offset'] - len(CubeMagic) - 8
+
+    if len(HeaderBytes) > Space:
+        _MovePayload(FilePath, Header)
+        return
+
+    with open(FilePath, 'r+b') as f:
+        f.seek(len(CubeMagic))
+        f.write(np.uint64(Space).astype('<u8').tobytes())
+        f.write(HeaderBytes + b' ' * (Space - len(HeaderBytes)))
+
+def _MovePayload(FilePath, Header, HeaderSlack=4096, BlockSize=64*1024**2):
+
+    Offset0 = Header['offset']
+    Offset = _Aligned(len(CubeMagic) + 8 + len(json.dumps(Header).encode()) + HeaderSlack)
+
+    Header['offset'] = Offset
+    if 'count_offset' in Header:
+        Header['count_offset'] += Offset - Offset0
+
+    HeaderBytes = _HeaderBytes(Header, Offset)
+    TmpPath = FilePath + '.tmp'
+
+    with open(FilePath, 'rb') as Source, open(TmpPath, 'wb') as f:
+        f.write(CubeMagic)
+        f.write(np.uint64(len(HeaderBytes)).astype('<u8').tobytes())
+        f.write(HeaderBytes)
+        Source.seek(Offset0)
+        shutil.copyfileobj(Source, f, BlockSize)
+
+    os.replace(TmpPath, FilePath)
+
+def ReadCubeHeader(FilePath):
+
+    with open(FilePath, 'rb') as f:
+
+        if f.read(len(CubeMagic)) != CubeMagic:
+            raise ValueError('{} is not a cube file.'.format(FilePath))
+
+        HeaderSize = int(np.frombuffer(f.read(8), dtype='<u8')[0])
+        Header = json.loads(f.read(HeaderSize))
+
+    if Header['Version'] > CubeVersion:
+        raise ValueError('{} has cube format version {}, this reader knows up to {}.'.format(FilePath, Header['Version'], CubeVersion))
+
+    return Header
+
+def _ReadArray(FilePath, dtype, shape, offset, mmap_mode):
+
+    if mmap_mode is None:
+        return np.fromfile(FilePath, dtype=dtype, count=int(np.prod(shape)), offset=offset).reshape(shape)
+    if int(np.prod(shape)) == 0:
+        return np.zeros(shape, dtype=dtype)
+    return np.memmap(FilePath, dtype=dtype, mode=mmap_mode, offset=offset, shape=tuple(shape))
+
+#InfoDict and HashTable of a cube file, the HashTable memory-mapped (read only by
+#default), only the slices used are read from disk. mmap_mode=None reads it all.
+#A sparse file gives a SparseCube, dense ones a NumPy array.
+def ReadCube(FilePath, mmap_mode='r'):
+
+    Header = ReadCubeHeader(FilePath)
+
+    InfoDict = Header['InfoDict']
+    for Key in Header['Arrays']:
+        InfoDict[Key] = np.array(InfoDict[Key])
+
+    if Header.get('layout', 'dense') == 'sparse':
+        Indices = _ReadArray(FilePath, Header['index_dtype'], [Header['nnz']], Header['offset'], mmap_mode)
+        Counts = _ReadArray(FilePath, Header['dtype'], [Header['nnz']], Header['count_offset'], mmap_mode)
+        HashTable = SparseCube(Indices, Counts, Header['shape'])
+    else:
+        HashTable = _ReadArray(FilePath, Header['dtype'], Header['shape'], Header['offset'], mmap_mode)
+
+    return InfoDict, HashTable
+
+#InfoDict and HashTable of a cube saved in either format.
+def LoadCube(FilePath, mmap_mode='r'):
+
+    if FilePath.endswith('.pkl'):
+        with open(FilePath, 'rb') as f:
+            InfoDict = pickle.load(f)
+            HashTable = pickle.load(f)
+        return InfoDict, HashTable
+
+    return ReadCube(FilePath, mmap_mode)
+
+#Rewrite a ProbCube_*.pkl as a cube file next to it, only its non-zero bins with Sparse=True.
+def ConvertCubePickle(PklPath, CubePath=None, Sparse=False):
+
+    if CubePath is None:
+        CubePath = PklPath[:-len('.pkl')] + '.cube'
+
+    InfoDict, HashTable = LoadCube(PklPath)
+    if Sparse:
+        HashTable = SparseCube.FromDense(HashTable)
+    WriteCube(CubePath, InfoDict, HashTable, Provenance={'Created': time.strftime('%Y-%m-%d %H:%M:%S'),
+                                                         'ConvertedFrom': os.path.basename(PklPath)})
+    return CubePath
+
+
+#Seed sequence of the random numbers of an event and band pair (and of the further Keys,
+#a time pair, ...), the child of Seed with a spawn key made of them: the same for every
+#task of a build, wherever and in whatever order it runs.
+def SampleSeed(Seed, EventName, BandPair, *Keys):
+
+    SpawnKey = tuple( zlib.crc32(str(Key).encode()) for Key in (EventName, BandPair) + Keys )
+    return np.random.SeedSequence(Seed, spawn_key=SpawnKey)
+
+
+#Manifest of the objects counted in a cube: a list of chunks {'Event', 'Objects', 'Seed'},
+#Objects being a range [Start, Stop, Step] of object indices of the event and Seed the
+#seed of their samples (see SampleSeed). A new build of the same event counts only the
+#objects missing from the manifest and folds them into the cube with AddToCube.
+
+#Chunks of at most ChunkSize of the sorted object indices Objects, each an arithmetic range.
+#All the chunks get Seed, a new random one if None.
+def ObjectChunks(EventName, Objects, ChunkSize, Seed=None):
+
+    Objects = np.asarray(Objects)
+    Chunks = []
+    Lo = 0
+
+    while Lo < len(Objects):
+
+        Hi = min(Lo+ChunkSize, len(Objects))
+        Step = int(Objects[Lo+1] - Objects[Lo]) if Hi-Lo > 1 else 1
+
+        Break = np.flatnonzero(np.diff(Objects[Lo:Hi]) != Step)
+        if len(Break) > 0:
+            Hi = Lo + int(Break[0]) + 1
+
+        Chunks.append({'Event': EventName, 'Objects': [int(Objects[Lo]), int(Objects[Hi-1])+1, Step]})
+        Lo = Hi
+
+    if Seed is None:
+        Seed = int(np.random.SeedSequence().generate_state(1, np.uint64)[0])
+    for Chunk in Chunks:
+        Chunk['Seed'] = Seed
+
+    return Chunks
+
+def ChunkObjects(Chunk):
+    return np.arange(*Chunk['Objects'])
+
+def ReadManifest(FilePath):
+    return ReadCubeHeader(FilePath).get('Manifest') or []
+
+#Seed of the objects of EventName counted in Manifest, None if there are none. Objects
+#added with the same seed make the cube identical to one built with all of them at once.
+def ManifestSeed(Manifest, EventName):
+    return next( (Chunk['Seed'] for Chunk in Manifest if Chunk['Event'] == EventName), None )
+
+#The objects of Objects not counted yet for EventName according to Manifest.
+def MissingObjects(Objects, Manifest, EventName):
+
+    Done = [ ChunkObjects(Chunk) for Chunk in Manifest if Chunk['Event'] == EventName ]
+    if not Done:
+        return np.asarray(Objects)
+
+    return np.asarray(Objects)[ ~np.isin(Objects, np.concatenate(Done)) ]
+
+#Raise ValueError unless the manifest of the cube file FilePath lists objects of EventName.
+#A cube without one (built before manifests, converted from a .pkl, ...) counts unknown
+#objects, which new counts would count again.
+def CheckManifest(FilePath, EventName):
+
+    if ManifestSeed(ReadManifest(FilePath), EventName) is None:
+        raise ValueError('{} has no manifest of the objects of {} it counts, new counts cannot be added to it.'.format(FilePath, EventName))
+
+#Add HashTable into the writable Cube band pair by band pair, summed in 64 bits so bins
+#beyond the range of an integer dtype are found. They are clipped to its maximum and
+#their number returned.
+def AddCounts(Cube, HashTable):
+
+    Integer = np.issubdtype(Cube.dtype, np.integer)
+    SumType = np.uint64 if Integer else np.float64
+
+    OverflowNo = 0
+
+    for kk in range(Cube.shape[0]):
+
+        Sum = Cube[kk].astype(SumType)
+        Sum += np.asarray(HashTable[kk], dtype=SumType)
+
+        if Integer:
+            Over = Sum > np.iinfo(Cube.dtype).max
+            if Over.any():
+                OverflowNo += int(Over.sum())
+                Sum[Over] = np.iinfo(Cube.dtype).max
+
+        Cube[kk] = Sum
+
+    return OverflowNo
+
+#The first chunk of Chunks with objects already counted in a chunk of Manifest, and that
+#chunk, or None.
+def CountedTwice(Manifest, Chunks):
+
+    for Chunk in Chunks:
+        for Done in Manifest:
+            if Done['Event'] == Chunk['Event'] and np.isin(ChunkObjects(Chunk), ChunkObjects(Done)).any():
+                return Chunk, Done
+
+    return None
+
+#Fold the HashTable and the infos (as for SaveCube) of newly counted objects into the
+#cube file FilePath, in place for a dense cube, and add their Chunks to its manifest.
+#Build, the parameters of the new counts (see BuildInfo), must be those of the cube, and
+#its manifest must list the objects of the event it counts (see CheckManifest).
+def AddToCube(FilePath, HashTable, Infos, Chunks, Build):
+
+    CheckBuild(FilePath, Build)
+    for EventName in sorted(set( Chunk['Event'] for Chunk in Chunks )):
+        CheckManifest(FilePath, EventName)
+
+    Header = ReadCubeHeader(FilePath)
+    Sparse = Header.get('layout', 'dense') == 'sparse'
+
+    InfoDict, Cube = ReadCube(FilePath, mmap_mode=None if Sparse else 'r+')
+    if list(Cube.shape) != list(HashTable.shape):
+        raise ValueError('{} has shape {}, the new counts {}.'.format(FilePath, Cube.shape, HashTable.shape))
+    if np.issubdtype(Cube.dtype, np.integer) != np.issubdtype(HashTable.dtype, np.integer):
+        raise ValueError('{} holds {}, the new counts {}: cubes of the Exact kernel and of the sampling '
+                         'kernels cannot be added.'.format(FilePath, Cube.dtype, HashTable.dtype))
+
+    Manifest = Header['Manifest']
+    Twice = CountedTwice(Manifest, Chunks)
+    if Twice:
+        raise ValueError('Objects {} of {} are already counted in {}.'.format(Twice[0]['Objects'], Twice[0]['Event'], FilePath))
+
+    if Sparse:
+        Cube = Cube.ToDense()
+    OverflowNo = AddCounts(Cube, HashTable)
+
+    InfoDict['ObjectNo'] += Infos[0][0]
+
+    outliersNo = InfoDict.get('Outliers', 0) + sum( info[2] for info in Infos )
+    InfoDict['dMagRange'] = [ min([InfoDict['dMagRange'][0]] + [info[3] for info in Infos]),
+                              max([InfoDict['dMagRange'][1]] + [info[4] for info in Infos]) ]
+    InfoDict['ColorRange'] = [ min([InfoDict['ColorRange'][0]] + [info[5] for info in Infos]),
+                               max([InfoDict['ColorRange'][1]] + [info[6] for info in Infos]) ]
+
+    Max = max( Cube[kk].max() for kk in range(Cube.shape[0]) )
+    if outliersNo > 0 and Max > 0:
+        InfoDict['Outliers'] = outliersNo
+        InfoDict['OutliersRatio'] = outliersNo / Max
+    OverflowNo += sum( InfoOverflow(info) for info in Infos )
+    if OverflowNo > 0:
+        InfoDict['Overflow'] = InfoDict.get('Overflow', 0) + OverflowNo
+
+    if Sparse:
+        TmpPath = FilePath + '.tmp'
+        WriteCube(TmpPath, InfoDict, SparseCube.FromDense(Cube), Provenance=Header['Provenance'],
+                  Manifest=Manifest+Chunks)
+        os.replace(TmpPath, FilePath)
+    else:
+        Cube.flush()
+        del Cube
+        UpdateCubeInfo(FilePath, InfoDict, Manifest+Chunks)
+
+    return OverflowNo
+
+
+#Finished blocks of a cube build kept on disk, so a build killed by its time limit can
+#be resumed by the next job. Folder holds a file <BandPair>_<Lo>_<Hi>.npy with the
+#HashTable of every finished block (time pairs Lo:Hi of a band pair) and Progress.json,
+#the manifest of the finished blocks with their infos (as returned by CalculateCube).
+#Both are written to a temporary file and renamed, so a kill leaves the old or the new
+#version, never a partial one. Config, the parameters of the build, is kept in the
+#manifest and must be the same to resume; State keeps whatever else a resumed build
+#has to reuse (the seeds of its objects, ...).
+class BuildCheckpoint:
+
+    def __init__(self, Folder, Config):
+
+        self.Folder = Folder
+        self.Config = _JSONValue(Config)
+        self.ProgressPath = os.path.join(Folder, 'Progress.json')
+
+        self.Blocks = {}
+        self.State = {}
+
+        if os.path.exists(self.ProgressPath):
+
+            with open(self.ProgressPath) as f:
+                Progress = json.load(f)
+
+            if Progress['Config'] != self.Config:
+                raise ValueError('The checkpoint in {} is of a build with other parameters.'.format(Folder))
+
+            self.Blocks = Progress['Blocks']
+            self.State = Progress['State']
+
+        os.makedirs(Folder, exist_ok=True)
+
+    @staticmethod
+    def BlockPath(Folder, BandPair, Block):
+        return os.path.join(Folder, '{}_{}_{}.npy'.format(BandPair, *Block))
+
+    #Write the HashTable of a block, which is not finished before Finish records it.
+    #Needs no BuildCheckpoint, so it can run where the block was computed.
+    @staticmethod
+    def WriteBlock(Folder, BandPair, Block, HashTable):
+
+        FilePath = BuildCheckpoint.BlockPath(Folder, BandPair, Block)
+
+        with open(FilePath + '.tmp', 'wb') as f:
+            np.save(f, HashTable)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(FilePath + '.tmp', FilePath)
+
+    def Done(self, BandPair, Block):
+        return '{}_{}_{}'.format(BandPair, *Block) in self.Blocks
+
+    def Finish(self, BandPair, Block, info):
+        self.Blocks['{}_{}_{}'.format(BandPair, *Block)] = _JSONValue(info)
+        self.Commit()
+
+    def Save(self, BandPair, Block, info, HashTable):
+        self.WriteBlock(self.Folder, BandPair, Block, HashTable)
+        self.Finish(BandPair, Block, info)
+
+    #info and HashTable of a finished block.
+    def Load(self, BandPair, Block, mmap_mode=None):
+        return self.Blocks['{}_{}_{}'.format(BandPair, *Block)], np.load(self.BlockPath(self.Folder, BandPair, Block), mmap_mode=mmap_mode)
+
+    def Commit(self):
+
+        with open(self.ProgressPath + '.tmp', 'w') as f:
+            json.dump({'Config': self.Config, 'Blocks': self.Blocks, 'State': _JSONValue(self.State)}, f)
+            f.flush()
+            os.fsync(f.fileno())
+
+        os.replace(self.ProgressPath + '.tmp', self.ProgressPath)
+
+    #Delete the checkpoint once the cube is saved.
+    def Remove(self):
+        shutil.rmtree(self.Folder)
+
+
+#Number of bins clipped when partial cubes were summed, kept by AddPartials as an eighth
+#entry of the info of a band pair, the kernels returning seven.
+def InfoOverflow(info):
+    return info[7] if len(info) > 7 else 0
+
+def AddInfos(info1, info2, OverflowNo=0):
+
+    info = [ info1[0] + info2[0], info1[1], info1[2] + info2[2],
+             min(info1[3], info2[3]), max(info1[4], info2[4]), min(info1[5], info2[5]), max(info1[6], info2[6]) ]
+
+    OverflowNo += InfoOverflow(info1) + InfoOverflow(info2)
+    return info + [OverflowNo] if OverflowNo > 0 else info
+
+#Sum two (info, HashTable) results of the same band pair and time pairs computed on
+#different objects, or two (infos, HashTable) of all band pairs (see CalculateCubeAllPairs).
+#The counts are summed as by AddCounts, the bins beyond the largest count of the dtype
+#being clipped and counted in the info (see InfoOverflow).
+def AddPartials(Part1, Part2):
+
+    info1, HashTable1 = Part1
+    info2, HashTable2 = Part2
+
+    HashTable = np.array(HashTable1)
+
+    if isinstance(info1[0], list):
+        info = [ AddInfos(Info1, Info2, AddCounts(HashTable[kk], HashTable2[kk]))
+                 for kk, (Info1, Info2) in enumerate(zip(info1, info2)) ]
+    else:
+        info = AddInfos(info1, info2, AddCounts(HashTable, HashTable2))
+
+    return info, HashTable
+
+
+#Usage: python CubeBuilder.py [--sparse] ProbCube_<time>__<Event>.pkl [...]
+if __name__ == '__main__':
+
+    Sparse = '--sparse' in sys.argv[1:]
+
+    for PklPath in [Arg for Arg in sys.argv[1:] if Arg != '--sparse']:
+
+        start = time.time()
+        CubePath = ConvertCubePickle(PklPath, Sparse=Sparse)
+        print('{} -> {}\t time spent: {:6.3f} s'.format(PklPath, CubePath, time.time()-start))
@@ -0,0 +1,266 @@
+"""
+Lookups in a probability cube saved by CubeBuilder.SaveCube.
+
+ProbabilityCube indexes the band pairs, the (dT1, dT2) grid and the dMag/Color
+bins of a cube once, so a query is a few dict/list lookups instead of the
+scans over InfoDict['TimePairs'] done by the Enquiry function of the notebooks.
+Query answers one alert; QueryBatch answers arrays of alerts at once.
+AlertClassifier turns batches of alert triplets into posterior probabilities
+over the cubes of all the events.
+"""
+
+from bisect import bisect_left, bisect_right
+import numpy as np
+
+from CubeBuilder import BinIndex, IsUniform, LoadCube, TakeFlat
+
+
+#Index of the nearest value of the sorted Grid, the lower one on a tie as argmin does.
+def NearestIndex(Values, Grid):
+
+    Values = np.asarray(Values)
+
+    if len(Grid) == 1:
+        return np.zeros(Values.shape, dtype=np.int64)
+
+    Ind = np.clip(np.searchsorted(Grid, Values, side='left'), 1, len(Grid)-1)
+
+    return Ind - ( Values - Grid[Ind-1] <= Grid[Ind] - Values )
+
+def _Nearest(Value, Grid):
+
+    Ind = min(max(bisect_left(Grid, Value), 1), len(Grid)-1)
+
+    if len(Grid) == 1 or Value - Grid[Ind-1] <= Grid[Ind] - Value:
+        return Ind - 1
+    return Ind
+
+
+class ProbabilityCube:
+
+    def __init__(self, HashTable, InfoDict):
+
+        self.HashTable = HashTable
+        self.InfoDict = InfoDict
+
+        self.BandPairIndex = { BandPair: ii for ii, BandPair in enumerate(InfoDict['BandPairs']) }
+
+        #dT grids sorted, with the positions in InfoDict.
+        self._dT1Order = np.argsort(InfoDict['dT1s'], kind='stable')
+        self._dT2Order = np.argsort(InfoDict['dT2s'], kind='stable')
+        self.dT1s = np.asarray(InfoDict['dT1s'])[self._dT1Order]
+        self.dT2s = np.asarray(InfoDict['dT2s'])[self._dT2Order]
+
+        #TimePairIndex[dT1 cell, dT2 cell] is the index in TimePairs, -1 if the pair is not in the cube.
+        TimePairs = np.asarray(InfoDict['TimePairs']).reshape(-1, 2)
+
+        self.TimePairIndex = np.full([len(self.dT1s), len(self.dT2s)], -1, dtype=np.int64)
+        self.TimePairIndex[ np.searchsorted(self.dT1s, TimePairs[:, 0]),
+                            np.searchsorted(self.dT2s, TimePairs[:, 1]) ] = np.arange(len(TimePairs))
+
+        self.BinMag = np.asarray(InfoDict['BinMag'])
+        self.BinColor = np.asarray(InfoDict['BinColor'])
+        self.UniformMag = IsUniform(self.BinMag)
+        self.UniformColor = IsUniform(self.BinColor)
+
+        #Plain lists for the single queries, bisect on them is faster than NumPy on scalars.
+        self._dT1List = self.dT1s.tolist()
+        self._dT2List = self.dT2s.tolist()
+        self._TimePairList = self.TimePairIndex.tolist()
+        self._BinMagList = self.BinMag.tolist()
+        self._BinColorList = self.BinColor.tolist()
+
+    #The cube as saved by CubeBuilder.SaveCube, a .cube file being memory-mapped.
+    @classmethod
+    def Load(cls, FilePath, mmap_mode='r'):
+
+        InfoDict, HashTable = LoadCube(FilePath, mmap_mode)
+
+        return cls(HashTable, InfoDict)
+
+    #Indices of HashTable for one alert, same results and errors as Enquiry.
+    #dMag or Color set to None leaves the corresponding axis whole.
+    def Index(self, Band1, Band2, dT1, dT2, dMag=None, Color=None):
+
+        if abs(dT1) > abs(dT1-dT2):
+            dT1, dT2 = dT1-dT2, -dT2
+
+        #A ValueError as InfoDict['BandPairs'].index raised in the Enquiry of the notebooks.
+        if Band1+Band2 not in self.BandPairIndex:
+            raise ValueError('The band pair {} is not in the cube, the available ones are {}.'.format(Band1+Band2, ', '.join(self.BandPairIndex)))
+
+        Ind1 = self.BandPairIndex[Band1+Band2]
+        Ind2 = self._TimePairList[ _Nearest(dT1, self._dT1List) ][ _Nearest(dT2, self._dT2List) ]
+
+        if Ind2 < 0:
+            raise ValueError('The time pair ({}, {}) is not in the cube.'.format(dT1, dT2))
+
+        Ind = (Ind1, Ind2)
+
+        if dMag is not None:
+            if dMag<self._BinMagList[0] or dMag>=self._BinMagList[-1]:
+                raise ValueError('The value of dMag is out of boundary, the available interval is [{:.2f}, {:.2f}).'.format(self._BinMagList[0], self._BinMagList[-1]))
+            Ind = Ind + (bisect_right(self._BinMagList, dMag) - 1,)
+        else:
+            Ind = Ind + (slice(None),)
+
+        if Color is not None:
+            if Color<self._BinColorList[0] or Color>=self._BinColorList[-1]:
+                raise ValueError('The value of Color is out of boundary, the available interval is [{:.2f}, {:.2f}).'.format(self._BinColorList[0], self._BinColorList[-1]))
+            Ind = Ind + (bisect_right(self._BinColorList, Color) - 1,)
+
+        return Ind
+
+    def Query(self, Band1, Band2, dT1, dT2, dMag=None, Color=None):
+        return self.HashTable[ self.Index(Band1, Band2, dT1, dT2, dMag, Color) ]
+
+    #Flat indices into HashTable for arrays of alerts, -1 for the alerts out of the cube
+    #(unknown band pair, time pair not in the cube, dMag or Color out of the bins).
+    #BandPairs is an array of band pair names such as 'gi'.
+    def IndexBatch(self, BandPairs, dT1, dT2, dMag, Color):
+
+        BandPairs = np.asarray(BandPairs)
+
+        Names, Inverse = np.unique(BandPairs, return_inverse=True)
+        Ind1 = np.array([ self.BandPairIndex.get(Name, -1) for Name in Names ], dtype=np.int64)[Inverse.reshape(BandPairs.shape)]
+
+        return self.FlatIndex(Ind1, dT1, dT2, dMag, Color)
+
+    #IndexBatch with the band pairs given as indices in InfoDict['BandPairs'] (-1 for unknown).
+    def FlatIndex(self, BandPairInd, dT1, dT2, dMag, Color):
+
+        Ind1, dT1, dT2, dMag, Color = np.broadcast_arrays(BandPairInd, dT1, dT2, dMag, Color)
+
+        Swap = np.abs(dT1) > np.abs(dT1-dT2)
+        dT1, dT2 = np.where(Swap, dT1-dT2, dT1), np.where(Swap, -dT2, dT2)
+
+        Ind2 = self.TimePairIndex[ NearestIndex(dT1, self.dT1s), NearestIndex(dT2, self.dT2s) ]
+
+        #Bins are [lo, hi) here, unlike the cube building where the last edge is included.
+        IndMag = BinIndex(np.asarray(dMag, dtype=float), self.BinMag, self.UniformMag)
+        IndMag[dMag == self.BinMag[-1]] = -1
+        IndColor = BinIndex(np.asarray(Color, dtype=float), self.BinColor, self.UniformColor)
+        IndColor[Color == self.BinColor[-1]] = -1
+
+        Shape = self.HashTable.shape
+        Ind = ((Ind1*Shape[1] + Ind2)*Shape[2] + IndMag)*Shape[3] + IndColor
+        Ind[ (Ind1 < 0) | (Ind2 < 0) | (IndMag < 0) | (IndColor < 0) ] = -1
+
+        return Ind
+
+    #HashTable values for arrays of alerts, Fill for the alerts out of the cube.
+    def QueryBatch(self, BandPairs, dT1, dT2, dMag, Color, Fill=0):
+
+        Ind = self.IndexBatch(BandPairs, dT1, dT2, dMag, Color)
+
+        Results = np.full(Ind.shape, Fill, dtype=np.result_type(self.HashTable.dtype, np.min_scalar_type(Fill)))
+        Results[Ind >= 0] = TakeFlat(self.HashTable, Ind[Ind >= 0])
+
+        return Results
+
+
+#Drop-in replacement of the Enquiry function of the notebooks. Building the index
+#costs more than one query, keep a ProbabilityCube for repeated queries.
+def Enquiry(HashTable, InfoDict, Band1, Band2, dT1, dT2, dMag=None, Color=None):
+    return ProbabilityCube(HashTable, InfoDict).Query(Band1, Band2, dT1, dT2, dMag, Color)
+
+
+#Posterior probabilities of the events for batches of alert triplets.
+#
+#An alert triplet is three observations: Mag1 in Band1 at MJD1, Mag2 in Band2 at MJD2 and
+#Mag3 in Band1 at MJD3, i.e. the Mag1, Mag2 and Mag12 of the cube building with
+#dT1 = MJD2-MJD1 and dT2 = MJD3-MJD1 in minutes. The triplets are mapped to their cube cells
+#in bulk, and the counts of the cell in the cube of every event, weighted by
+#Rate/ObjectNo as the total cube of TotalCube_V2, give the posterior of each event.
+#All the cubes must share the grids of the first one.
+class AlertClassifier:
+
+    def __init__(self, Cubes, Rates=None):
+
+        self.EventNames = list(Cubes)
+        self.Cubes = [ Cubes[EventName] for EventName in self.EventNames ]
+
+        if Rates is None:
+            Rates = {}
+
+        Ref = self.Cubes[0]
+        for EventName, Cube in zip(self.EventNames, self.Cubes):
+            if ( list(Cube.InfoDict['BandPairs']) != list(Ref.InfoDict['BandPairs'])
+                 or not np.array_equal(Cube.InfoDict['TimePairs'], Ref.InfoDict['TimePairs'])
+                 or not np.array_equal(Cube.BinMag, Ref.BinMag) or not np.array_equal(Cube.BinColor, Ref.BinColor)
+                 or Cube.HashTable.shape != Ref.HashTable.shape ):
+                raise ValueError('The cube of {} is not on the grids of the cube of {}.'.format(EventName, self.EventNames[0]))
+
+        self.Weights = np.array([ Rates.get(EventName, 1) / Cube.InfoDict['ObjectNo']
+                                  for EventName, Cube in zip(self.EventNames, self.Cubes) ], dtype=np.float32)
+
+
+        #Band pair index from the code points of the two band letters, either case.
+        self.BandPairTable = np.full([128, 128], -1, dtype=np.int64)
+        for ii, BandPair in enumerate(Ref.InfoDict['BandPairs']):
+            for B1 in {BandPair[0].lower(), BandPair[0].upper()}:
+                for B2 in {BandPair[1].lower(), BandPair[1].upper()}:
+                    self.BandPairTable[ord(B1), ord(B2)] = ii
+
+    #Cubes saved by CubeBuilder.SaveCube, named by their InfoDict['EventName'].
+    @classmethod
+    def Load(cls, FilePaths, Rates=None):
+
+        Cubes = {}
+        for FilePath in FilePaths:
+            Cube = ProbabilityCube.Load(FilePath)
+            Cubes[Cube.InfoDict['EventName']] = Cube
+
+        return cls(Cubes, Rates)
+
+    def _BandCodes(self, Bands):
+        return np.minimum(np.asarray(Bands).astype('U1').view(np.uint32), 127)
+
+    #Flat cube indices of the triplets, -1 for those out of the cube.
+    def CellIndex(self, Band1, Band2, MJD1, MJD2, MJD3, Mag1, Mag2, Mag3):
+
+        MJD1, MJD2, MJD3 = np.asarray(MJD1), np.asarray(MJD2), np.asarray(MJD3)
+        Mag1, Mag2, Mag3 = np.asarray(Mag1), np.asarray(Mag2), np.asarray(Mag3)
+
+        BandPairInd = self.BandPairTable[ self._BandCodes(Band1), self._BandCodes(Band2) ]
+
+        dT1 = (MJD2 - MJD1) * 1440
+        dT2 = (MJD3 - MJD1) * 1440
+
+        #When the third observation is the nearer one, the cube cell is referenced to it,
+        #see ProbabilityCube.Index, so is the color.
+        Swap = np.abs(dT1) > np.abs(dT1-dT2)
+
+        dMag = (Mag1 - Mag3) * np.sign(dT2)
+        Color = np.where(Swap, Mag3, Mag1) - Mag2
+
+        return self.Cubes[0].FlatIndex(BandPairInd, dT1, dT2, dMag, Color)
+
+    #Posterior probabilities [alert, event] of the triplets, in the order of EventNames.
+    #Rows of alerts out of the cube, or in a cell empty in every cube, are NaN.
+    def Classify(self, Band1, Band2, MJD1, MJD2, MJD3, Mag1, Mag2, Mag3, ChunkSize=2**20):
+
+        Inputs = np.broadcast_arrays(np.asarray(Band1), np.asarray(Band2), MJD1, MJD2, MJD3, Mag1, Mag2, Mag3)
+        Inputs = [ Input.reshape(-1) for Input in Inputs ]
+
+        AlertNo = len(Inputs[0])
+        Posterior = np.empty([AlertNo, len(self.EventNames)], dtype=np.float32)
+
+        for Lo in range(0, AlertNo, ChunkSize):
+
+            Hi = min(Lo+ChunkSize, AlertNo)
+
+            Ind = self.CellIndex(*[ Input[Lo:Hi] for Input in Inputs ])
+            Out = Ind < 0
+            Ind[Out] = 0
+
+            Chunk = Posterior[Lo:Hi]
+            for ii, Cube in enumerate(self.Cubes):
+                np.multiply(TakeFlat(Cube.HashTable, Ind), self.Weights[ii], out=Chunk[:, ii], casting='unsafe')
+
+            Total = Chunk.sum(axis=1, keepdims=True)
+            with np.errstate(invalid='ignore', divide='ignore'):
+                Chunk /= Total
+            Chunk[Out] = np.nan
+
+        return Posterior
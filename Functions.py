@@ -3,6 +3,9 @@ V220317
 """
 
 import os
+import glob
+import shutil
+import hashlib
 import numpy as np
 import matplotlib.pyplot as plt
 
@@ -10,6 +13,9 @@ from astropy.io import fits
 from astropy.table import Table
 from collections import OrderedDict as odict
 import time
+from concurrent.futures import ProcessPoolExecutor
+
+from LightCurves import AsStore, SampleTimePair, StreamTimePair
 
 def TestFunc(a, b):
     print('just for test!')
@@ -83,15 +89,13 @@ def PlotLightCurve(Path, Band, EventName=None, SeedFile=None, SeedObj=None, Prop
     TotFileNo = sum(Mask)
     
     if FileNo is None:
-        np.random.seed(SeedFile)
-        FileNo = np.random.randint(0,TotFileNo-1,RowNo)
+        FileNo = np.random.default_rng(SeedFile).integers(0,TotFileNo-1,RowNo)
     else:
         if any([II>TotFileNo for II in FileNo]):
             print('The FileNo excceed the limit.')
             
     if ObjNo is None:
-        np.random.seed(SeedObj)
-        ObjNoRatio = np.random.rand(ColNo)
+        ObjNoRatio = np.random.default_rng(SeedObj).random(ColNo)
         FigNo = len(FileNo) * len(ObjNoRatio)
     else:
         FigNo = len(FileNo) * len(ObjNo)
@@ -200,53 +204,39 @@ def PlotLightCurve(Path, Band, EventName=None, SeedFile=None, SeedObj=None, Prop
 
 
 #Calculate Map Function for the "cube"
+#If a CubeBuilder.CubeAccumulator is given as Cube, the samples are streamed into its
+#slice TimePairInd object group by object group and the Cube is returned instead of the data.
+#Mode places the samples, see LightCurves.StreamTimePair.
 def CalculateMap(Interp_load, TimeRange_load, Band1, Band2, dT1, dT2, 
-                 PointsPDay = 50, Thrs=None, ObjNo=None, SeedObj=None, SaveData=0, TargetFolder='MapData'):
-    
-    dMag = []
-    Color = []
+                 PointsPDay = 50, Thrs=None, ObjNo=None, SeedObj=None, SaveData=0, TargetFolder='MapData',
+                 Cube=None, TimePairInd=0, Mode='random'):
     
     if Thrs == None:
         Thrs = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3, 'Y': 22.1}
         
-    TotalObjNo = len(Interp_load[Band1])
+    Store = AsStore(Interp_load)
+    TotalObjNo = Store.ObjectNo
+
+    #A generator of its own, the global np.random state being shared by all threads.
+    rng = np.random.default_rng(SeedObj)
     
     if ObjNo == None:
         ObjInd = range(TotalObjNo)
     elif ObjNo < 0.1*TotalObjNo:
-        np.random.seed(SeedObj)
-        ObjInd = np.random.randint(0, TotalObjNo, size=ObjNo)
+        ObjInd = rng.integers(0, TotalObjNo, size=ObjNo)
     elif ObjNo > TotalObjNo:
         raise ValueError('The No of Objects excceeds limit. The total No is {}'.format(TotalObjNo))
     else:
         ObjInd = range(ObjNo)                                   
 
-    for II in ObjInd:
-        
-        if Interp_load[Band1][II]==[] or Interp_load[Band2][II]==[]:
-            continue
-        
-        # if II%5000 == 4999:
-        #     print('|')
-        # elif II%50 == 49:
-        #     print('|', end='' )
-
-        TimeRangeStart = max( TimeRange_load[Band1][II][0], TimeRange_load[Band2][II][0] - dT1/1440 )
-        TimeRangeEnd = min( TimeRange_load[Band1][II][1] - dT2/1440, TimeRange_load[Band2][II][1] - dT1/1440 )
-
-        TimeRange = TimeRangeEnd - TimeRangeStart
-        SampleNo = np.int(PointsPDay*TimeRange)
-        
-        XX = np.random.rand(SampleNo)*TimeRange + TimeRangeStart
-
-        Mag1 = Interp_load[Band1][II](XX)
-        Mag2 = Interp_load[Band2][II](XX+dT1/1440)
-        Mag12 = Interp_load[Band1][II](XX+dT2/1440)
-
-        Mask = (Mag1<Thrs[Band1]) * (Mag2<Thrs[Band2]) *(Mag12<Thrs[Band1])
+    if Cube is not None:
+        for dMag, Color in StreamTimePair(Store, Band1, Band2, dT1, dT2, np.asarray(ObjInd), PointsPDay, 
+                                          Thrs=Thrs, SignCorrect=False, rng=rng, Mode=Mode):
+            Cube.Add(TimePairInd, dMag, Color)
+        return Cube
 
-        dMag.extend(Mag1[Mask] - Mag12[Mask])
-        Color.extend(Mag1[Mask] - Mag2[Mask])
+    dMag, Color = SampleTimePair(Store, Band1, Band2, dT1, dT2, np.asarray(ObjInd), PointsPDay, 
+                                 Thrs=Thrs, SignCorrect=False, rng=rng, Mode=Mode)
         
     data = np.array([dMag, Color])
     
@@ -272,40 +262,24 @@ def CalculateMap(Interp_load, TimeRange_load, Band1, Band2, dT1, dT2,
 
 #Calculate Map Function for the "cube"
 def CalculateMap1(Interp_load, TimeRange_load, Band1, Band2, dT1, dT2, 
-                 PointsPDay = 50, Thr=27.5, ObjNo=None, SaveData=0, TargetFolder='MapData'):
-    
-    dMag = []
-    Color = []
+                 PointsPDay = 50, Thr=27.5, ObjNo=None, SaveData=0, TargetFolder='MapData',
+                 Cube=None, TimePairInd=0):
     
-    if ObjNo == None:
-        ObjNo = len(Interp_load[Band1])
-
-    for II in range(ObjNo):
-        
-        if Interp_load[Band1][II]==[] or Interp_load[Band2][II]==[]:
-            continue
-        
-        # if II%5000 == 4999:
-        #     print('|')
-        # elif II%50 == 49:
-        #     print('|', end='' )
-
-        TimeRangeStart = max( TimeRange_load[Band1][II][0], TimeRange_load[Band2][II][0] - dT1/1440 )
-        TimeRangeEnd = min( TimeRange_load[Band1][II][1] - dT2/1440, TimeRange_load[Band2][II][1] - dT1/1440 )
+    Store = AsStore(Interp_load)
 
-        TimeRange = TimeRangeEnd - TimeRangeStart
-        SampleNo = np.int(PointsPDay*TimeRange)
-        
-        XX = np.random.rand(SampleNo)*TimeRange + TimeRangeStart
+    if ObjNo == None:
+        ObjNo = Store.ObjectNo
 
-        Mag1 = Interp_load[Band1][II](XX)
-        Mag2 = Interp_load[Band2][II](XX+dT1/1440)
-        Mag12 = Interp_load[Band1][II](XX+dT2/1440)
+    Thrs = {Band: Thr for Band in Store.Bands}
 
-        Mask = (Mag1<Thr) * (Mag2<Thr) *(Mag12<Thr)
+    if Cube is not None:
+        for dMag, Color in StreamTimePair(Store, Band1, Band2, dT1, dT2, np.arange(ObjNo), PointsPDay, 
+                                          Thrs=Thrs, SignCorrect=False):
+            Cube.Add(TimePairInd, dMag, Color)
+        return Cube
 
-        dMag.extend(Mag1[Mask] - Mag12[Mask])
-        Color.extend(Mag1[Mask] - Mag2[Mask])
+    dMag, Color = SampleTimePair(Store, Band1, Band2, dT1, dT2, np.arange(ObjNo), PointsPDay, 
+                                 Thrs=Thrs, SignCorrect=False)
         
     data = np.array([dMag, Color])
     
@@ -385,10 +359,13 @@ def GetFileSize(Path, output=0, plot=1):
         return SizeHMB, SizePMB
     
 #Count the observation numbers of each object contained in the given path
-def GetObsNum(Path, output=0, plot=1):
+#Results: output of ScanStatistics, the files are scanned here if not given.
+def GetObsNum(Path, output=0, plot=1, Results=None):
     
     PathsDict = GetEventPaths(Path)
     Bands = ['u ', 'g ', 'r ', 'i ', 'z ', 'Y ']
+
+    Results = ScanStatistics(Path, Results=Results)
     
     ObjectNums = []
     
@@ -397,38 +374,8 @@ def GetObsNum(Path, output=0, plot=1):
     
     for Event in PathsDict:
         
-        print('Counting {:<25}'.format(Event+':'), end='')
-        start = time.time()
-
-        SubPath = PathsDict[Event]
-        FileNames = os.listdir(SubPath)
-
-        ObjectNum = 0
-        ObjObsNums = [ [] for _ in range(len(Bands)) ]
-
-        for FileName in FileNames:
-
-            Ind = FileName.find('HEAD')
-
-            if Ind > -1:                
-
-                print('|', end='')
-
-                FileNamePHOT = FileName[:Ind] + 'PHOT.FITS.gz'
-
-                HeadFilePath = os.path.join(SubPath, FileName)
-                PhotFilePath = os.path.join(SubPath, FileNamePHOT)        
-                Data = read_snana_fits(HeadFilePath, PhotFilePath)
-
-                FileObjNum = len(Data)
-                ObjectNum = ObjectNum + FileObjNum        
-
-                for Obj in Data:
-                    
-                    for II, Band in enumerate(Bands):
-                        
-                        Mask = Obj['BAND'] == Band
-                        ObjObsNums[II].append(Mask.sum())
+        ObjectNum = Results.ObjectNum[Event]
+        ObjObsNums = [ Results.Get(Event, Band, 'ObsNum') for Band in Bands ]
 
         ObjectNums.append(ObjectNum)
         
@@ -442,10 +389,6 @@ def GetObsNum(Path, output=0, plot=1):
         
 #         [ [ObsNums[II].append(ObjObsNumsMean[II]), [ObsNumStd[II].append(ObjObsNumsStd[II])] ] for II in range(len(Bands)) ]
         
-        end = time.time()
-
-        print('\t time spent: {0:6.3f} s'.format(end-start))
-        
     if plot == 1:
 
         plt.figure(figsize=(15,5))
@@ -480,7 +423,7 @@ def GetObsNum(Path, output=0, plot=1):
         
         
 # Find out the gaps between observations
-def GetObsGaps(Path, Band, Events=None, output=0, plot=1):
+def GetObsGaps(Path, Band, Events=None, output=0, plot=1, Results=None):
 
     PathsDict = GetEventPaths(Path)
     EventNames = list(PathsDict.keys())
@@ -501,48 +444,16 @@ def GetObsGaps(Path, Band, Events=None, output=0, plot=1):
         
     if isinstance(Events, str):
         Events = [Events]
+
+    Results = ScanStatistics(Path, Events, Results=Results)
     
     for Event in Events:
 
-        print('Counting {:<25}'.format(Event+':'), end='')
-        start = time.time()
-
-        SubPath = PathsDict[Event]
-        FileNames = os.listdir(SubPath)
-
-        #Start counting one type of events.
-
-        Gaps = []
-
-        for FileName in FileNames:
-
-            Ind = FileName.find('HEAD')
-
-            if Ind > -1:
-
-                print('|', end='')
-
-                FileNamePHOT = FileName[:Ind] + 'PHOT.FITS.gz'
-
-                HeadFilePath = os.path.join(SubPath, FileName)
-                PhotFilePath = os.path.join(SubPath, FileNamePHOT)        
-#                 Data = np.array(read_snana_fits(HeadFilePath, PhotFilePath))
-                Data = read_snana_fits(HeadFilePath, PhotFilePath)
-#                 Data = np.array(Data)
-        
-                for Obj in Data:
-                    Mask = Obj['BAND']==Band
-                    Gaps.append(Obj['MJD'][Mask][1:] - Obj['MJD'][Mask][:-1])    
-
-        GapsArray = np.array(Gaps)
+        GapsArray = np.array(Results.Get(Event, Band, 'Gaps'))
 
         GapMean.append(GapsArray.mean(axis=0))
         GapStd.append(GapsArray.std(axis=0, ddof=1))
 
-        end = time.time()
-
-        print('\t time spent: {0:6.3f} s'.format(end-start))
-
     GapMean = [np.round(II, 2) for II in GapMean]
     GapStd = [np.round(II, 2) for II in GapStd]
     
@@ -573,37 +484,13 @@ def GetObsGaps(Path, Band, Events=None, output=0, plot=1):
     
     
 #Find out the peak magnitudes of the objects of a given class.
-def GetPeakMag(Path, EventName, output=0, plot=1):
+def GetPeakMag(Path, EventName, output=0, plot=1, Results=None):
     
-    PathsDict = GetEventPaths(Path)
     Bands = ['u ', 'g ', 'r ', 'i ', 'z ', 'Y ']
     
-    SubPath = PathsDict[EventName]
-    FileNames = os.listdir(SubPath)
-    
-    PeakMags = [ [] for _ in range(len(Bands)) ]
-
-    for FileName in FileNames:
-
-        Ind = FileName.find('HEAD')
-
-        if Ind > -1:                
-
-            print('|', end='')
-
-            FileNamePHOT = FileName[:Ind] + 'PHOT.FITS.gz'
-
-            HeadFilePath = os.path.join(SubPath, FileName)
-            PhotFilePath = os.path.join(SubPath, FileNamePHOT)        
-            Data = read_snana_fits(HeadFilePath, PhotFilePath)
-
-
-            for Obj in Data:
+    Results = ScanStatistics(Path, EventName, Results=Results)
 
-                for II, Band in enumerate(Bands):
-
-                    MaskBand = Obj['BAND'] == Band                    
-                    PeakMags[II].append( min(Obj['SIM_MAGOBS'][MaskBand]) )
+    PeakMags = [ list(Results.Get(EventName, Band, 'PeakMag')) for Band in Bands ]
                     
     if plot == 1:
                                         
@@ -637,7 +524,7 @@ def GetPeakMag(Path, EventName, output=0, plot=1):
 
     
 #Find the range in time of the objects.
-def GetTimeRange(Path, Band, Events=None, Prop='MJD', output=0, plot=1):
+def GetTimeRange(Path, Band, Events=None, Prop='MJD', output=0, plot=1, Results=None):
     
     print('bbb')
 
@@ -658,54 +545,20 @@ def GetTimeRange(Path, Band, Events=None, Prop='MJD', output=0, plot=1):
     
     if Events == None:
         Events = list(PathsDict.keys())
+
+    Results = ScanStatistics(Path, Events, Results=Results)
     
     for Event in Events:
 
-        print('Counting {:<25}'.format(Event+':'), end='')
-        start = time.time()
-
-        SubPath = PathsDict[Event]
-        FileNames = os.listdir(SubPath)
-
-        #Start counting one type of events.
-
-        Gaps = []
-
-        Starts = []
-        Ends = []
-
-        for FileName in FileNames:
-
-            Ind = FileName.find('HEAD')
-
-            if Ind > -1:
-
-                print('|', end='')
-
-                FileNamePHOT = FileName[:Ind] + 'PHOT.FITS.gz'
-
-                HeadFilePath = os.path.join(SubPath, FileName)
-                PhotFilePath = os.path.join(SubPath, FileNamePHOT)        
-#                 Data = np.array(read_snana_fits(HeadFilePath, PhotFilePath))
-                Data = read_snana_fits(HeadFilePath, PhotFilePath)
-#                 Data = np.array(Data)
+        #Objects without observation in the band have NaN.
+        Starts = Results.Get(Event, Band, 'Start')
+        Ends = Results.Get(Event, Band, 'End')
         
-                for Obj in Data:
-                    Mask = Obj['BAND']==Band
+        StartMean.append(np.nanmean(Starts))
+        StartStd.append(np.nanstd(Starts, ddof=1))
 
-                    Starts.append(Obj['MJD'][Mask][0])
-                    Ends.append(Obj['MJD'][Mask][-1])
-
-        GapsArray = np.array(Gaps)
-        
-        StartMean.append(np.mean(Starts))
-        StartStd.append(np.std(Starts, ddof=1))
-
-        EndMean.append(np.mean(Ends))
-        EndStd.append(np.std(Ends, ddof=1))
-
-        end = time.time()
-        print('\t time spent: {0:6.3f} s'.format(end-start))
+        EndMean.append(np.nanmean(Ends))
+        EndStd.append(np.nanstd(Ends, ddof=1))
 
     if plot == 1:
 
@@ -727,42 +580,22 @@ def GetTimeRange(Path, Band, Events=None, Prop='MJD', output=0, plot=1):
     
     
     
-def CountMag99(Path, EventName):
-
-    PathsDict = GetEventPaths(Path)
-    SubPath = PathsDict[EventName]
-    
-    FileNames = os.listdir(SubPath)
-    FileNames.sort()
+def CountMag99(Path, EventName, Results=None):
 
     Bands = ['u ', 'g ', 'r ', 'i ', 'z ', 'Y ']
 
-    Mag99No = []
-
-    for FileName in FileNames[0:1]:
-
-        Ind = FileName.find('HEAD')
-
-        if Ind > -1:                
-
-            print('|', end='')
+    #The first 50 objects of the event, only its first file is read if no Results are given.
+    if Results is None:
+        Results = ScanResults(Bands)
+        Data = ReadSnanaBulk(*GetFilePairs(GetEventPaths(Path)[EventName])[0])
+        ObjInd = ObjectIndex(Data['Offsets'])
+        Results.Stats[EventName] = odict()
 
-            FileNamePHOT = FileName[:Ind] + 'PHOT.FITS.gz'
-    
-            Data = read_snana_fits(os.path.join(SubPath, FileName), os.path.join(SubPath, FileNamePHOT))
-
-            
+        for Band in Results.Bands:
+            Mask = Data['PHOT']['BAND'] == Band
+            Results.Stats[EventName][Band] = {'Mag99No': _Mag99No(None, Data['PHOT']['SIM_MAGOBS'][Mask], ObjInd[Mask], len(Data['Offsets'])-1)}
 
-            for Obj in Data[0:50]:
-
-                ObjMag99No = []
-                
-                for Band in Bands:
-                    
-                    Mask = Obj['BAND'] == Band
-                    ObjMag99No.append(sum(Obj['SIM_MAGOBS'][Mask] == 99))
-
-                Mag99No.append(ObjMag99No)
+    Mag99No = np.transpose([ Results.Get(EventName, Band, 'Mag99No')[:50] for Band in Bands ])
 
 #                 if any([ ii!=ObjMag99No[0] for ii in ObjMag99No ]):
 #                     print('Unequal Mag99 found!')
@@ -846,4 +679,231 @@ def read_snana_fits(head_file, phot_file, snids=None, n=None):
             data['FLT'][:] = np.char.strip(data['FLT'])
         sne.append(Table(data, meta=meta, copy=False))
 
-    return sne
\ No newline at end of file
+    return sne
+
+#Pair up the HEAD and PHOT files of an event folder, in the order of the file names.
+def GetFilePairs(SubPath):
+
+    FilePairs = []
+
+    for FileName in sorted(os.listdir(SubPath)):
+
+        Ind = FileName.find('HEAD')
+
+        if Ind > -1:
+            FilePairs.append( (os.path.join(SubPath, FileName),
+                               os.path.join(SubPath, FileName[:Ind] + 'PHOT.FITS.gz')) )
+    return FilePairs
+
+#Hash of the contents of the given files, used as the key of the decompressed cache.
+def FileHash(FilePaths, BlockSize=2**24):
+
+    Hash = hashlib.sha1()
+
+    for FilePath in FilePaths:
+        with open(FilePath, 'rb') as f:
+            for Block in iter(lambda: f.read(BlockSize), b''):
+                Hash.update(Block)
+
+    return Hash.hexdigest()[:16]
+
+#Native byte order and str instead of bytes, so the table can be saved as a plain .npy.
+def _NativeTable(Data, Strip=()):
+
+    Columns = []
+
+    for Name in Data.dtype.names:
+        Col = np.asarray(Data[Name])
+        if Col.dtype.kind == 'S':
+            Col = np.char.decode(Col, 'ascii')
+            if Name in Strip:
+                Col = np.char.strip(Col)
+        else:
+            Col = Col.astype(Col.dtype.newbyteorder('='))
+        Columns.append(Col)
+
+    return np.rec.fromarrays(Columns, names=Data.dtype.names).view(np.ndarray)
+
+def _Columns(Table):
+    return odict( (Name, np.ascontiguousarray(Table[Name])) for Name in Table.dtype.names )
+
+#Bulk version of read_snana_fits for one HEAD/PHOT pair.
+#Returns {'HEAD': columns, 'PHOT': columns, 'Offsets': (N+1)}, columns being odicts of
+#NumPy arrays. The PHOT rows of object ii are PHOT[Offsets[ii]:Offsets[ii+1]], i.e. rows
+#PTROBS_MIN to PTROBS_MAX of the file, the rows between objects being dropped.
+#String columns are str, SNID, FLT and BAND stripped of padding.
+#With Cache=True the decompressed tables are kept next to the PHOT file as uncompressed .npy
+#in <PHOT file>_<hash>.npycache, keyed by the hash of both files, so later reads skip gunzip.
+def ReadSnanaBulk(head_file, phot_file, Cache=True):
+
+    if Cache:
+        Prefix = phot_file[:-len('.FITS.gz')] if phot_file.endswith('.FITS.gz') else phot_file
+        CachePath = '{}_{}.npycache'.format(Prefix, FileHash([head_file, phot_file]))
+
+        if os.path.isdir(CachePath):
+            Head = np.load(os.path.join(CachePath, 'HEAD.npy'))
+            Phot = np.load(os.path.join(CachePath, 'PHOT.npy'))
+            Offsets = np.load(os.path.join(CachePath, 'Offsets.npy'))
+            return {'HEAD': _Columns(Head), 'PHOT': _Columns(Phot), 'Offsets': Offsets}
+
+    Head = _NativeTable(fits.getdata(head_file, 1, view=np.ndarray), Strip=('SNID',))
+    Phot = fits.getdata(phot_file, 1, view=np.ndarray)
+
+    Starts = Head['PTROBS_MIN'].astype(np.int64) - 1
+    Ends = Head['PTROBS_MAX'].astype(np.int64)
+    Lengths = np.maximum(Ends - Starts, 0)
+
+    Offsets = np.zeros(len(Head)+1, dtype=np.int64)
+    np.cumsum(Lengths, out=Offsets[1:])
+
+    #Row numbers of the objects' observations, all objects in one go.
+    Rows = np.arange(Offsets[-1]) + np.repeat(Starts - Offsets[:-1], Lengths)
+    Phot = _NativeTable(Phot[Rows], Strip=('FLT', 'BAND'))
+
+    if Cache:
+        try:
+            TmpPath = '{}.tmp{}'.format(CachePath, os.getpid())
+            os.makedirs(TmpPath, exist_ok=True)
+            np.save(os.path.join(TmpPath, 'HEAD.npy'), Head)
+            np.save(os.path.join(TmpPath, 'PHOT.npy'), Phot)
+            np.save(os.path.join(TmpPath, 'Offsets.npy'), Offsets)
+
+            #Caches of older versions of the files are removed.
+            for Old in glob.glob(glob.escape(Prefix) + '_*.npycache'):
+                if Old != CachePath:
+                    shutil.rmtree(Old, ignore_errors=True)
+            os.rename(TmpPath, CachePath)
+
+        except OSError:
+            #Read-only data folder, or another process wrote the cache first.
+            shutil.rmtree(TmpPath, ignore_errors=True)
+
+    return {'HEAD': _Columns(Head), 'PHOT': _Columns(Phot), 'Offsets': Offsets}
+
+#Join the outputs of ReadSnanaBulk, objects in the given order.
+def ConcatSnana(Parts):
+
+    Offsets = [np.zeros(1, dtype=np.int64)]
+    for Part in Parts:
+        Offsets.append(Part['Offsets'][1:] + Offsets[-1][-1])
+
+    return {'HEAD': odict( (Name, np.concatenate([Part['HEAD'][Name] for Part in Parts])) for Name in Parts[0]['HEAD'] ),
+            'PHOT': odict( (Name, np.concatenate([Part['PHOT'][Name] for Part in Parts])) for Name in Parts[0]['PHOT'] ),
+            'Offsets': np.concatenate(Offsets)}
+
+#Read many HEAD/PHOT pairs with ReadSnanaBulk on a process pool and join them.
+def ReadSnanaFiles(FilePairs, WorkerNo=None, Cache=True):
+
+    if WorkerNo is None:
+        WorkerNo = min(len(FilePairs), len(os.sched_getaffinity(0)))
+
+    HeadFiles = [Pair[0] for Pair in FilePairs]
+    PhotFiles = [Pair[1] for Pair in FilePairs]
+
+    if WorkerNo > 1:
+        with ProcessPoolExecutor(max_workers=WorkerNo) as Pool:
+            Parts = list(Pool.map(ReadSnanaBulk, HeadFiles, PhotFiles, [Cache]*len(FilePairs)))
+    else:
+        Parts = [ReadSnanaBulk(HeadFile, PhotFile, Cache) for HeadFile, PhotFile in FilePairs]
+
+    return ConcatSnana(Parts)
+
+#Object number of every PHOT row.
+def ObjectIndex(Offsets):
+    return np.repeat(np.arange(len(Offsets)-1), np.diff(Offsets))
+
+
+#Per-band statistics computed by ScanStatistics, each one called with the observations of
+#one band (MJD, Mag, object number of each row, sorted by object) and the number of objects.
+#A new statistic only needs to be registered here.
+def _ObsNum(MJD, Mag, ObjInd, ObjectNum):
+    return np.bincount(ObjInd, minlength=ObjectNum)
+
+def _Gaps(MJD, Mag, ObjInd, ObjectNum):
+    Gaps = np.diff(MJD)[ ObjInd[1:] == ObjInd[:-1] ]
+    GapNo = np.maximum(np.bincount(ObjInd, minlength=ObjectNum) - 1, 0)
+    return np.split(Gaps, np.cumsum(GapNo)[:-1])
+
+def _PeakMag(MJD, Mag, ObjInd, ObjectNum):
+    PeakMag = np.full(ObjectNum, np.inf, dtype=Mag.dtype)
+    np.minimum.at(PeakMag, ObjInd, Mag)
+    return PeakMag
+
+def _Start(MJD, Mag, ObjInd, ObjectNum):
+    Start = np.full(ObjectNum, np.nan)
+    Objs = np.unique(ObjInd)
+    Start[Objs] = MJD[ np.searchsorted(ObjInd, Objs, side='left') ]
+    return Start
+
+def _End(MJD, Mag, ObjInd, ObjectNum):
+    End = np.full(ObjectNum, np.nan)
+    Objs = np.unique(ObjInd)
+    End[Objs] = MJD[ np.searchsorted(ObjInd, Objs, side='right') - 1 ]
+    return End
+
+def _Mag99No(MJD, Mag, ObjInd, ObjectNum):
+    return np.bincount(ObjInd[Mag == 99], minlength=ObjectNum)
+
+BandStatistics = odict([ ('ObsNum', _ObsNum), ('Gaps', _Gaps), ('PeakMag', _PeakMag),
+                         ('Start', _Start), ('End', _End), ('Mag99No', _Mag99No) ])
+
+#Output of ScanStatistics.
+#ObjectNum[Event] is the number of objects, Stats[Event][Band][Name] the statistic Name of
+#every object of the event in Band, Band given without the trailing space.
+class ScanResults:
+
+    def __init__(self, Bands):
+        self.Bands = [Band.strip() for Band in Bands]
+        self.ObjectNum = odict()
+        self.Stats = odict()
+
+    @property
+    def Events(self):
+        return list(self.Stats)
+
+    def Get(self, Event, Band, Name):
+        return self.Stats[Event][Band.strip()][Name]
+
+#Read every event under Path once and compute all the statistics in BandStatistics.
+#The results can be given to GetObsNum, GetObsGaps, GetPeakMag, GetTimeRange and CountMag99
+#to plot them without reading the files again.
+def ScanStatistics(Path, Events=None, Bands=['u ', 'g ', 'r ', 'i ', 'z ', 'Y '], Prop='SIM_MAGOBS',
+                   WorkerNo=None, Cache=True, Results=None):
+
+    PathsDict = GetEventPaths(Path)
+
+    if Events is None:
+        Events = list(PathsDict.keys())
+
+    if isinstance(Events, str):
+        Events = [Events]
+
+    if Results is None:
+        Results = ScanResults(Bands)
+
+    for Event in Events:
+
+        if Event in Results.Stats:
+            continue
+
+        print('Scanning {:<25}'.format(Event+':'), end='')
+        start = time.time()
+
+        Data = ReadSnanaFiles(GetFilePairs(PathsDict[Event]), WorkerNo=WorkerNo, Cache=Cache)
+
+        ObjectNum = len(Data['Offsets']) - 1
+        ObjInd = ObjectIndex(Data['Offsets'])
+
+        Results.ObjectNum[Event] = ObjectNum
+        Results.Stats[Event] = odict()
+
+        for Band in Results.Bands:
+
+            Mask = Data['PHOT']['BAND'] == Band
+            Args = (Data['PHOT']['MJD'][Mask], Data['PHOT'][Prop][Mask], ObjInd[Mask], ObjectNum)
+
+            Results.Stats[Event][Band] = odict( (Name, Func(*Args)) for Name, Func in BandStatistics.items() )
+
+        print('\t time spent: {0:6.3f} s'.format(time.time()-start))
+
+    return Results
@@ -0,0 +1,595 @@
+"""
+Packed, array-backed light curves for the probability cube.
+
+The light curves of one event are stored band by band as flat arrays, the
+knots of object II being MJD[Band][Offsets[Band][II]:Offsets[Band][II+1]].
+Objects whose band has fewer than two effective points have an empty slice,
+which plays the role of the [] placeholder in the old <Event>_Interp.pkl.
+
+On disk the same arrays are kept as a light-curve archive, a folder
+<Event>_LC holding one .npy file per band and array plus Info.json, so that
+workers can open it with np.load(mmap_mode='r') and page in only the objects
+they use.
+"""
+
+import os
+import sys
+import time
+import json
+import pickle
+import numpy as np
+from collections import OrderedDict
+
+Bands = ['u', 'g', 'r', 'i', 'z', 'Y']
+
+Thrs = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3, 'Y': 22.1}
+
+
+class LightCurveStore:
+
+    def __init__(self, MJD, Mag, Offsets, TimeRange=None, Bands=Bands):
+
+        self.Bands = list(Bands)
+        self.MJD = MJD
+        self.Mag = Mag
+        self.Offsets = Offsets
+
+        self.ObjectNo = len(Offsets[self.Bands[0]]) - 1
+
+        self.TimeRange = {}
+        self.Valid = {}
+        self._Keys = {}
+        self._Bright = {}
+
+        #Time window of every object in each band as contiguous float64 arrays, the
+        #columns of TimeRange, for the vectorized overlaps of Overlap and OverlapMask.
+        self.Start = {}
+        self.End = {}
+
+        for Band in self.Bands:
+
+            Start = np.asarray(Offsets[Band][:-1])
+            End = np.asarray(Offsets[Band][1:])
+
+            Valid = End - Start >= 2
+
+            if TimeRange is None:
+                BandRange = np.zeros([self.ObjectNo, 2])
+                BandRange[Valid, 0] = MJD[Band][Start[Valid]]
+                BandRange[Valid, 1] = MJD[Band][End[Valid]-1]
+            else:
+                BandRange = np.asarray(TimeRange[Band])
+
+            self.Valid[Band] = Valid
+            self.TimeRange[Band] = BandRange
+            self.Start[Band] = np.ascontiguousarray(BandRange[:, 0], dtype=np.float64)
+            self.End[Band] = np.ascontiguousarray(BandRange[:, 1], dtype=np.float64)
+
+        #Width reserved for each object on the key axis, see Keys().
+        Durations = [ (self.TimeRange[Band][:, 1] - self.TimeRange[Band][:, 0]).max(initial=0) for Band in self.Bands ]
+        self.Span = 2*max(Durations) + 1
+
+    # Build the store from the dicts loaded from <Event>_Interp.pkl.
+    @classmethod
+    def FromInterp(cls, Interp_load):
+
+        MJD = {}
+        Mag = {}
+        Offsets = {}
+
+        for Band in Interp_load:
+
+            Lengths = [0 if Interp==[] else len(Interp.x) for Interp in Interp_load[Band]]
+
+            Offsets[Band] = np.zeros(len(Lengths)+1, dtype=np.int64)
+            np.cumsum(Lengths, out=Offsets[Band][1:])
+
+            MJD[Band] = np.empty(Offsets[Band][-1])
+            Mag[Band] = np.empty(Offsets[Band][-1])
+
+            for II, Interp in enumerate(Interp_load[Band]):
+                if Interp==[]:
+                    continue
+                MJD[Band][Offsets[Band][II]:Offsets[Band][II+1]] = Interp.x
+                Mag[Band][Offsets[Band][II]:Offsets[Band][II+1]] = Interp.y
+
+        return cls(MJD, Mag, Offsets, Bands=list(Interp_load.keys()))
+
+    # Open a light-curve archive written by Save(). With mmap_mode='r' nothing
+    # but the offsets and time ranges is read until the knots are used.
+    @classmethod
+    def Load(cls, Path, mmap_mode='r'):
+
+        with open(os.path.join(Path, 'Info.json')) as f:
+            Info = json.load(f)
+
+        MJD = {}
+        Mag = {}
+        Offsets = {}
+        TimeRange = {}
+
+        for Band in Info['Bands']:
+            MJD[Band] = np.load(os.path.join(Path, Band+'_MJD.npy'), mmap_mode=mmap_mode)
+            Mag[Band] = np.load(os.path.join(Path, Band+'_Mag.npy'), mmap_mode=mmap_mode)
+            Offsets[Band] = np.load(os.path.join(Path, Band+'_Offsets.npy'))
+            TimeRange[Band] = np.load(os.path.join(Path, Band+'_TimeRange.npy'))
+
+        return cls(MJD, Mag, Offsets, TimeRange=TimeRange, Bands=Info['Bands'])
+
+    # Join stores of the same bands into one in-memory store, the objects of
+    # Stores[0] first, then those of Stores[1], and so on.
+    @classmethod
+    def Concatenate(cls, Stores):
+
+        MJD = {}
+        Mag = {}
+        Offsets = {}
+        TimeRange = {}
+
+        for Band in Stores[0].Bands:
+
+            Shifts = np.cumsum([0] + [ Store.Offsets[Band][-1] for Store in Stores[:-1] ])
+
+            MJD[Band] = np.concatenate([ np.asarray(Store.MJD[Band], dtype=np.float64) for Store in Stores ])
+            Mag[Band] = np.concatenate([ np.asarray(Store.Mag[Band], dtype=np.float64) for Store in Stores ])
+            Offsets[Band] = np.concatenate([ [0] ] + [ Store.Offsets[Band][1:] + Shift for Store, Shift in zip(Stores, Shifts) ]).astype(np.int64)
+            TimeRange[Band] = np.concatenate([ Store.TimeRange[Band] for Store in Stores ])
+
+        return cls(MJD, Mag, Offsets, TimeRange=TimeRange, Bands=Stores[0].Bands)
+
+    # Write the store as a light-curve archive folder.
+    def Save(self, Path, MagDtype=np.float64, EventName=None):
+
+        os.makedirs(Path, exist_ok=True)
+
+        for Band in self.Bands:
+            np.save(os.path.join(Path, Band+'_MJD.npy'), np.asarray(self.MJD[Band], dtype=np.float64))
+            np.save(os.path.join(Path, Band+'_Mag.npy'), np.asarray(self.Mag[Band], dtype=MagDtype))
+            np.save(os.path.join(Path, Band+'_Offsets.npy'), np.asarray(self.Offsets[Band], dtype=np.int64))
+            np.save(os.path.join(Path, Band+'_TimeRange.npy'), self.TimeRange[Band])
+
+        Info = {'Version': 1, 'EventName': EventName, 'Bands': self.Bands, 'ObjectNo': self.ObjectNo}
+
+        with open(os.path.join(Path, 'Info.json'), 'w') as f:
+            json.dump(Info, f, indent=1)
+
+    # Copy the objects of the given indices into a compact in-memory store,
+    # object Objects[II] becoming object II. On a memory-mapped archive only
+    # the knots of these objects are read from disk.
+    def Select(self, Objects):
+
+        Objects = np.asarray(Objects)
+
+        MJD = {}
+        Mag = {}
+        Offsets = {}
+        TimeRange = {}
+
+        for Band in self.Bands:
+
+            Start = self.Offsets[Band][Objects]
+            Lengths = self.Offsets[Band][Objects+1] - Start
+
+            Offsets[Band] = np.zeros(len(Objects)+1, dtype=np.int64)
+            np.cumsum(Lengths, out=Offsets[Band][1:])
+
+            Ind = np.repeat(Start - Offsets[Band][:-1], Lengths) + np.arange(Offsets[Band][-1])
+
+            MJD[Band] = np.asarray(self.MJD[Band][Ind], dtype=np.float64)
+            Mag[Band] = np.asarray(self.Mag[Band][Ind], dtype=np.float64)
+            TimeRange[Band] = self.TimeRange[Band][Objects]
+
+        return LightCurveStore(MJD, Mag, Offsets, TimeRange=TimeRange, Bands=self.Bands)
+
+    # Bytes held in memory, memory-mapped arrays not counted.
+    def MemorySize(self):
+
+        Arrays = [self.MJD, self.Mag, self.Offsets, self.TimeRange, self._Keys]
+        return ( sum( Array[Band].nbytes for Array in Arrays for Band in Array if not isinstance(Array[Band], np.memmap) )
+                 + sum( Array.nbytes for Index in self._Bright.values() for Array in Index ) )
+
+    # Sort keys of the knots, strictly increasing over the whole band, so a
+    # single searchsorted finds the segment of every (object, time) sample.
+    def Keys(self, Band):
+
+        if Band not in self._Keys:
+
+            Lengths = np.diff(self.Offsets[Band])
+            Owner = np.repeat(np.arange(self.ObjectNo), Lengths)
+
+            self._Keys[Band] = Owner*self.Span + (self.MJD[Band] - self.TimeRange[Band][Owner, 0])
+
+        return self._Keys[Band]
+
+    # Evaluate the linear interpolants of Band for the objects ObjInd at the
+    # times XX (both arrays of the same length), as interp1d would.
+    # Samples out of the time range of their object are set to Fill.
+    def Interpolate(self, Band, ObjInd, XX, Fill=np.nan):
+
+        ObjInd = np.asarray(ObjInd)
+        XX = np.asarray(XX, dtype=np.float64)
+
+        Keys = self.Keys(Band)
+        Offsets = self.Offsets[Band]
+        MJD = self.MJD[Band]
+        Mag = self.Mag[Band]
+
+        Start = self.TimeRange[Band][ObjInd, 0]
+        End = self.TimeRange[Band][ObjInd, 1]
+
+        Valid = self.Valid[Band][ObjInd] & (XX >= Start) & (XX <= End)
+        if not Valid.any():
+            return np.full(len(XX), Fill, dtype=np.float64)
+
+        #interp1d convention: the segment [Ind-1, Ind] with Ind from the left-side search.
+        Ind = np.searchsorted(Keys, ObjInd*self.Span + (XX - Start))
+        Ind = np.clip(Ind, Offsets[ObjInd]+1, np.maximum(Offsets[ObjInd+1]-1, Offsets[ObjInd]+1))
+        Ind[~Valid] = Offsets[-1]-1
+
+        XLo = MJD[Ind-1]
+        YLo = Mag[Ind-1]
+        Slope = (Mag[Ind] - YLo) / (MJD[Ind] - XLo)
+
+        Results = Slope*(XX - XLo) + YLo
+        Results[~Valid] = Fill
+
+        return Results
+
+    # Brightness index of Band for the detection limit Thr, computed once: the
+    # intervals where the linear curve of each object is brighter than Thr
+    # (Mag < Thr), merged where they touch, as flat Starts and Ends arrays, those
+    # of object II being Starts[Offsets[II]:Offsets[II+1]].
+    def BrightWindows(self, Band, Thr):
+        return self._BrightIndex(Band, Thr)[:3]
+
+    # First and last time each object is brighter than Thr in Band, inf and
+    # -inf for the objects which never are.
+    def BrightRange(self, Band, Thr):
+        return self._BrightIndex(Band, Thr)[3:]
+
+    def _BrightIndex(self, Band, Thr):
+
+        if (Band, Thr) not in self._Bright:
+
+            MJD = np.asarray(self.MJD[Band], dtype=np.float64)
+            Mag = np.asarray(self.Mag[Band], dtype=np.float64)
+
+            Owner = np.repeat(np.arange(self.ObjectNo), np.diff(self.Offsets[Band]))
+            Seg = np.flatnonzero(Owner[1:] == Owner[:-1])
+
+            #Bright part of every segment between two knots.
+            Lo, Hi = BelowThr(Mag[Seg], Mag[Seg+1], Thr)
+            Keep = Hi > Lo
+            Seg, Lo, Hi = Seg[Keep], Lo[Keep], Hi[Keep]
+
+            Starts = MJD[Seg] + Lo*(MJD[Seg+1] - MJD[Seg])
+            Ends = MJD[Seg] + Hi*(MJD[Seg+1] - MJD[Seg])
+            Owner = Owner[Seg]
+
+            New = np.ones(len(Seg), dtype=bool)
+            New[1:] = (Owner[1:] != Owner[:-1]) | (Starts[1:] != Ends[:-1])
+            Last = np.append(np.flatnonzero(New)[1:] - 1, len(Seg) - 1)
+            Starts, Ends = Starts[New], Ends[Last]
+
+            Offsets = np.zeros(self.ObjectNo+1, dtype=np.int64)
+            np.cumsum(np.bincount(Owner[New], minlength=self.ObjectNo), out=Offsets[1:])
+
+            Some = Offsets[1:] > Offsets[:-1]
+            BrightStart = np.full(self.ObjectNo, np.inf)
+            BrightEnd = np.full(self.ObjectNo, -np.inf)
+            BrightStart[Some] = Starts[Offsets[:-1][Some]]
+            BrightEnd[Some] = Ends[Offsets[1:][Some] - 1]
+
+            self._Bright[Band, Thr] = (Starts, Ends, Offsets, BrightStart, BrightEnd)
+
+        return self._Bright[Band, Thr]
+
+    # Peak (smallest) magnitude of every object in Band, inf without knots.
+    def Peak(self, Band):
+
+        Lengths = np.diff(self.Offsets[Band])
+        Peak = np.full(self.ObjectNo, np.inf)
+
+        if Lengths.sum() > 0:
+            Some = Lengths > 0
+            Peak[Some] = np.minimum.reduceat(np.asarray(self.Mag[Band], dtype=np.float64), self.Offsets[Band][:-1][Some])
+
+        return Peak
+
+    # Time ranges of Band1 and Band2 for the objects Objects, narrowed to the
+    # part brighter than Thrs if given.
+    def _Ranges(self, Band1, Band2, Objects, Thrs=None):
+
+        Ranges = []
+
+        for Band in [Band1, Band2]:
+
+            Start, End = self.Start[Band][Objects], self.End[Band][Objects]
+
+            if Thrs is not None:
+                BrightStart, BrightEnd = self.BrightRange(Band, Thrs[Band])
+                Start, End = np.maximum(Start, BrightStart[Objects]), np.minimum(End, BrightEnd[Objects])
+
+            Ranges += [Start, End]
+
+        return Ranges
+
+    # Start and end of the window where Band1 at t, Band2 at t+dT1 and Band1
+    # at t+dT2 (dT in minutes) are all defined, and with Thrs all brighter
+    # than the limits somewhere in their ranges (see BrightRange): out of it
+    # every sample fails the Thrs mask.
+    def Overlap(self, Band1, Band2, dT1, dT2, Objects, Thrs=None):
+
+        Start1, End1, Start2, End2 = self._Ranges(Band1, Band2, Objects, Thrs)
+
+        Start = np.maximum(np.maximum(Start1, Start2 - dT1/1440), Start1 - dT2/1440)
+        End = np.minimum(np.minimum(End1, End1 - dT2/1440), End2 - dT1/1440)
+
+        #Objects never bright enough have infinite bounds, their window is set empty.
+        Valid = self.Valid[Band1][Objects] & self.Valid[Band2][Objects]
+        if Thrs is not None:
+            Valid &= np.isfinite(Start) & np.isfinite(End)
+            Start[~Valid] = 0
+        End[~Valid] = Start[~Valid]
+
+        return Start, End
+
+    # [Object, TimePair] mask of the objects whose window of Overlap is not
+    # empty, for all the time pairs [[dT1, dT2], ...] at once. Computed for
+    # ChunkSize objects at a time and reduced by Reduce(Mask, Lo, Hi).
+    def _OverlapChunks(self, Band1, Band2, TimePairs, Objects, Reduce, ChunkSize=1024, Thrs=None):
+
+        TimePairs = np.asarray(TimePairs, dtype=np.float64).reshape(-1, 2) / 1440
+        dT1 = TimePairs[None, :, 0]
+        dT2 = TimePairs[None, :, 1]
+
+        #Only the bounds which depend on dT are computed per time pair.
+        for Lo in range(0, len(Objects), ChunkSize):
+
+            Chunk = Objects[Lo:Lo+ChunkSize]
+
+            Start1, End1, Start2, End2 = [ Bound[:, None] for Bound in self._Ranges(Band1, Band2, Chunk, Thrs) ]
+
+            Mask = ( np.minimum(End1 - np.maximum(dT2, 0), End2 - dT1)
+                     > np.maximum(Start1 - np.minimum(dT2, 0), Start2 - dT1) )
+            Mask &= (self.Valid[Band1][Chunk] & self.Valid[Band2][Chunk])[:, None]
+
+            Reduce(Mask, Lo, Lo+len(Chunk))
+
+    # The objects of Objects (all by default) with a non-empty window for at
+    # least one of TimePairs: the others add no sample to the cube. With Thrs
+    # the objects never bright enough at the times needed are left out too.
+    def OverlapMask(self, Band1, Band2, TimePairs, Objects=None, Thrs=None):
+
+        Objects = np.arange(self.ObjectNo) if Objects is None else np.asarray(Objects)
+        Any = np.zeros(len(Objects), dtype=bool)
+
+        def Reduce(Mask, Lo, Hi):
+            Any[Lo:Hi] = Mask.any(axis=1)
+
+        self._OverlapChunks(Band1, Band2, TimePairs, Objects, Reduce, Thrs=Thrs)
+
+        return Any
+
+    # Number of the objects of Objects (all by default) contributing samples
+    # to each of TimePairs.
+    def OverlapCounts(self, Band1, Band2, TimePairs, Objects=None, Thrs=None):
+
+        Objects = np.arange(self.ObjectNo) if Objects is None else np.asarray(Objects)
+        Counts = np.zeros(len(np.asarray(TimePairs).reshape(-1, 2)), dtype=np.int64)
+
+        def Reduce(Mask, Lo, Hi):
+            Counts[:] += Mask.sum(axis=0)
+
+        self._OverlapChunks(Band1, Band2, TimePairs, Objects, Reduce, Thrs=Thrs)
+
+        return Counts
+
+
+# [Lo, Hi] of the fractions u in [0, 1] of the linear pieces going from V0 to
+# V1 where V0 + (V1 - V0)*u < Thr, Hi <= Lo where there are none.
+def BelowThr(V0, V1, Thr):
+
+    with np.errstate(divide='ignore', invalid='ignore'):
+        u = (Thr - V0) / (V1 - V0)
+
+    Lo = np.where(V0 < Thr, 0.0, np.where(V1 < Thr, u, 1.0))
+    Hi = np.where(V1 < Thr, 1.0, np.where(V0 < Thr, u, 0.0))
+
+    return Lo, Hi
+
+
+# Accept either a LightCurveStore or the Interp_load dict of a pickle, so the
+# store can be built once and reused for many calls.
+def AsStore(Interp_load):
+
+    if isinstance(Interp_load, LightCurveStore):
+        return Interp_load
+    return LightCurveStore.FromInterp(Interp_load)
+
+
+# Load the light curves of one event, either from a light-curve archive folder
+# or from an old <Event>_Interp.pkl.
+def LoadEvent(Path, mmap_mode='r'):
+
+    if Path.endswith('.pkl'):
+        with open(Path, 'rb') as f:
+            Interp_load = pickle.load(f)
+        return LightCurveStore.FromInterp(Interp_load)
+
+    return LightCurveStore.Load(Path, mmap_mode=mmap_mode)
+
+
+# Events already loaded by this process, least recently used first:
+# (Path, mtime): (Store, bytes in memory).
+_Cache = OrderedDict()
+
+# Memory allowed to the cache of each process, a quarter of the RAM by default.
+CacheBytes = os.sysconf('SC_PAGE_SIZE') * os.sysconf('SC_PHYS_PAGES') // 4
+
+
+# LoadEvent keeping the stores in a per-process LRU cache, so the tasks of a
+# worker load each event only once. An entry is replaced when its file
+# changes, and the least recently used events are dropped once the cache
+# holds more than MaxBytes.
+def LoadEventCached(Path, MaxBytes=None):
+
+    if MaxBytes is None:
+        MaxBytes = CacheBytes
+
+    StampPath = Path if Path.endswith('.pkl') else os.path.join(Path, 'Info.json')
+    Key = (Path, os.path.getmtime(StampPath))
+
+    if Key in _Cache:
+        _Cache.move_to_end(Key)
+        return _Cache[Key][0]
+
+    for OldKey in [OldKey for OldKey in _Cache if OldKey[0] == Path]:
+        del _Cache[OldKey]
+
+    Store = LoadEvent(Path)
+    _Cache[Key] = (Store, Store.MemorySize())
+
+    while len(_Cache) > 1 and sum(Size for _, Size in _Cache.values()) > MaxBytes:
+        _Cache.popitem(last=False)
+
+    return Store
+
+
+# Convert an <Event>_Interp.pkl into the light-curve archive <Event>_LC.
+def ConvertInterpPickle(PklPath, ArchivePath=None, MagDtype=np.float64):
+
+    if ArchivePath is None:
+        ArchivePath = PklPath[:PklPath.rfind('_Interp.pkl')] + '_LC'
+
+    EventName = os.path.basename(ArchivePath)[:-3]
+
+    Store = LoadEvent(PklPath)
+    Store.Save(ArchivePath, MagDtype=MagDtype, EventName=EventName)
+
+    return ArchivePath
+
+
+# Draw the random samples of all objects for one (Band1, Band2, dT1, dT2) and
+# return their dMag and Color, replacing the per-object loop of CalculateMap.
+def SampleTimePair(Store, Band1, Band2, dT1, dT2, Objects, PointsPerDay, Thrs=Thrs, SignCorrect=True, rng=None,
+                   Mode='random', Bright=True):
+
+    Chunks = list(StreamTimePair(Store, Band1, Band2, dT1, dT2, Objects, PointsPerDay, 
+                                 Thrs=Thrs, SignCorrect=SignCorrect, ChunkSize=None, rng=rng, Mode=Mode, Bright=Bright))
+
+    if not Chunks:
+        return np.zeros(0), np.zeros(0)
+
+    return np.concatenate([Chunk[0] for Chunk in Chunks]), np.concatenate([Chunk[1] for Chunk in Chunks])
+
+
+# Uniform numbers in [0, 1) for the samples SampleInd of the objects ObjectIDs
+# under the uint64 Key, from a counter-based generator (splitmix64 of the key,
+# the object and the sample): each sample gets the same number however the
+# objects are split into tasks, which no sequential generator can give.
+def CounterUniform(Key, ObjectIDs, SampleInd):
+
+    def Mix(z):
+        z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+        z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+        return z ^ (z >> np.uint64(31))
+
+    Golden = np.uint64(0x9E3779B97F4A7C15)
+
+    with np.errstate(over='ignore'):
+        z = Mix(np.asarray(ObjectIDs, dtype=np.uint64) * Golden + np.uint64(Key))
+        z = Mix(z + (np.asarray(SampleInd, dtype=np.uint64) + np.uint64(1)) * Golden)
+
+    return (z >> np.uint64(11)) * (1.0 / 2**53)
+
+
+# Same samples as SampleTimePair, yielded as (dMag, Color) for consecutive
+# groups of objects holding at most ChunkSize samples (an object with more
+# samples than that is a group of its own), so the memory used does not grow
+# with the number of objects. ChunkSize=None gives one group.
+# The sample times are drawn from rng (a np.random.Generator), from np.random if
+# None. With a Key they come from CounterUniform instead, ObjectIDs (Objects by
+# default) being the indices of the objects in the whole event, so the samples
+# of an object do not depend on the other objects of the call.
+# The N = int(PointsPerDay*window) samples of an object are placed by Mode:
+#   'random':     uniformly at random over its window;
+#   'stratified': one uniformly at random in each of N equal parts of the window;
+#   'grid':       at the centres of the N parts, no random number needed.
+# The last two cover the window evenly, so the cube converges with fewer samples.
+# With Bright the window is narrowed to the bright parts of the bands (see
+# LightCurveStore.BrightRange), out of which every sample fails the Thrs mask:
+# the samples keep their density of PointsPerDay, so the cube is the same on
+# average, with no sample spent on faint phases.
+SamplingModes = ['random', 'stratified', 'grid']
+
+def StreamTimePair(Store, Band1, Band2, dT1, dT2, Objects, PointsPerDay, Thrs=Thrs, SignCorrect=True, 
+                   ChunkSize=2**20, rng=None, Key=None, ObjectIDs=None, Mode='random', Bright=True):
+
+    if Mode not in SamplingModes:
+        raise ValueError('Unknown sampling mode {}, use one of {}.'.format(Mode, SamplingModes))
+
+    Objects = np.asarray(Objects)
+    ObjectIDs = Objects if ObjectIDs is None else np.asarray(ObjectIDs)
+
+    Start, End = Store.Overlap(Band1, Band2, dT1, dT2, Objects, Thrs=Thrs if Bright else None)
+    TimeRange = End - Start
+
+    Mask = TimeRange > 0
+    Objects, ObjectIDs, Start, TimeRange = Objects[Mask], ObjectIDs[Mask], Start[Mask], TimeRange[Mask]
+
+    SampleNos = (PointsPerDay*TimeRange).astype(np.int64)
+    FirstSample = np.cumsum(SampleNos) - SampleNos
+
+    if ChunkSize is None:
+        Bounds = [0, len(Objects)]
+    else:
+        Cumulative = np.cumsum(SampleNos)
+        Bounds = [0]
+        while Bounds[-1] < len(Objects):
+            Done = Cumulative[Bounds[-1]-1] if Bounds[-1] > 0 else 0
+            Bounds.append(max(Bounds[-1]+1, int(np.searchsorted(Cumulative, Done+ChunkSize, side='right'))))
+
+    for Lo, Hi in zip(Bounds[:-1], Bounds[1:]):
+
+        Owner = np.repeat(np.arange(Lo, Hi), SampleNos[Lo:Hi])
+        if len(Owner) == 0:
+            continue
+
+        SampleInd = np.arange(len(Owner)) + FirstSample[Lo] - FirstSample[Owner]
+
+        if Mode == 'grid':
+            Uniform = np.full(len(Owner), 0.5)
+        elif Key is None:
+            Uniform = (np.random if rng is None else rng).random(len(Owner))
+        else:
+            Uniform = CounterUniform(Key, ObjectIDs[Owner], SampleInd)
+
+        if Mode != 'random':
+            Uniform = (SampleInd + Uniform) / SampleNos[Owner]
+
+        XX = Uniform*TimeRange[Owner] + Start[Owner]
+        ObjInd = Objects[Owner]
+
+        Mag1 = Store.Interpolate(Band1, ObjInd, XX)
+        Mag2 = Store.Interpolate(Band2, ObjInd, XX+dT1/1440)
+        Mag12 = Store.Interpolate(Band1, ObjInd, XX+dT2/1440)
+
+        Mask = (Mag1<Thrs[Band1]) * (Mag2<Thrs[Band2]) * (Mag12<Thrs[Band1])
+
+        dMag = Mag1[Mask] - Mag12[Mask]
+        if SignCorrect:
+            dMag *= np.sign(dT2)
+        Color = Mag1[Mask] - Mag2[Mask]
+
+        yield dMag, Color
+
+
+#Usage: python LightCurves.py <Event>_Interp.pkl [<Event>_Interp.pkl ...]
+if __name__ == '__main__':
+
+    for PklPath in sys.argv[1:]:
+
+        start = time.time()
+        ArchivePath = ConvertInterpPickle(PklPath)
+        print('{} -> {}\t time spent: {:6.3f} s'.format(PklPath, ArchivePath, time.time()-start))
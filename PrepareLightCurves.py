@@ -0,0 +1,195 @@
+import os
+import sys
+import time
+import shutil
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+from Functions import GetEventPaths, GetFilePairs, ReadSnanaBulk, ObjectIndex
+from LightCurves import LightCurveStore
+
+#Preprocessing of the SNANA simulations into the light-curve archives <Event>_LC read by the
+#cube builders (see LightCurves.LightCurveStore), in place of the <Event>_Interp.pkl of
+#Data_Interpolate_and_Serialization.ipynb. The knots are the same as those of the notebook's
+#interp1d: in each band the observations of an object with a magnitude, objects with fewer
+#than two of them left empty. Every (event, HEAD file) pair is converted by a process pool into
+#the shard TargetFolder/Shards/<Event>/<HEAD file>_LC, and the shards of an event are joined
+#in the order of the files into TargetFolder/<Event>_LC once all of them are written. Shards
+#and archives already written are kept, so a killed run is finished by running it again.
+#Usage: python PrepareLightCurves.py SourcePath TargetFolder [WorkerNo]
+
+#########################################################
+#Parameter setting
+
+SourcePath = '/global/homes/l/lianming/data/GSN_IDEAL_zALL_p1day'
+TargetFolder = '/global/cscratch1/sd/lianming/data/2Day_Interp'
+
+#None for all the events of SourcePath, see Functions.GetEventPaths.
+EventNames = None
+
+Bands = ['u', 'g', 'r', 'i', 'z', 'Y']
+
+Prop = 'SIM_MAGOBS'
+MagNull = 99            #magnitude of the observations where the object is not seen
+
+MagDtype = np.float64
+
+#Number of processes, all the cores available by default.
+WorkerNo = len(os.sched_getaffinity(0))
+
+#Keep the decompressed tables next to the PHOT files, see Functions.ReadSnanaBulk.
+Cache = False
+
+#The shards of an event are removed once its archive is written.
+KeepShards = False
+
+#########################################################
+#Functions
+
+def ArchivePath(EventName, TargetFolder=TargetFolder):
+    return os.path.join(TargetFolder, EventName+'_LC')
+
+def ShardPath(EventName, HeadFile, TargetFolder=TargetFolder):
+    FileName = os.path.basename(HeadFile)
+    return os.path.join(TargetFolder, 'Shards', EventName, FileName[:FileName.find('HEAD')] + 'LC')
+
+#Write the store through a temporary folder renamed at the end, so a killed process never
+#leaves an archive that looks finished.
+def SaveStore(Store, Path, EventName):
+
+    TmpPath = '{}.tmp{}'.format(Path, os.getpid())
+    shutil.rmtree(TmpPath, ignore_errors=True)
+
+    Store.Save(TmpPath, MagDtype=MagDtype, EventName=EventName)
+    os.rename(TmpPath, Path)
+
+#The knots of every band of the objects of one HEAD/PHOT pair, as a store.
+def ConvertFile(HeadFile, PhotFile, Bands=Bands):
+
+    Data = ReadSnanaBulk(HeadFile, PhotFile, Cache=Cache)
+
+    ObjectNo = len(Data['Offsets']) - 1
+    ObjInd = ObjectIndex(Data['Offsets'])
+
+    MJD = {}
+    Mag = {}
+    Offsets = {}
+
+    for Band in Bands:
+
+        Mask = (Data['PHOT']['BAND'] == Band) & (Data['PHOT'][Prop] != MagNull)
+
+        Obj = ObjInd[Mask]
+        Keep = (np.bincount(Obj, minlength=ObjectNo) >= 2)[Obj]
+
+        Obj = Obj[Keep]
+        XX = Data['PHOT']['MJD'][Mask][Keep]
+        YY = Data['PHOT'][Prop][Mask][Keep]
+
+        #Knots sorted by time within each object, as interp1d sorts them.
+        Order = np.lexsort((XX, Obj))
+
+        MJD[Band] = XX[Order].astype(np.float64)
+        Mag[Band] = YY[Order].astype(np.float64)
+        Offsets[Band] = np.zeros(ObjectNo+1, dtype=np.int64)
+        np.cumsum(np.bincount(Obj, minlength=ObjectNo), out=Offsets[Band][1:])
+
+    return LightCurveStore(MJD, Mag, Offsets, Bands=Bands)
+
+#Convert one HEAD/PHOT pair into its shard, unless a previous run wrote it.
+def WriteShard(EventName, HeadFile, PhotFile, TargetFolder=TargetFolder):
+
+    Path = ShardPath(EventName, HeadFile, TargetFolder)
+
+    if not os.path.isdir(Path):
+        os.makedirs(os.path.dirname(Path), exist_ok=True)
+        SaveStore(ConvertFile(HeadFile, PhotFile), Path, EventName)
+
+    return Path
+
+#Join the shards of an event, in the order of its files, into its archive.
+def JoinShards(EventName, ShardPaths, TargetFolder=TargetFolder):
+
+    Store = LightCurveStore.Concatenate([ LightCurveStore.Load(Path, mmap_mode=None) for Path in ShardPaths ])
+    SaveStore(Store, ArchivePath(EventName, TargetFolder), EventName)
+
+    if not KeepShards:
+        shutil.rmtree(os.path.join(TargetFolder, 'Shards', EventName), ignore_errors=True)
+
+    return Store.ObjectNo
+
+def PrepareEvents(SourcePath=SourcePath, TargetFolder=TargetFolder, EventNames=EventNames, WorkerNo=WorkerNo):
+
+    PathsDict = GetEventPaths(SourcePath)
+
+    if EventNames is None:
+        EventNames = list(PathsDict)
+
+    os.makedirs(TargetFolder, exist_ok=True)
+    np.save(os.path.join(TargetFolder, 'EventName.npy'), EventNames)
+
+    Left = {}       #EventName: [shard paths, No. of shards left]
+    Futures = {}    #future: (EventName, HEAD file), HEAD file None for the join
+
+    Pool = ProcessPoolExecutor(max_workers=WorkerNo)
+
+    try:
+        for EventName in EventNames:
+
+            if os.path.isdir(ArchivePath(EventName, TargetFolder)):
+                print('{:<25} archive already written.'.format(EventName+':'))
+                continue
+
+            FilePairs = GetFilePairs(PathsDict[EventName])
+
+            if not FilePairs:
+                print('{:<25} no HEAD file found.'.format(EventName+':'))
+                continue
+
+            Left[EventName] = [ [ShardPath(EventName, HeadFile, TargetFolder) for HeadFile, _ in FilePairs], len(FilePairs) ]
+
+            for HeadFile, PhotFile in FilePairs:
+                Futures[Pool.submit(WriteShard, EventName, HeadFile, PhotFile, TargetFolder)] = (EventName, HeadFile)
+
+        print('{} workers, {} files of {} events.'.format(WorkerNo, len(Futures), len(Left)))
+
+        while Futures:
+
+            Done, _ = wait(Futures, return_when=FIRST_COMPLETED)
+
+            for Future in Done:
+
+                EventName, HeadFile = Futures.pop(Future)
+                Result = Future.result()
+
+                if HeadFile is None:
+                    print('{:<25}{} objects -> {}'.format(EventName+':', Result, ArchivePath(EventName, TargetFolder)))
+                    continue
+
+                Left[EventName][1] -= 1
+
+                #The join of an event starts as soon as its last shard is written.
+                if Left[EventName][1] == 0:
+                    Futures[Pool.submit(JoinShards, EventName, Left[EventName][0], TargetFolder)] = (EventName, None)
+
+    finally:
+        Pool.shutdown(cancel_futures=True)
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) < 3:
+        sys.exit('Usage: python PrepareLightCurves.py SourcePath TargetFolder [WorkerNo]')
+
+    SourcePath, TargetFolder = sys.argv[1], sys.argv[2]
+
+    if len(sys.argv) > 3:
+        WorkerNo = int(sys.argv[3])
+
+    print('###############\nStart!\n###############')
+    time1 = time.time()
+
+    PrepareEvents(SourcePath, TargetFolder, WorkerNo=WorkerNo)
+
+    print( '{} min spent.'.format( (time.time() - time1)/60 ))
+    print('###############\nFinish!\n###############')
@@ -6,6 +6,8 @@ from scipy import interpolate
 import pickle
 
 import Functions
+from LightCurves import LightCurveStore
+from CubeBuilder import CubeAccumulator, BuildCheckpoint
 
 Path0 = '/global/homes/l/lianming/Presto-Color-2/data'
 Path1 = '/global/homes/l/lianming/Presto-Color-2/data/Test_Interp'
@@ -21,6 +23,10 @@ EventNames = [ 'SNIa-SALT2']
 PointsPerDay = 0.1
 ObjNo = 1000
 
+#Every finished band pair of an event is kept here (see CubeBuilder.BuildCheckpoint), so a
+#run killed by its time limit resumes from the band pairs left when started again.
+CheckpointFolder = '/global/homes/l/lianming/Presto-Color-2/data/Checkpoint'
+
 #Coordinates
 
 InfoDict = {}
@@ -43,39 +49,61 @@ time1 = time.time()
 dMagRange = [[], []]
 ColorRange = [[], []]
 
+Checkpoint = BuildCheckpoint(CheckpointFolder, {'InfoDict': InfoDict, 'PointsPerDay': PointsPerDay, 'ObjNo': ObjNo})
+Block = (0, len(InfoDict['dT1s'])*len(InfoDict['dT2s']))
+
 for EventName in EventNames:
+
+    #HashTable[ii, jj] is kept as summed up to this event, so the last one finished is resumed.
+    Todo = []
+    for ii, Band1 in enumerate(InfoDict['Bands']):
+        for jj, Band2 in enumerate(InfoDict['Bands']):
+            if jj != ii and Checkpoint.Done(EventName+'_'+Band1+Band2, Block):
+                info, HashTable[ii, jj] = Checkpoint.Load(EventName+'_'+Band1+Band2, Block)
+                dMagRange[0].append(info[1])
+                dMagRange[1].append(info[2])
+                ColorRange[0].append(info[3])
+                ColorRange[1].append(info[4])
+            elif jj != ii:
+                Todo.append((ii, jj))
+
+    if not Todo:
+        continue
     
     FilePath = os.path.join(PathInterp, EventName+'_Interp.pkl')
     with open(FilePath, 'rb') as f:
         Interp_load = pickle.load(f)
         TimeRange_load = pickle.load(f)  
 
+    Store = LightCurveStore.FromInterp(Interp_load)
+
     for ii, Band1 in enumerate(InfoDict['Bands']):
         for jj, Band2 in enumerate(InfoDict['Bands']):
-            if jj==ii:
+            if (ii, jj) not in Todo:
                 continue
             else:
+                #Stream the samples straight into HashTable[ii, jj], seen as [TimePair, BinMag, BinColor].
+                Cube = CubeAccumulator(InfoDict['BinMag'], InfoDict['BinColor'], None, 
+                                       HashTable=HashTable[ii, jj].reshape(-1, *HashTable.shape[-2:]))
+
                 for kk, dT1 in enumerate(InfoDict['dT1s']):
                     for ll, dT2 in enumerate(InfoDict['dT2s']):
 
-                        data = Functions.CalculateMap(Interp_load, TimeRange_load, 
-                                     Band1, Band2, dT1, dT2, PointsPDay=PointsPerDay, ObjNo=ObjNo);
-
-                        histdata,_,_ = np.histogram2d(data[0], data[1], bins=[InfoDict['BinMag'], InfoDict['BinColor']])
+                        Functions.CalculateMap(Store, TimeRange_load, 
+                                     Band1, Band2, dT1, dT2, PointsPDay=PointsPerDay, ObjNo=ObjNo, 
+                                     Cube=Cube, TimePairInd=kk*len(InfoDict['dT2s'])+ll);
 
-                        dMagRange[0].append(data[0].min())
-                        dMagRange[1].append(data[0].max())
-                        ColorRange[0].append(data[1].min())
-                        ColorRange[1].append(data[1].max())
+                        print('|', end='')
 
-                        outliersNo = len(data[0]) - np.sum(histdata)
-                        if outliersNo != 0:
-                            print('{:.0f} outliers found!'.format(outliersNo), end='')
+                dMagRange[0].append(Cube.dMagMin)
+                dMagRange[1].append(Cube.dMagMax)
+                ColorRange[0].append(Cube.ColorMin)
+                ColorRange[1].append(Cube.ColorMax)
 
-#                         HashTable[ii, jj, kk, ll] = histdata*RateDict[EventName] + HashTable[ii, jj, kk, ll]
-                        HashTable[ii, jj, kk, ll] = histdata + HashTable[ii, jj, kk, ll]
+                if Cube.outliersNo != 0:
+                    print('{:.0f} outliers found!'.format(Cube.outliersNo), end='')
 
-                        print('|', end='')
+                Checkpoint.Save(EventName+'_'+Band1+Band2, Block, Cube.Info(), HashTable[ii, jj])
                     
         print('')
             
@@ -107,3 +135,5 @@ with open(FilePath, 'wb') as f:
     pickle.dump(EventNames, f)
     pickle.dump(InfoDict, f)
     pickle.dump(HashTable, f ) 
+
+Checkpoint.Remove()
@@ -0,0 +1,250 @@
+import os
+import sys
+import numpy as np
+import time
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from multiprocessing import shared_memory
+
+from LightCurves import LoadEventCached
+from CubeBuilder import CalculateCube, GridStepOf, SampleStride, SaveCube, BuildCheckpoint, SampleSeed, ObjectChunks
+
+#Single-node cube builder: the same cube as ProbabilityCube_forDask_Final.py, computed
+#by a process pool on the cores of one node, no scheduler needed.
+#Usage: python ProbabilityCube_Local.py [WorkerNo]
+
+#########################################################
+#Parameter setting
+
+RootPath = '/global/cscratch1/sd/lianming/'
+Path1 = '/global/cscratch1/sd/lianming/data/2Day_Interp'
+Path2 = '/global/homes/l/lianming/Presto-Color-2/data/2Day_Interp'
+
+TargetFolder = '/global/cscratch1/sd/lianming/Results/FullRun1/'
+
+PathInterp = Path1
+
+EventNames = ['AGN', 'CART', 'EB', 'ILOT', 'MIRA', 'Mdwarf',
+              'PISN', 'RRL', 'SLSN-I', 'SNII-NMF', 'SNII-Templates', 'SNIIn',
+              'SNIa-91bg', 'SNIa-SALT2', 'SNIax', 'SNIbc-MOSFIT',
+              'SNIbc-Templates', 'TDE', 'V19_CC+HostXT', 'uLens-Binary',
+              'uLens-Single-GenLens', 'uLens-Single_PyLIMA']
+
+PointsPerDay = 1
+Objects = np.arange(0, 40000, 4)
+
+#Seed of the random samples, see CubeBuilder.SampleSeed. The cubes are the same as those
+#of ProbabilityCube_forDask_Final.py with the same Seed.
+Seed = 2021
+
+#Objects per chunk of the manifest of the cubes (see CubeBuilder.ObjectChunks), the
+#ObjectChunk of ProbabilityCube_forDask_Final.py, so the cubes of both builders can be
+#extended by an Incremental build of the Dask script or merged by CombineCubes.py.
+ObjectChunk = 2500
+
+Bands = ['u', 'g', 'r', 'i', 'z', 'Y']
+
+dT1s = np.arange(-480, 481, 15)
+dT2s = np.hstack(( np.arange(-1920, -1439, 30), np.arange(-480, 481, 30), np.arange(1440, 1921, 30) ))
+
+BinMag = np.arange(-5.05, 6.01, 0.1)
+BinColor = np.arange(-9.25, 9.8, 0.5)
+
+Thrs = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3, 'Y': 22.1}
+
+#Number of processes, all the cores available by default.
+WorkerNo = len(os.sched_getaffinity(0))
+
+#Time pairs per task, None to split each band pair into enough blocks to keep every worker busy.
+TimePairChunk = None
+
+#Events whose cubes are held in shared memory at the same time.
+EventsInFlight = 2
+
+#Save only the non-zero bins of the cubes, see CubeBuilder.SparseCube.
+SaveSparse = False
+
+#Every finished block is written to CheckpointFolder/<Event> (see CubeBuilder.BuildCheckpoint),
+#so a job killed by its time limit is resumed by submitting it again.
+CheckpointFolder = os.path.join(TargetFolder, 'Checkpoint')
+
+#########################################################
+#Generating filter pairs and time pairs.
+
+BandPairs = [B1+B2 for B1 in Bands for B2 in Bands if B1!=B2 and B1+B2!='uY' and B1+B2!='Yu']
+TimePairs = [ [ii, jj] for ii in dT1s for jj in dT2s if abs(ii) <= abs(ii-jj) ]
+
+HashTableDim = [ len(BandPairs), len(TimePairs), len(BinMag)-1, len(BinColor)-1 ]
+
+GridStep = GridStepOf(TimePairs)
+
+#PointsPerDay must be a whole number of grid steps apart, see CubeBuilder.SampleStride.
+SampleStride(GridStep, PointsPerDay)
+
+#########################################################
+#Functions
+
+#Use the light-curve archive <Event>_LC if it has been converted, the old pickle otherwise.
+def GeneratePath(EventName, PathInterp=PathInterp):
+    ArchivePath = os.path.join(PathInterp, EventName+'_LC')
+    if os.path.isdir(ArchivePath):
+        return ArchivePath
+    return os.path.join(PathInterp, EventName+'_Interp.pkl')
+
+#The selected objects of an event, the event being loaded once per worker, and their indices.
+def GetStore(FilePath, Objects=Objects):
+
+    Store = LoadEventCached(FilePath)
+    Objs = Objects[Objects < Store.ObjectNo]
+
+    return Store.Select(Objs), Objs
+
+def AttachCube(ShmName):
+
+    try:
+        shm = shared_memory.SharedMemory(name=ShmName, track=False)
+    except TypeError:
+        shm = shared_memory.SharedMemory(name=ShmName)
+
+    return shm, np.ndarray(HashTableDim, dtype=np.uint32, buffer=shm.buf)
+
+#Fill HashTable[BandPairInd, Lo:Hi] of the cube in shared memory.
+def CalculateBlock(FilePath, EventName, ShmName, BandPairInd, Lo, Hi):
+
+    Store, Objs = GetStore(FilePath)
+
+    info, HashTable = CalculateCube(Store, BandPairs[BandPairInd], TimePairs[Lo:Hi], BinMag, BinColor,
+                                    np.arange(len(Objs)), PointsPerDay, Thrs=Thrs, GridStep=GridStep,
+                                    Seed=SampleSeed(Seed, EventName, BandPairs[BandPairInd]), ObjectIDs=Objs)
+
+    shm, HashTableTotal = AttachCube(ShmName)
+    HashTableTotal[BandPairInd, Lo:Hi] = HashTable
+    del HashTableTotal
+    shm.close()
+
+    return info
+
+#The checkpoint of an event, resumed if a previous job left one, and its time-pair blocks.
+#The blocks depend on WorkerNo when TimePairChunk is None, so they are kept in the State of
+#the checkpoint rather than in its Config: a resumed build reuses the blocks of the job
+#which started it, whatever the number of cores of the job resuming it.
+def GetCheckpoint(EventName, Blocks):
+
+    Checkpoint = BuildCheckpoint(os.path.join(CheckpointFolder, EventName),
+                                 {'EventName': EventName, 'BandPairs': BandPairs, 'TimePairs': TimePairs,
+                                  'BinMag': BinMag, 'BinColor': BinColor, 'PointsPerDay': PointsPerDay, 'Objects': Objects, 'Seed': Seed})
+
+    if 'Blocks' not in Checkpoint.State:
+        Checkpoint.State['Blocks'] = Blocks
+        Checkpoint.Commit()
+
+    return Checkpoint, [ tuple(Block) for Block in Checkpoint.State['Blocks'] ]
+
+def BuildLocal(EventNames=EventNames, WorkerNo=WorkerNo, TimePairChunk=TimePairChunk):
+
+    if TimePairChunk is None:
+        BlockNo = int(np.ceil( 4*WorkerNo / len(BandPairs) ))
+        TimePairChunk = int(np.ceil( len(TimePairs) / BlockNo ))
+
+    Blocks = [ (Lo, min(Lo+TimePairChunk, len(TimePairs))) for Lo in range(0, len(TimePairs), TimePairChunk) ]
+
+    print('{} workers, {} tasks per event.'.format(WorkerNo, len(BandPairs)*len(Blocks)))
+
+    Waiting = list(EventNames)
+    Running = {}    #EventName: [shm, Infos, No. of tasks left, BuildCheckpoint]
+    Futures = {}    #future: (EventName, BandPairInd, Lo, Hi)
+
+    Pool = ProcessPoolExecutor(max_workers=WorkerNo)
+
+    try:
+        while Waiting or Futures:
+
+            #Events are taken one after another, each one is spread over all workers.
+            while Waiting and len(Running) < EventsInFlight:
+
+                EventName = Waiting.pop(0)
+                FilePath = GeneratePath(EventName)
+
+                shm = shared_memory.SharedMemory(create=True, size=int(np.prod(HashTableDim))*4)
+                HashTableTotal = np.ndarray(HashTableDim, dtype=np.uint32, buffer=shm.buf)
+                HashTableTotal[:] = 0
+
+                #The blocks finished by a previous job are read back, the others computed.
+                Checkpoint, EventBlocks = GetCheckpoint(EventName, Blocks)
+                Infos = []
+
+                for kk in range(len(BandPairs)):
+                    for Lo, Hi in EventBlocks:
+                        if Checkpoint.Done(BandPairs[kk], (Lo, Hi)):
+                            info, HashTableTotal[kk, Lo:Hi] = Checkpoint.Load(BandPairs[kk], (Lo, Hi))
+                            Infos.append(info)
+                        else:
+                            Futures[Pool.submit(CalculateBlock, FilePath, EventName, shm.name, kk, Lo, Hi)] = (EventName, kk, Lo, Hi)
+
+                del HashTableTotal
+                Running[EventName] = [shm, Infos, len(BandPairs)*len(EventBlocks) - len(Infos), Checkpoint]
+
+                if Infos:
+                    print('{:<25}{} of {} blocks resumed from the checkpoint.'.format(EventName+':', len(Infos), len(BandPairs)*len(EventBlocks)))
+
+            Finished = [ EventName for EventName in Running if Running[EventName][2] == 0 ]
+
+            if Futures:
+                Done, _ = wait(Futures, return_when=FIRST_COMPLETED)
+            else:
+                Done = []
+
+            for Future in Done:
+
+                EventName, kk, Lo, Hi = Futures.pop(Future)
+                shm, Infos, _, Checkpoint = Running[EventName]
+
+                info = Future.result()
+                Infos.append(info)
+                Running[EventName][2] -= 1
+
+                HashTableTotal = np.ndarray(HashTableDim, dtype=np.uint32, buffer=shm.buf)
+                Checkpoint.Save(BandPairs[kk], (Lo, Hi), info, HashTableTotal[kk, Lo:Hi])
+                del HashTableTotal
+
+                if Running[EventName][2] == 0:
+                    Finished.append(EventName)
+
+            for EventName in Finished:
+
+                shm, Infos, _, Checkpoint = Running.pop(EventName)
+                HashTableTotal = np.ndarray(HashTableDim, dtype=np.uint32, buffer=shm.buf)
+
+                #The objects counted are those of Objects in the event (see GetStore), as many as
+                #every info records.
+                Objs = Objects[:Infos[0][0]]
+
+                SaveCube(HashTableTotal, Infos, EventName, BandPairs, dT1s, dT2s, TimePairs,
+                         BinMag, BinColor, PointsPerDay, TargetFolder, Sparse=SaveSparse,
+                         Manifest=ObjectChunks(EventName, Objs, ObjectChunk, Seed), Kernel='SharedGrid')
+                Checkpoint.Remove()
+
+                del HashTableTotal
+                shm.close()
+                shm.unlink()
+
+                print('{:<25} done.'.format(EventName+':'))
+
+    finally:
+        Pool.shutdown(cancel_futures=True)
+        for shm, _, _, _ in Running.values():
+            shm.close()
+            shm.unlink()
+
+
+if __name__ == '__main__':
+
+    if len(sys.argv) > 1:
+        WorkerNo = int(sys.argv[1])
+
+    print('###############\nStart!\n###############')
+    time1 = time.time()
+
+    BuildLocal(WorkerNo=WorkerNo)
+
+    print( '{} min spent.'.format( (time.time() - time1)/60 ))
+    print('###############\nFinish!\n###############')
@@ -1,11 +1,13 @@
 import os
 import numpy as np
 import time
-from scipy import interpolate
-import pickle
 
-import dask
-from dask.distributed import Client
+from LightCurves import LoadEventCached
+from CubeBuilder import CalculateCube, CalculateCubeAllPairs, CalculateCubeExact, CalculateCubeSampling, CubeAccumulator, SaveCube, AddPartials, GridStepOf, SampleStride
+from CubeBuilder import FindCube, ReadManifest, MissingObjects, ObjectChunks, ChunkObjects, AddToCube, BuildCheckpoint
+from CubeBuilder import SampleSeed, ManifestSeed, BuildInfo, CheckBuild, CheckManifest
+
+from dask.distributed import Client, as_completed
 
 scheduler_file = os.path.join(os.environ["SCRATCH"], "scheduler.json")
 
@@ -47,6 +49,50 @@ EventNames = ['AGN', 'CART', 'EB', 'ILOT', 'MIRA', 'Mdwarf',
 PointsPerDay = 1
 Objects = np.arange(0, 40000, 4)
 
+#Seed of the random samples, see CubeBuilder.SampleSeed: with the same Seed the cube is
+#the same however the build is split into tasks, resumed or extended. None for a new one.
+Seed = 2021
+
+#'SharedGrid': one pass over a shared time grid for all time pairs (CubeBuilder.CalculateCube).
+#'Sampling': independent random samples for every time pair (CubeBuilder.CalculateCubeSampling,
+#compiled with Numba if it is installed, the same cube without).
+#'Exact': the exact time-weighted histogram of the linear light curves, no sampling noise
+#(CubeBuilder.CalculateCubeExact). Its cube holds float64 weights in samples.
+Kernel = 'SharedGrid'
+
+#Placement of the samples of the 'Sampling' kernel: 'random', 'stratified' or 'grid', see
+#LightCurves.StreamTimePair. Benchmark_Convergence.py compares them for PointsPerDay.
+SamplingMode = 'random'
+
+#With the SharedGrid kernel, each task computes all band pairs from one evaluation of every
+#band (CubeBuilder.CalculateCubeAllPairs) instead of one band pair, for 1/28 of the tasks.
+AllBandPairs = False
+
+#Granularity of the task graph: each task handles one event, one band pair, TimePairChunk
+#time pairs and ObjectChunk consecutive entries of Objects. Smaller chunks give more,
+#shorter tasks; the partial cubes of the object chunks are summed by a tree reduction.
+TimePairChunk = 256
+ObjectChunk = 2500
+
+#Memory each worker may use to keep loaded events for its later tasks.
+CacheBytes = 4 * 1024**3
+
+#Save only the non-zero bins of the cubes, see CubeBuilder.SparseCube.
+SaveSparse = False
+
+#Count only the objects of Objects missing from the manifest of the newest cube of the
+#event in TargetFolder and add them into that cube in place, see CubeBuilder.AddToCube.
+#Events without a cube get a new one. The cube must have been built with the same
+#parameters (CubeBuilder.BuildKeys) and list its objects in a manifest, which cubes
+#converted from a .pkl lack (CubeBuilder.CheckManifest). Off by default: a rerun then writes new cubes and
+#leaves the existing ones untouched.
+Incremental = False
+
+#Every reduced (band pair, time-pair block) is written to CheckpointFolder/<Event> as soon
+#as it is finished (see CubeBuilder.BuildCheckpoint). A job killed by its time limit is
+#resumed by running the script again, only the blocks not written yet are computed.
+CheckpointFolder = os.path.join(TargetFolder, 'Checkpoint')
+
 Bands = ['u', 'g', 'r', 'i', 'z', 'Y']
 # Bands = ['g', 'i']
 
@@ -67,175 +113,221 @@ Thrs = {'u': 23.9, 'g': 25.0, 'r': 24.7, 'i': 24.0, 'z': 23.3, 'Y': 22.1}
 time1 = time.time()
 
 #########################################################
-#Generating filter pairs, time pairs, see if worker No is enough for the job. 
+#Generating filter pairs, time pairs and the blocks of the task graph.
 
 BandPairs = [B1+B2 for B1 in Bands for B2 in Bands if B1!=B2 and B1+B2!='uY' and B1+B2!='Yu']
 TimePairs = [ [ii, jj] for ii in dT1s for jj in dT2s if abs(ii) <= abs(ii-jj) ]
 
-if WorkerNo < len(EventNames) * len(BandPairs):
-    raise ValueError('Worker Not Enough! No. of worker is {}.'.format(WorkerNo) )
+TimePairBlocks = [ (Lo, min(Lo+TimePairChunk, len(TimePairs))) for Lo in range(0, len(TimePairs), TimePairChunk) ]
 
 HashTableDim = [ len(BandPairs), len(TimePairs), len(BinMag)-1, len(BinColor)-1 ]
 
+#The band pairs of the tasks, 'All' for all of them in each task.
+if AllBandPairs and Kernel != 'SharedGrid':
+    raise ValueError('AllBandPairs needs the SharedGrid kernel.')
+TaskBandPairs = ['All'] if AllBandPairs else BandPairs
+CubeDtype = np.float64 if Kernel == 'Exact' else np.uint32
+
+#Parameters of the build, recorded in its cubes, see CubeBuilder.BuildInfo.
+Build = BuildInfo(BandPairs, dT1s, dT2s, TimePairs, BinMag, BinColor, PointsPerDay, Kernel, SamplingMode)
+
+#Same grid step for every time-pair block.
+GridStep = GridStepOf(TimePairs)
+
+#Refuse a PointsPerDay off the grid here rather than in every task, see CubeBuilder.SampleStride.
+if Kernel == 'SharedGrid':
+    SampleStride(GridStep, PointsPerDay)
+
 #########################################################
 #Functions
 
+#Use the light-curve archive <Event>_LC if it has been converted, the old pickle otherwise.
 def GeneratePath(EventName, PathInterp=PathInterp):
+    ArchivePath = os.path.join(PathInterp, EventName+'_LC')
+    if os.path.isdir(ArchivePath):
+        return ArchivePath
     return os.path.join(PathInterp, EventName+'_Interp.pkl')
 
 def CalculateMap(BandPair, FilePath,
                  TimePairs=TimePairs,  
                  BinMag=BinMag, BinColor=BinColor,
                  HashTableDim=HashTableDim, 
-                 Objects=Objects, PointsPerDay=PointsPerDay, Thrs=Thrs):
+                 Objects=Objects, PointsPerDay=PointsPerDay, Thrs=Thrs, Kernel=Kernel, CacheBytes=CacheBytes, 
+                 EventName=None, Seed=None, SamplingMode=SamplingMode):
     
     Band1 = BandPair[0]
     Band2 = BandPair[1]   
 
-    with open(FilePath, 'rb') as f:
-        Interp_load = pickle.load(f)
-        TimeRange_load = pickle.load(f)    
+    #Loaded once per worker and kept while memory allows, see LightCurves.LoadEventCached.
+    Store = LoadEventCached(FilePath, MaxBytes=CacheBytes)
+    TotalObjNo = Store.ObjectNo
         
-    TotalObjNo = len(Interp_load[Band1])
+    Objects = Objects[Objects<TotalObjNo]
+    if len(Objects) == 0 and BandPair == 'All':
+        return ( [ [0, BP] + CubeAccumulator(BinMag, BinColor, 0).Info() for BP in BandPairs ], 
+                 np.zeros([len(BandPairs), len(TimePairs)]+HashTableDim[2:], dtype=CubeDtype) )
+    if len(Objects) == 0:
+        return [0, BandPair] + CubeAccumulator(BinMag, BinColor, 0).Info(), np.zeros([len(TimePairs)]+HashTableDim[2:], dtype=CubeDtype)
+
+    #Read only the objects used here, renumbered from 0.
+    Store = Store.Select(Objects)
+
+    if BandPair == 'All':
+        return CalculateCubeAllPairs(Store, BandPairs, TimePairs, BinMag, BinColor, np.arange(len(Objects)), PointsPerDay, 
+                                     Thrs=Thrs, GridStep=GridStep, Seed=SampleSeed(Seed, EventName, 'All'), ObjectIDs=Objects)
+
+    if Kernel == 'SharedGrid':
+        return CalculateCube(Store, BandPair, TimePairs, BinMag, BinColor, np.arange(len(Objects)), PointsPerDay, 
+                             Thrs=Thrs, GridStep=GridStep, Seed=SampleSeed(Seed, EventName, BandPair), ObjectIDs=Objects)
+
+    if Kernel == 'Exact':
+        return CalculateCubeExact(Store, BandPair, TimePairs, BinMag, BinColor, np.arange(len(Objects)), PointsPerDay, Thrs=Thrs)
         
-    if TotalObjNo <= Objects[-1]:
-        Objects = Objects[Objects<TotalObjNo]
-        
-    HashTable = np.zeros(HashTableDim[1:], dtype=np.uint32)
-    
-    for kk, TimePair in enumerate(TimePairs):
-        
-        dT1 = TimePair[0]
-        dT2 = TimePair[1]
-
-        dMag = []
-        Color = []
-
-        dMagMin = []
-        dMagMax = []
-        ColorMin = []
-        ColorMax = []
-
-        for II in Objects:
-
-            if Interp_load[Band1][II]==[] or Interp_load[Band2][II]==[]:
-                continue
-
-            #Decide the range and the length of XX.
-            TimeRangeStart = max( TimeRange_load[Band1][II][0], TimeRange_load[Band2][II][0] - dT1/1440, TimeRange_load[Band1][II][0] - dT2/1440 )
-            TimeRangeEnd = min( TimeRange_load[Band1][II][1], TimeRange_load[Band1][II][1] - dT2/1440, TimeRange_load[Band2][II][1] - dT1/1440 )
-
-            TimeRange = TimeRangeEnd - TimeRangeStart
-            if TimeRange<=0:
-                continue
-                
-            SampleNo = int(PointsPerDay*TimeRange)
-
-            XX = np.random.rand(SampleNo)*TimeRange + TimeRangeStart
-
-            #Calculate the values of the functions with selected x values.  
-            Mag1 = Interp_load[Band1][II](XX)
-            Mag2 = Interp_load[Band2][II](XX+dT1/1440)
-            Mag12 = Interp_load[Band1][II](XX+dT2/1440)
-
-            #Add a threshold for the results and output.
-            Mask = (Mag1<Thrs[Band1]) * (Mag2<Thrs[Band2]) * (Mag12<Thrs[Band1])
-
-            dMag.extend(  (Mag1[Mask] - Mag12[Mask])*np.sign(dT2) )
-            Color.extend(Mag1[Mask] - Mag2[Mask])
-
-        # data = np.array([dMag, Color])
-        histdata,_,_ = np.histogram2d(dMag, Color, bins=[BinMag, BinColor])
-
-        dMagMin.append(min(dMag))
-        dMagMax.append(max(dMag))
-        ColorMin.append(min(Color))
-        ColorMax.append(max(Color))
-
-        outliersNo = len(dMag) - int(histdata.sum())
-
-        HashTable[kk] = histdata
-            
-    return  [len(Objects), BandPair, outliersNo, min(dMagMin), max(dMagMax), min(ColorMin), max(ColorMax)], HashTable
-
-def reduceAndSave(results, EventName, HashTableDim=HashTableDim, 
+    Keys = [ SampleSeed(Seed, EventName, BandPair, int(dT1), int(dT2)).generate_state(1, np.uint64)[0] for dT1, dT2 in TimePairs ]
+
+    return CalculateCubeSampling(Store, BandPair, TimePairs, BinMag, BinColor, np.arange(len(Objects)), PointsPerDay, Keys, 
+                                 Thrs=Thrs, ObjectIDs=Objects, Mode=SamplingMode)
+
+#One task: a block of time pairs of a band pair (or of all, BandPair='All') for a chunk of
+#objects (see CubeBuilder.ObjectChunks).
+def CalculateBlock(BandPair, FilePath, TimePairBlock, Chunk):
+    return CalculateMap(BandPair, FilePath, TimePairs=TimePairs[TimePairBlock[0]:TimePairBlock[1]], 
+                        Objects=ChunkObjects(Chunk), EventName=Chunk['Event'], Seed=Chunk['Seed'])
+
+#The checkpoint of an event, resumed if a previous run left one.
+def GetCheckpoint(EventName):
+    return BuildCheckpoint(os.path.join(CheckpointFolder, EventName),
+                           {'EventName': EventName, 'BandPairs': BandPairs, 'TimePairs': TimePairs, 'TimePairBlocks': TimePairBlocks,
+                            'BinMag': BinMag, 'BinColor': BinColor, 'PointsPerDay': PointsPerDay, 'Kernel': Kernel, 'SamplingMode': SamplingMode,
+                            'AllBandPairs': AllBandPairs})
+
+#Write a reduced block to the checkpoint of its event and return its info.
+def flushBlock(EventName, BandPair, TimePairBlock, Result):
+    BuildCheckpoint.WriteBlock(os.path.join(CheckpointFolder, EventName), BandPair, TimePairBlock, Result[1])
+    return Result[0]
+
+#Assemble the cube of an event from the blocks of its checkpoint, add it into the cube
+#CubePath if given or save it as a new cube, then remove the checkpoint.
+def reduceAndSave(EventName, Chunks, CubePath=None, HashTableDim=HashTableDim, 
                   BandPairs=BandPairs, dT1s=dT1s, dT2s=dT2s, TimePairs=TimePairs, 
                   BinMag=BinMag, BinColor=BinColor, PointsPerDay=PointsPerDay, TargetFolder=TargetFolder):
     
-    HashTableTotal = np.zeros(HashTableDim, dtype=np.uint32)
-    
-    outliersNo = 0
-    dMagMin = []
-    dMagMax = []
-    ColorMin = []
-    ColorMax = []
+    Checkpoint = GetCheckpoint(EventName)
+
+    HashTableTotal = np.zeros(HashTableDim, dtype=CubeDtype)
+    Infos = []
     
-    for info, HashTable in results:
-        
-        HashTableTotal[BandPairs.index(info[1])] = HashTable
-        outliersNo += info[2]
-        dMagMin.append(info[3])
-        dMagMax.append(info[4])
-        ColorMin.append(info[5])
-        ColorMax.append(info[6])
-        
-    InfoDict = {}
-    InfoDict['EventName'] = EventName
-    InfoDict['PointsPerDay'] = PointsPerDay
-    InfoDict['ObjectNo'] = results[0][0][0]
+    for BandPair in TaskBandPairs:
+        for TimePairBlock in TimePairBlocks:
+            info, HashTable = Checkpoint.Load(BandPair, TimePairBlock)
+            if BandPair == 'All':
+                HashTableTotal[:, TimePairBlock[0]:TimePairBlock[1]] = HashTable
+                Infos.extend(info)
+            else:
+                HashTableTotal[BandPairs.index(BandPair), TimePairBlock[0]:TimePairBlock[1]] = HashTable
+                Infos.append(info)
+
+    if CubePath is not None:
+        AddToCube(CubePath, HashTableTotal, Infos, Chunks, Build)
+    else:
+        SaveCube(HashTableTotal, Infos, EventName, BandPairs, dT1s, dT2s, TimePairs, 
+                 BinMag, BinColor, PointsPerDay, TargetFolder, Sparse=SaveSparse, Manifest=Chunks,
+                 Kernel=Kernel, SamplingMode=SamplingMode)
+
+    Checkpoint.Remove()
 
-    InfoDict['BandPairs'] = [ii.lower() for ii in BandPairs]
+#########################################################
+#Task graph
 
-    InfoDict['dT1s'] = dT1s
-    InfoDict['dT2s'] = dT2s
+#Submit every (event, band pair, time-pair block, object block) task not in a checkpoint
+#yet. As soon as two partial cubes of the same (event, band pair, time-pair block) are
+#ready they are summed on the cluster. A block reduced to one cube is written to the
+#checkpoint of its event, and the event is saved once all its blocks are written.
 
-    InfoDict['BinMag'] = BinMag
-    InfoDict['BinColor'] = BinColor
+Groups = {}     #future: (EventName, BandPair, TimePairBlock)
+Left = {}       #group: No. of partial cubes not summed yet
+Holding = {}    #group: a finished partial cube waiting for a partner
+Flushing = set() #futures writing a block to its checkpoint
+Inputs = {}     #future: its input futures, referenced here until it is done so they are not released early
+Checkpoints = {} #EventName: BuildCheckpoint, its State holding the Chunks of objects counted and the CubePath added into
+Saved = []
 
-    InfoDict['dMagRange'] = [ min(dMagMin), max(dMagMax) ]
-    InfoDict['ColorRange'] = [ min(ColorMin), max(ColorMax) ]
-    InfoDict['TimePairs'] = np.array(TimePairs)
-    
-    if outliersNo>0:
-        InfoDict['Outliers'] = outliersNo
-        InfoDict['OutliersRatio'] = outliersNo / HashTableTotal.max()        
+for EventName in EventNames:
     
-    if HashTableTotal.min()<0:
-        InfoDict['Overflow'] = HashTableTotal.min()
-        
-    #Save results
+    Path = GeneratePath(EventName)
+    Checkpoint = GetCheckpoint(EventName)
 
-    FileName = 'ProbCube_' + time.strftime('%m%d_%H%M') + '__' + EventName + '.pkl'
+    #The objects and seeds of a resumed build are those of the run which started it.
+    if 'Chunks' not in Checkpoint.State:
 
-    FilePath = os.path.join(TargetFolder, FileName)
-    FilePath0 = FilePath
+        CubePath = FindCube(TargetFolder, EventName) if Incremental else None
+        EventObjects = Objects
+        EventSeed = Seed
+        if CubePath is not None:
+            CheckBuild(CubePath, Build)
+            CheckManifest(CubePath, EventName)
+            EventObjects = MissingObjects(Objects, ReadManifest(CubePath), EventName)
+            EventSeed = ManifestSeed(ReadManifest(CubePath), EventName)
 
-    ii = 1
-    while os.path.exists(FilePath):
-        FilePath = FilePath0[:-4] + '('+str(ii)+')' + '.pkl'
-        ii += 1
+        if len(EventObjects) == 0:
+            print('{:<25} all objects already counted in {}.'.format(EventName+':', os.path.basename(CubePath)))
+            Checkpoint.Remove()
+            continue
 
-    with open(FilePath, 'wb') as f:
-        pickle.dump(InfoDict, f)
-        pickle.dump(HashTableTotal, f ) 
+        Checkpoint.State = {'Chunks': ObjectChunks(EventName, EventObjects, ObjectChunk, EventSeed), 'CubePath': CubePath}
+        Checkpoint.Commit()
 
-#########################################################
-#Delayed
+    Checkpoints[EventName] = Checkpoint
+    Chunks = Checkpoint.State['Chunks']
 
-lazy_results_Total = []
+    Todo = [ (BandPair, TimePairBlock) for BandPair in TaskBandPairs for TimePairBlock in TimePairBlocks
+             if not Checkpoint.Done(BandPair, TimePairBlock) ]
 
-for EventName in EventNames:
-    
-    lazy_results = []
-    
-    Path = GeneratePath(EventName)
-    
-    for BandPair in BandPairs:
-        lazy_results.append(dask.delayed(CalculateMap)(BandPair, Path))
-        
-    lazy_results_Total.append( dask.delayed(reduceAndSave)(lazy_results, EventName) )
+    print('{:<25}{} objects, {} of {} blocks to do, {} tasks.'.format(EventName+':', sum(len(ChunkObjects(Chunk)) for Chunk in Chunks), 
+                                                                    len(Todo), len(TaskBandPairs)*len(TimePairBlocks), len(Todo)*len(Chunks)))
+
+    if not Todo:
+        Saved.append(client.submit(reduceAndSave, EventName, Chunks, Checkpoint.State['CubePath'], pure=False))
     
-dask.compute(*lazy_results_Total);
+    for BandPair, TimePairBlock in Todo:
+
+        Group = (EventName, BandPair, TimePairBlock)
+        Left[Group] = len(Chunks)
+
+        for Chunk in Chunks:
+            Groups[client.submit(CalculateBlock, BandPair, Path, TimePairBlock, Chunk, pure=False)] = Group
+
+Sequence = as_completed(list(Groups))
+
+for Future in Sequence:
+
+    Group = Groups.pop(Future)
+    EventName, BandPair, TimePairBlock = Group
+    Inputs.pop(Future, None)
+
+    if Future in Flushing:
+        Flushing.remove(Future)
+        Checkpoint = Checkpoints[EventName]
+        Checkpoint.Finish(BandPair, TimePairBlock, Future.result())
+
+        if len(Checkpoint.Blocks) == len(TaskBandPairs)*len(TimePairBlocks):
+            Saved.append(client.submit(reduceAndSave, EventName, Checkpoint.State['Chunks'], Checkpoint.State['CubePath'], pure=False))
+    elif Group in Holding:
+        Summed = client.submit(AddPartials, Holding[Group], Future)
+        Inputs[Summed] = (Holding.pop(Group), Future)
+        Groups[Summed] = Group
+        Sequence.add(Summed)
+        Left[Group] -= 1
+    elif Left[Group] > 1:
+        Holding[Group] = Future
+    else:
+        Flushed = client.submit(flushBlock, EventName, BandPair, TimePairBlock, Future)
+        Inputs[Flushed] = (Future,)
+        Groups[Flushed] = Group
+        Flushing.add(Flushed)
+        Sequence.add(Flushed)
+
+client.gather(Saved);
 
 #########################
 
@@ -14,4 +14,4 @@ export OMP_PROC_BIND=spread
 
 module load python
 #run the application:
-srun -n 1 -c 64 --cpu_bind=cores python3 /global/homes/l/lianming/Presto-Color-2/ProbabilityCube.py
+srun -n 1 -c 64 --cpu_bind=cores python3 /global/homes/l/lianming/Presto-Color-2/ProbabilityCube_Local.py 64